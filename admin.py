@@ -0,0 +1,162 @@
+# "MYSHLENEK", the admin endpoint
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# A small HTTP server for the operators of the bot. It listens on 127.0.0.1 only,
+# on the ADMIN_PORT port (see 'settings.py'); if ADMIN_PORT is not set, it is not started at all.
+
+# The routes:
+# - GET  /metrics        : all the metrics as JSON (see 'metrics.py');
+# - POST /profile/start  : start the sampling profiler (see 'profiling.py');
+# - POST /profile/stop   : stop it and write the folded stacks; the answer holds the path of the file;
+# - GET  /config         : the active settings, with the secrets hidden (see 'settings.py');
+# - POST /config         : set some settings, for example {"max_concurrent_generations": 8},
+#                          and apply them to the running bot; an invalid value is refused with 400;
+# - POST /config/reload  : read the environment and the configuration file again and apply them;
+# - GET  /memory         : the last memory report (see 'memory.py'), measured now if there is none yet;
+# - POST /memory/sample  : measure the memory now (and evict, if the high-water mark is passed);
+# - GET  /usage          : the tokens used in the rolling window, per model and for the heaviest chats
+#                          (see 'usage_ledger.py').
+
+# Every route is a function that takes the request body (parsed JSON or None)
+# and returns a dictionary, which is sent back as JSON.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import memory
+import metrics
+import profiling
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE ROUTES
+
+ROUTES = {}  # (method, path) -> function
+_get_components = dict  # returns the components of the bot (set by 'start_admin_server')
+
+
+def route(method, path):
+    def register(func):
+        ROUTES[(method, path)] = func
+        return func
+    return register
+
+
+@route('GET', '/metrics')
+def get_metrics(body):
+    return metrics.snapshot()
+
+
+@route('POST', '/profile/start')
+def start_profile(body):
+    return {'started': profiling.sampling_profiler.start()}
+
+
+@route('POST', '/profile/stop')
+def stop_profile(body):
+    from settings import get_config
+
+    return {'path': profiling.sampling_profiler.stop(get_config().profile_dir)}
+
+
+@route('GET', '/config')
+def get_settings(body):
+    from settings import describe_config
+
+    return describe_config()
+
+
+@route('POST', '/config')
+def set_settings(body):
+    from settings import describe_config, reload_config
+
+    if not isinstance(body, dict):
+        raise ValueError("A JSON object with the settings is expected")
+    return describe_config(reload_config(body))
+
+
+@route('POST', '/config/reload')
+def reload_settings(body):
+    from settings import describe_config, reload_config
+
+    return describe_config(reload_config())
+
+
+@route('GET', '/memory')
+def get_memory(body):
+    return memory.memory_monitor.last_report or memory.memory_monitor.sample()
+
+
+@route('POST', '/memory/sample')
+def sample_memory(body):
+    return memory.memory_monitor.sample()
+
+
+@route('GET', '/usage')
+def get_usage(body):
+    ledger = _get_components().get('usage_ledger')
+    return ledger.report() if ledger is not None else {}
+
+####################################
+
+# THE "START_ADMIN_SERVER" FUNCTION
+
+# Starts the server in a daemon thread and returns it. 'get_components' returns the components of the bot
+# (see 'main.py'), for the routes that read them.
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        func = ROUTES.get((method, self.path.split('?')[0]))
+        if func is None:
+            self._reply(404, {'error': 'Resource not found'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length)) if length else None
+            self._reply(200, func(body))
+        except ValueError as e:
+            self._reply(400, {'error': str(e)})
+        except Exception as e:
+            logger.exception("Admin request failed: {}".format(e))
+            self._reply(500, {'error': str(e)})
+
+    def _reply(self, status, data):
+        body = json.dumps(data, ensure_ascii=False, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_admin_server(port, host='127.0.0.1', get_components=None):
+    global _get_components
+    if get_components is not None:
+        _get_components = get_components
+    server = ThreadingHTTPServer((host, port), AdminHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='admin', daemon=True).start()
+    logger.error("Admin endpoint listening on %s:%d", host, port)
+    return server
@@ -0,0 +1,171 @@
+# "MYSHLENEK", the micro-benchmarks
+# Usage: python cli.py bench [names...] (or python bench.py [names...])
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Measures the hot spots of the bot in isolation, so the effect of a change can be checked in seconds,
+# without the network. For the whole path with realistic traffic, see 'replay.py'.
+
+# Every benchmark is a function that prepares its data (in a temporary directory, if it needs files)
+# and returns the function to measure. It is registered in BENCHMARKS with the '@benchmark' decorator.
+# The measured function is called repeatedly for about 'seconds' seconds, and the mean time of one call
+# and the number of calls are printed.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import argparse
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS = {}  # name -> function preparing the benchmark and returning the function to measure
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+####################################
+
+# THE BENCHMARKS
+
+
+@benchmark('cold_start')
+def bench_cold_start(workdir):
+    # Importing 'main' in a new interpreter, minus the start of the interpreter itself
+    def run():
+        subprocess.run([sys.executable, '-c', 'import main'], cwd=HERE, check=True)
+
+    def baseline():
+        subprocess.run([sys.executable, '-c', 'pass'], cwd=HERE, check=True)
+
+    run.baseline = baseline
+    return run
+
+
+@benchmark('semantic_cache_lookup')
+def bench_semantic_cache_lookup(workdir):
+    from semantic_cache import SemanticCache
+
+    cache = SemanticCache(os.path.join(workdir, 'semantic_cache'), capacity=10000)
+    words = _words(3000)
+    for i in range(cache.capacity):
+        cache.store(' '.join(random.choices(words, k=12)), 'answer {}'.format(i))
+    query = ' '.join(random.choices(words, k=12))
+    return lambda: cache.lookup(query)
+
+
+@benchmark('knowledge_search')
+def bench_knowledge_search(workdir):
+    from knowledge_base import KnowledgeBase
+
+    corpus_dir = os.path.join(workdir, 'knowledge')
+    os.makedirs(corpus_dir)
+    words = _words(5000)
+    for i in range(20):
+        with open(os.path.join(corpus_dir, 'part{}.txt'.format(i)), 'w', encoding='utf-8') as corpus_file:
+            corpus_file.write('\n\n'.join(' '.join(random.choices(words, k=100)) for _ in range(100)))
+    knowledge_base = KnowledgeBase(corpus_dir, os.path.join(workdir, 'knowledge_index'))
+    query = ' '.join(random.choices(words, k=8))
+    return lambda: knowledge_base.retrieve(query)
+
+
+@benchmark('conversation_render')
+def bench_conversation_render(workdir):
+    from conversation_store import Conversation, USER, BOT
+
+    conversation = Conversation()
+    for i in range(100):
+        conversation.add(USER if i % 2 == 0 else BOT, 'message number {} '.format(i) * 20)
+    return conversation.render
+
+
+# The request of 'generate_response' with a prompt of about 8 KB, serialized the old way
+# (dumps, loads to "validate", and dumps again inside 'requests') and with 'codec.encode' (once,
+# with orjson if it is installed)
+
+def _request_data():
+    prompt = ' '.join(random.choices(_words(3000) + ['противоречие', 'идеальный', 'результат'], k=1200))
+    return {"model": "gpt-4-1106-preview", "prompt": prompt, "temperature": 0.9, "max_tokens": 2200,
+            "top_p": 1, "n": 1, "stream": True}
+
+
+@benchmark('request_encode_legacy')
+def bench_request_encode_legacy(workdir):
+    import json
+
+    data = _request_data()
+
+    def run():
+        json.loads(json.dumps(data))
+        json.dumps(data).encode('utf-8')
+    return run
+
+
+@benchmark('request_encode')
+def bench_request_encode(workdir):
+    import codec
+
+    print("(JSON backend: {})".format(codec.BACKEND))
+    data = _request_data()
+    return lambda: codec.encode(data)
+
+
+def _words(count):
+    random.seed(1)
+    return ['w{}'.format(i) for i in range(count)]
+
+####################################
+
+# THE "RUN_BENCHMARK" FUNCTION
+
+# Returns the mean time of one call in seconds and the number of calls.
+
+
+def run_benchmark(func, seconds=1.0):
+    func()  # warm up
+    calls = 0
+    started = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - started
+        if elapsed >= seconds:
+            return elapsed / calls, calls
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description="Run the micro-benchmarks of the bot")
+    parser.add_argument('names', nargs='*', help="the benchmarks to run (all by default): " + ', '.join(BENCHMARKS))
+    parser.add_argument('--seconds', type=float, default=1.0, help="how long to run each benchmark")
+    return parser
+
+
+def main(args):
+    sys.path.insert(0, HERE)
+    names = args.names or list(BENCHMARKS)
+    results = {}
+    for name in names:
+        with tempfile.TemporaryDirectory(prefix='myshlenek-bench-') as workdir:
+            func = BENCHMARKS[name](workdir)
+            mean, calls = run_benchmark(func, args.seconds)
+            if hasattr(func, 'baseline'):
+                mean -= run_benchmark(func.baseline, args.seconds)[0]
+        results[name] = mean
+        print("{:<28} {:>10.3f} ms  ({} calls)".format(name, mean * 1000, calls))
+    return results
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
@@ -0,0 +1,119 @@
+# "MYSHLENEK", the cancellation helpers
+# Used by 'main.py' and 'scheduler.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# A generation started by the 'GENERATE_RESPONSE' function can run for a long time
+# (up to 'max_tokens' tokens of output). If the User sends '/stop', resets the chat,
+# or sends a newer message that supersedes the old one, nobody will read that answer.
+
+# This module provides the 'CANCEL_TOKEN' object, which is handed to a generation
+# and can be triggered from another thread. When it is triggered:
+# - the HTTP response attached to it is closed, which aborts the stream from the OpenAI API;
+# - the code checking the token raises the 'GENERATION_CANCELLED' exception;
+# - the worker running the generation is released, and 'send_message' is skipped.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import socket
+import threading
+
+####################################
+
+# THE "GENERATION_CANCELLED" EXCEPTION
+
+# Raised by 'CancelToken.raise_if_cancelled' when the generation was cancelled.
+
+
+class GenerationCancelled(Exception):
+    pass
+
+####################################
+
+# THE "CANCEL_TOKEN" CLASS
+
+# The token wraps a 'threading.Event' (so it can be set from any thread)
+# and remembers the HTTP response currently in use, so it can be closed on cancellation.
+# The 'reason' field tells the logs why the generation was cancelled ('stop', 'reset', 'superseded').
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._response = None
+        self.reason = None
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="cancelled"):
+        # Set the event and close the attached response (if any) outside of the lock
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            response = self._response
+        _close_quietly(response)
+        return True
+
+    def attach(self, response):
+        # Remember the response, so that 'cancel' can abort it.
+        # If the token is already cancelled, the response is closed right away.
+        with self._lock:
+            self._response = response
+            cancelled = self._event.is_set()
+        if cancelled:
+            _close_quietly(response)
+
+    def detach(self):
+        with self._lock:
+            self._response = None
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled(self.reason)
+
+    def wait(self, timeout=None):
+        return self._event.wait(timeout)
+
+####################################
+
+# THE "_CLOSE_QUIETLY" HELPER
+
+# Closing a response from another thread makes the reading thread fail with a connection error,
+# which is exactly what we want. Any error raised by the close itself is ignored.
+# The reading thread holds the lock of the buffered socket file while it waits for the next bytes,
+# and 'close' waits for that lock, so a stalled stream would block the cancelling thread (the polling loop
+# or a webhook request) until the OpenAI API sends something. The socket is shut down first ('_socket_of'),
+# which makes the waiting read return at once.
+
+
+def _close_quietly(response):
+    if response is None:
+        return
+    try:
+        sock = _socket_of(response)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+
+# The socket under a 'requests' response: response.raw (urllib3) -> _fp (http.client) -> fp (the buffered
+# socket file) -> raw (socket.SocketIO) -> _sock; None if any of them is missing
+def _socket_of(response):
+    target = getattr(response, 'raw', None)
+    for name in ('_fp', 'fp', 'raw', '_sock'):
+        target = getattr(target, name, None)
+    return target
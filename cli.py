@@ -0,0 +1,130 @@
+# "MYSHLENEK", the command line
+# Usage: python cli.py {poll,webhook,bench,replay,logs} [options]
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# One entry point for all the ways to run the bot:
+# - 'poll'    : poll the Telegram API for updates (the 'MAIN LOOP' of 'main.py');
+# - 'webhook' : serve the webhook application of 'wsgi.py' with the simple server of the standard library
+#               (in production, run 'wsgi:application' with gunicorn instead); SIGUSR2 restarts it
+#               without refusing any connection (see 'lifecycle.py');
+# - 'bench'   : run the micro-benchmarks (see 'bench.py');
+# - 'replay'  : replay recorded traffic against local stand-ins (see 'replay.py');
+# - 'logs'    : aggregate the OpenAI latency, status codes and throughput from the log (see 'log_analyzer.py').
+
+# Each command imports only the modules it needs, when it runs,
+# so 'python cli.py --help' and the light commands start instantly.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import argparse
+import sys
+
+####################################
+
+# THE COMMANDS
+
+
+def run_poll(args):
+    from main import run_polling
+    run_polling()
+
+
+# The webhook server handles every request in its own thread, so a new update is taken in
+# while the others are still being read. It stops gracefully on SIGTERM: the requests being handled are
+# finished, and the answers still being generated get up to 'drain_seconds' (see 'drain' in 'main.py').
+# On SIGUSR2 it hands its listening socket over to a new process first (see 'lifecycle.py').
+# As in the polling mode, SIGUSR1 toggles the sampling profiler (see 'profiling.py'), SIGHUP reloads
+# the settings (see 'settings.py'), and the admin endpoint is started if ADMIN_PORT is set
+# (see 'start_worker' in 'wsgi.py'); its POST /config/reload reloads the settings too.
+# A process started by such a handoff serves the inherited socket instead of binding a new one.
+
+
+def run_webhook(args):
+    from socketserver import ThreadingMixIn
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+    import lifecycle
+    import profiling
+    from main import drain, install_reload_signal_handler
+    from wsgi import application, start_worker
+
+    class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+        pass
+
+    listening_socket = lifecycle.inherited_socket()
+    server = ThreadingWSGIServer((args.host, args.port), WSGIRequestHandler, bind_and_activate=listening_socket is None)
+    if listening_socket is not None:
+        server.socket.close()
+        server.socket = listening_socket
+        server.server_address = listening_socket.getsockname()
+        server.server_name, server.server_port = server.server_address[:2]
+        server.setup_environ()
+    server.set_app(application)
+
+    lifecycle.install_stop_handlers(on_stop=server.shutdown)
+    lifecycle.install_handoff_handler(server)
+    profiling.install_signal_handler()
+    install_reload_signal_handler()
+    start_worker(drain_at_exit=False)
+    with server:
+        print("Serving the webhook on {}:{}".format(*server.server_address[:2]))
+        server.serve_forever()
+    drain({})
+
+
+def run_bench(args):
+    import bench
+    bench.main(args)
+
+
+def run_replay(args):
+    import replay
+    replay.main(args)
+
+
+def run_logs(args):
+    import log_analyzer
+    log_analyzer.main(args)
+
+####################################
+
+# THE "BUILD_PARSER" FUNCTION
+
+# The options of 'bench', 'replay' and 'logs' are defined by their own scripts (their 'build_parser' functions).
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description="MYSHLENEK, the TRIZ thinking bot")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    poll = commands.add_parser('poll', help="poll the Telegram API for updates")
+    poll.set_defaults(func=run_poll)
+
+    webhook = commands.add_parser('webhook', help="serve the webhook application")
+    webhook.add_argument('--host', default='127.0.0.1')
+    webhook.add_argument('--port', type=int, default=8080)
+    webhook.set_defaults(func=run_webhook)
+
+    import bench
+    bench.build_parser(commands.add_parser('bench', help="run the micro-benchmarks")).set_defaults(func=run_bench)
+
+    import replay
+    replay.build_parser(commands.add_parser('replay', help="replay recorded traffic")).set_defaults(func=run_replay)
+
+    import log_analyzer
+    log_analyzer.build_parser(commands.add_parser('logs', help="analyze the log")).set_defaults(func=run_logs)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
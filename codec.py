@@ -0,0 +1,85 @@
+# "MYSHLENEK", the JSON codec
+# Used by 'main.py', 'wsgi.py' and 'traffic.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# 'generate_response' used to turn the request into JSON three times: 'json.dumps' to "validate" it,
+# 'json.loads' to check the result, and once more inside 'requests' ('json=data'). It also logged
+# the whole request three times. With prompts of several kilobytes, this was pure CPU overhead.
+
+# Now every outgoing body is serialized once, by 'encode', into an 'ENCODED_BODY': the bytes are sent
+# as they are ('data=body.body'), written to the log (decoded only if the log line is really written),
+# and hashed into a short key ('body.key') for the tracing and the caches.
+
+# 'dumps' and 'loads' use orjson if it is installed (it is several times faster than the standard
+# 'json' module), and the standard module otherwise; both give the same compact UTF-8 JSON.
+# orjson is optional, it is listed in 'requirements-optional.txt'.
+# The decoding errors of both are subclasses of 'json.JSONDecodeError' (and of 'ValueError'),
+# so the existing error handling does not change. BACKEND tells which one is in use.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import hashlib
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+####################################
+
+# THE "DUMPS" AND "LOADS" FUNCTIONS
+
+# 'dumps' returns bytes; 'loads' takes bytes or a string.
+
+
+if orjson is not None:
+    def dumps(data):
+        return orjson.dumps(data)
+
+    def loads(data):
+        return orjson.loads(data)
+else:
+    def dumps(data):
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        return json.loads(data)
+
+####################################
+
+# THE "ENCODED_BODY" CLASS
+
+
+class EncodedBody:
+    __slots__ = ('data', 'body', '_key')
+
+    def __init__(self, data):
+        self.data = data
+        self.body = dumps(data)  # raises TypeError or ValueError if the data cannot be serialized
+        self._key = None
+
+    # A short hash of the bytes, computed on first use
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = hashlib.blake2b(self.body, digest_size=16).hexdigest()
+        return self._key
+
+    def __len__(self):
+        return len(self.body)
+
+    # For the log lines: the bytes are decoded only when the line is written
+    def __str__(self):
+        return self.body.decode('utf-8', 'replace')
+
+
+def encode(data):
+    return EncodedBody(data)
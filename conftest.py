@@ -0,0 +1,105 @@
+# "MYSHLENEK", the fixtures of the checks
+# Used by the 'test_*.py' scripts
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The checks that run the whole bot share one bot, loaded once in a temporary directory and pointed at
+# the local stand-ins of the Telegram API and the OpenAI API (see 'replay.py'):
+# - 'stand_ins' loads it (once per session: the settings of the bot are read once);
+# - 'bot' gives every check a new scheduler and empty records of the stand-ins;
+# - 'held' holds the answers of the OpenAI stand-in until the check lets them go ('held.release()'),
+#   and 'held.wait_started()' waits until the answer of a generation has started, so the order of the events
+#   is set by the check itself, not by sleeps.
+# 'message' builds a text update, and 'sent_to' returns the texts sent to a chat.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import os
+import queue
+
+import pytest
+
+import replay
+
+OPENAI_LATENCY = 0.2  # seconds per answer of the OpenAI stand-in
+FAILURE = "Seems, something happened, sorry."
+
+####################################
+
+# THE FIXTURES
+
+
+@pytest.fixture(scope='session')
+def stand_ins():
+    environ = dict(os.environ)
+    directory = os.getcwd()
+    os.environ['DRAIN_SECONDS'] = '0.2'
+    server, base_url = replay.start_stand_ins(OPENAI_LATENCY, 20)
+    bot = replay.load_bot(base_url)
+    yield server, bot
+    server.gate.set()
+    server.shutdown()
+    bot.flush_components()
+    os.chdir(directory)
+    os.environ.clear()
+    os.environ.update(environ)
+
+
+@pytest.fixture
+def bot(stand_ins):
+    from scheduler import Scheduler
+
+    server, bot = stand_ins
+    bot.set_component('scheduler', Scheduler(2))
+    del server.sent[:]
+    del server.openai_statuses[:]
+    while not server.completions_started.empty():
+        server.completions_started.get_nowait()
+    yield bot
+    server.gate.set()
+    bot.get_component('scheduler').drain(10)
+
+
+@pytest.fixture
+def server(stand_ins):
+    return stand_ins[0]
+
+
+class Held:
+    def __init__(self, server):
+        self.server = server
+        server.gate.clear()
+
+    # Waits until the answer of a generation has started (see 'replay.py'); returns its prompt
+    def wait_started(self, timeout=10):
+        try:
+            return self.server.completions_started.get(timeout=timeout)
+        except queue.Empty:
+            pytest.fail("no generation reached the OpenAI stand-in")
+
+    def release(self):
+        self.server.gate.set()
+
+
+# 'bot' is torn down after it, so its scheduler is drained with the answers let go
+@pytest.fixture
+def held(bot, server):
+    held = Held(server)
+    yield held
+    held.release()
+
+####################################
+
+# THE HELPERS
+
+
+def message(update_id, chat_id, text):
+    return {'update_id': update_id, 'message': {'text': text, 'chat': {'id': chat_id}}}
+
+
+def sent_to(server, chat_id):
+    return [text for sent_chat_id, text in server.sent if sent_chat_id == str(chat_id)]
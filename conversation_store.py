@@ -0,0 +1,282 @@
+# "MYSHLENEK", the tiered conversation store
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The conversation histories used to stay in memory for the whole life of the process,
+# so the memory use grew with all the chats ever seen, not with the chats that are active now.
+
+# The 'CONVERSATION_STORE' keeps the conversations in two tiers:
+# 1. The hot tier: the active chats, in memory, in a compact form.
+#    A conversation is a list of 'TURN' records (with '__slots__', so there is no dictionary per turn),
+#    and the role tags ('user' and 'bot') are interned strings shared by all the turns.
+# 2. The cold tier: the chats that have been idle for more than 'idle_seconds'.
+#    Their turns are compressed with zlib and written to one file per chat in the store directory,
+#    and they are removed from memory. On the next message of the chat, the file is read back
+#    (rehydrated) and the conversation becomes hot again.
+
+# So the resident memory depends on the number of concurrently active chats.
+
+# 'checkout' returns the hot conversation of a chat (rehydrating it if needed) and marks it busy,
+# 'checkin' marks it idle again; a busy conversation is never spilled to disk.
+# 'spill_idle' moves the idle conversations to the cold tier; the spill timer of 'main.py' calls it regularly,
+# and the memory accounting may call it at the same time from its own thread (see 'memory.py').
+# The file of a conversation is written without holding the lock of the store, so meanwhile the conversation
+# is kept in '_spilling': a 'checkout' of the chat during the write takes that same object back
+# instead of reading a file that is not written yet, and the file only replaces the previous one
+# if the chat was not reset during the write.
+# 'memory_usage' and 'trim' are used by the memory accounting (see 'memory.py'): the history of a chat
+# is otherwise never shortened, so a very talkative chat could hold any amount of memory.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zlib
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+USER = sys.intern('user')
+BOT = sys.intern('bot')
+
+_UNSAFE_FILE_CHARS = re.compile(r'[^A-Za-z0-9_-]')
+
+####################################
+
+# THE "TURN" CLASS
+
+# One message of the conversation: who wrote it ('role') and what was written ('text').
+
+
+class Turn:
+    __slots__ = ('role', 'text')
+
+    def __init__(self, role, text):
+        self.role = sys.intern(role)
+        self.text = text
+
+####################################
+
+# THE "CONVERSATION" CLASS
+
+# The turns of one chat, the time of its last activity, and the number of workers using it.
+# 'render' returns the conversation history string in the format used by 'handle_message':
+# every turn is preceded by a newline character.
+
+
+class Conversation:
+    __slots__ = ('turns', 'last_active', 'busy', 'partial', 'length_bias')
+
+    def __init__(self, turns=None, partial=None, length_bias=0.0):
+        self.turns = turns or []
+        self.last_active = time.monotonic()
+        self.busy = 0
+        self.partial = partial  # the text to continue, if the last answer was cut (see 'output_length.py')
+        self.length_bias = length_bias
+
+    def add(self, role, text):
+        self.turns.append(Turn(role, text))
+
+    def render(self):
+        return ''.join('\n' + turn.text for turn in self.turns)
+
+    # Record the turns added by 'handle_message': 'added' is the part of the history string
+    # appended to it, that is '\n' + the User's text (if it is not empty) and '\n' + the answer (if any)
+    def add_exchange(self, text, added):
+        if text.strip() and added.startswith('\n' + text):
+            self.add(USER, text)
+            added = added[len(text) + 1:]
+        if added.startswith('\n'):
+            self.add(BOT, added[1:])
+
+    def size_in_bytes(self):
+        return sum(len(turn.text) for turn in self.turns) + len(self.partial or '')
+
+    # The memory held by the conversation: the objects themselves, not only the length of the texts
+    def memory_bytes(self):
+        size = sys.getsizeof(self) + sys.getsizeof(self.turns) + sys.getsizeof(self.partial or '')
+        for turn in self.turns:
+            size += sys.getsizeof(turn) + sys.getsizeof(turn.text)
+        return size
+
+    # Drop the oldest turns until the conversation holds at most 'max_bytes'; returns the number dropped
+    def trim(self, max_bytes):
+        dropped = 0
+        size = self.memory_bytes()
+        while self.turns and size > max_bytes:
+            turn = self.turns.pop(0)
+            size -= sys.getsizeof(turn) + sys.getsizeof(turn.text)
+            dropped += 1
+        return dropped
+
+    # The turns are written as a JSON list; with the output-length state, as an object holding the list
+    def compress(self):
+        turns = [[turn.role, turn.text] for turn in self.turns]
+        if self.partial or self.length_bias:
+            turns = {'turns': turns, 'partial': self.partial, 'length_bias': self.length_bias}
+        data = json.dumps(turns, ensure_ascii=False)
+        return zlib.compress(data.encode('utf-8'), 6)
+
+    @classmethod
+    def decompress(cls, data):
+        state = json.loads(zlib.decompress(data).decode('utf-8'))
+        if isinstance(state, list):
+            state = {'turns': state}
+        return cls([Turn(role, text) for role, text in state['turns']],
+                   state.get('partial'), state.get('length_bias', 0.0))
+
+####################################
+
+# THE "CONVERSATION_STORE" CLASS
+
+# 'path' is the directory of the cold tier, 'idle_seconds' is the idle time after which a chat is spilled.
+
+
+class ConversationStore:
+    def __init__(self, path, idle_seconds=1800):
+        self.path = path
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._hot = {}  # chat_id -> Conversation
+        self._spilling = {}  # chat_id -> Conversation being written to the cold tier
+        os.makedirs(path, exist_ok=True)
+
+    def _file_path(self, chat_id):
+        return os.path.join(self.path, _UNSAFE_FILE_CHARS.sub('_', str(chat_id)) + '.z')
+
+    def checkout(self, chat_id):
+        with self._lock:
+            conversation = self._hot.get(chat_id)
+            if conversation is None:
+                conversation = self._spilling.get(chat_id) or self._rehydrate(chat_id)
+                self._hot[chat_id] = conversation
+            conversation.busy += 1
+            conversation.last_active = time.monotonic()
+            metrics.set_gauge('conversation_store.hot_chats', len(self._hot))
+            return conversation
+
+    def checkin(self, chat_id, conversation):
+        with self._lock:
+            conversation.busy -= 1
+            conversation.last_active = time.monotonic()
+
+    def reset(self, chat_id):
+        with self._lock:
+            self._hot.pop(chat_id, None)
+            self._spilling.pop(chat_id, None)
+            try:
+                os.remove(self._file_path(chat_id))
+            except FileNotFoundError:
+                pass
+
+    def _rehydrate(self, chat_id):
+        # Called with the lock held; a chat that was never spilled starts empty
+        try:
+            with open(self._file_path(chat_id), 'rb') as cold_file:
+                conversation = Conversation.decompress(cold_file.read())
+        except FileNotFoundError:
+            return Conversation()
+        except (OSError, ValueError, zlib.error) as e:
+            logger.exception("Failed to rehydrate the conversation of chat {}: {}".format(chat_id, e))
+            return Conversation()
+        metrics.increment('conversation_store.rehydrated')
+        return conversation
+
+    # Move the conversations idle for more than 'idle_seconds' to the cold tier; returns their number.
+    # A conversation already being written by another call is left to that call.
+    def spill_idle(self, idle_seconds=None):
+        idle_seconds = self.idle_seconds if idle_seconds is None else idle_seconds
+        deadline = time.monotonic() - idle_seconds
+        with self._lock:
+            idle = [(chat_id, conversation) for chat_id, conversation in self._hot.items()
+                    if not conversation.busy and conversation.last_active <= deadline and chat_id not in self._spilling]
+            for chat_id, conversation in idle:
+                del self._hot[chat_id]
+                self._spilling[chat_id] = conversation
+
+        spilled = 0
+        for chat_id, conversation in idle:
+            try:
+                if self._write(chat_id, conversation):
+                    spilled += 1
+            except OSError as e:
+                # Keep the conversation in memory if it cannot be written
+                logger.exception("Failed to spill the conversation of chat {}: {}".format(chat_id, e))
+                with self._lock:
+                    if self._spilling.get(chat_id) is conversation:
+                        del self._spilling[chat_id]
+                        self._hot.setdefault(chat_id, conversation)
+
+        if spilled:
+            metrics.increment('conversation_store.spilled', spilled)
+        with self._lock:
+            metrics.set_gauge('conversation_store.hot_chats', len(self._hot))
+        return spilled
+
+    # Writes the conversation to a temporary file, then, with the lock held, puts it in place
+    # and ends the spilling; returns False if the chat was reset meanwhile (the file is dropped)
+    def _write(self, chat_id, conversation):
+        file_path = self._file_path(chat_id)
+        temporary_path = '{}.{}.tmp'.format(file_path, threading.get_ident())
+        try:
+            with open(temporary_path, 'wb') as cold_file:
+                cold_file.write(conversation.compress())
+            with self._lock:
+                if self._spilling.get(chat_id) is not conversation:
+                    return False
+                os.replace(temporary_path, file_path)
+                del self._spilling[chat_id]
+                return True
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    # Spill every conversation that is not in use, for example before the process exits
+    def flush(self):
+        return self.spill_idle(idle_seconds=-1)
+
+    def hot_chats(self):
+        with self._lock:
+            return len(self._hot)
+
+    def hot_bytes(self):
+        with self._lock:
+            return sum(conversation.size_in_bytes() for conversation in self._hot.values())
+
+    # The memory of the hot tier, in total and for the 'top' largest chats (see 'memory.py')
+    def memory_usage(self, top=10):
+        with self._lock:
+            sizes = [(conversation.memory_bytes(), chat_id) for chat_id, conversation in self._hot.items()]
+            size = sys.getsizeof(self._hot)
+        sizes.sort(reverse=True)
+        return {
+            'bytes': size + sum(chat_bytes for chat_bytes, _ in sizes),
+            'chats': len(sizes),
+            'largest_chats': {str(chat_id): chat_bytes for chat_bytes, chat_id in sizes[:top]},
+        }
+
+    # Trim the histories of the chats holding more than 'max_bytes' (the oldest turns go first);
+    # a conversation in use is left alone. Returns the number of turns dropped.
+    def trim(self, max_bytes):
+        dropped = 0
+        with self._lock:
+            for chat_id, conversation in self._hot.items():
+                if not conversation.busy:
+                    chat_dropped = conversation.trim(max_bytes)
+                    if chat_dropped:
+                        logger.error("Trimmed %d old turns of chat %s to %d bytes", chat_dropped, chat_id, max_bytes)
+                    dropped += chat_dropped
+        if dropped:
+            metrics.increment('conversation_store.trimmed_turns', dropped)
+        return dropped
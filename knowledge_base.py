@@ -0,0 +1,356 @@
+# "MYSHLENEK", the local knowledge base
+# Used by 'main.py'; can also be run as a script to rebuild the index: python knowledge_base.py
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The bot teaches inventive (TRIZ) thinking, but the model had to produce all the domain material
+# from scratch, in long and slow completions. This module finds the passages of our own materials
+# that are relevant to the User's message, so they can be put into the prompt.
+
+# The materials are the '.txt' and '.md' files in the KNOWLEDGE_DIR directory (see 'settings.py').
+# Each file is split into passages of about PASSAGE_CHARS characters (by paragraphs).
+
+####################################
+
+# THE INDEX
+
+# The passages are indexed in an inverted index ranked with BM25, stored in the KNOWLEDGE_INDEX_DIR directory:
+# - 'terms.json'      : term -> [offset, count] of its postings;
+# - 'doc_ids.npy'     : the passage numbers of all the postings, term after term (uint32);
+# - 'tfs.npy'         : the term frequencies of the same postings (uint16);
+# - 'doc_lengths.npy' : the number of terms in each passage (uint32);
+# - 'passages.txt' and 'passage_offsets.npy' : the texts of the passages and their byte offsets;
+# - 'manifest.json'   : the indexed files (size and modification time), and the index statistics.
+
+# The '.npy' files and 'passages.txt' are memory-mapped, so opening the index costs almost nothing,
+# and a search only touches the postings of the query terms: a few milliseconds.
+
+# The index is rebuilt incrementally: the tokenized passages of every file are kept in the 'files'
+# subdirectory, and only the files that were added or changed since the last build are tokenized again.
+# The postings are then merged from these per-file parts, which is fast.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE SETTINGS OF THE INDEX
+
+PASSAGE_CHARS = 800  # The approximate size of a passage, in characters
+STEM_LENGTH = 6  # Terms are cut to this length, a cheap stemming that works for English and Russian
+BM25_K1 = 1.2
+BM25_B = 0.75
+CHARS_PER_TOKEN = 4  # A rough estimate used for the token budget
+INDEX_VERSION = 1
+
+_WORD = re.compile(r'\w+')
+
+####################################
+
+# THE "TOKENIZE" FUNCTION
+
+# Splits a text into lowercase terms of at least 2 characters, cut to STEM_LENGTH characters.
+
+
+def tokenize(text):
+    return [word[:STEM_LENGTH] for word in _WORD.findall(text.lower()) if len(word) > 1]
+
+####################################
+
+# THE "SPLIT_PASSAGES" FUNCTION
+
+# Splits a text into passages: paragraphs (separated by blank lines) are joined
+# until a passage reaches PASSAGE_CHARS characters. A longer paragraph is a passage on its own.
+
+
+def split_passages(text):
+    passages = []
+    current = []
+    current_length = 0
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if current and current_length + len(paragraph) > PASSAGE_CHARS:
+            passages.append('\n\n'.join(current))
+            current = []
+            current_length = 0
+        current.append(paragraph)
+        current_length += len(paragraph)
+    if current:
+        passages.append('\n\n'.join(current))
+    return passages
+
+####################################
+
+# THE "BUILD_INDEX" FUNCTION
+
+# Builds (or updates) the index of the corpus directory in the index directory.
+# Returns True if the index was rebuilt, and False if nothing changed since the last build.
+
+
+def build_index(corpus_dir, index_dir):
+    started = time.perf_counter()
+    files_dir = os.path.join(index_dir, 'files')
+    os.makedirs(files_dir, exist_ok=True)
+
+    manifest = _read_json(os.path.join(index_dir, 'manifest.json')) or {}
+    previous_files = manifest.get('files', {}) if manifest.get('version') == INDEX_VERSION else {}
+
+    # Find the files of the corpus with their sizes and modification times
+    current_files = {}
+    for root, _, names in os.walk(corpus_dir):
+        for name in sorted(names):
+            if name.endswith(('.txt', '.md')):
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                current_files[os.path.relpath(path, corpus_dir)] = [stat.st_size, stat.st_mtime_ns]
+
+    if current_files == previous_files and os.path.exists(os.path.join(index_dir, 'terms.json')):
+        return False
+
+    # Tokenize the added and changed files, and keep the parts of the unchanged ones
+    changed = 0
+    for relative_path, signature in current_files.items():
+        part_path = _part_path(files_dir, relative_path)
+        if previous_files.get(relative_path) == signature and os.path.exists(part_path):
+            continue
+        with open(os.path.join(corpus_dir, relative_path), encoding='utf-8', errors='replace') as corpus_file:
+            passages = split_passages(corpus_file.read())
+        part = {'passages': passages, 'terms': [Counter(tokenize(passage)) for passage in passages]}
+        _write_json(part_path, part)
+        changed += 1
+
+    # Remove the parts of the deleted files
+    keep = {os.path.basename(_part_path(files_dir, relative_path)) for relative_path in current_files}
+    for name in os.listdir(files_dir):
+        if name not in keep:
+            os.remove(os.path.join(files_dir, name))
+
+    # Merge the parts into the postings
+    postings = {}  # term -> list of (passage number, frequency)
+    passages = []
+    doc_lengths = []
+    for relative_path in sorted(current_files):
+        part = _read_json(_part_path(files_dir, relative_path))
+        for passage, terms in zip(part['passages'], part['terms']):
+            doc_id = len(passages)
+            passages.append(passage)
+            doc_lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                postings.setdefault(term, []).append((doc_id, frequency))
+
+    terms = {}
+    doc_ids = []
+    tfs = []
+    for term in sorted(postings):
+        entries = postings[term]
+        terms[term] = [len(doc_ids), len(entries)]
+        doc_ids.extend(doc_id for doc_id, _ in entries)
+        tfs.extend(min(frequency, 65535) for _, frequency in entries)
+
+    encoded = [passage.encode('utf-8') for passage in passages]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+    if encoded:
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+
+    # Write everything to temporary files first and replace the old ones, so a reader never sees half an index
+    _replace_npy(index_dir, 'doc_ids.npy', np.array(doc_ids, dtype=np.uint32))
+    _replace_npy(index_dir, 'tfs.npy', np.array(tfs, dtype=np.uint16))
+    _replace_npy(index_dir, 'doc_lengths.npy', np.array(doc_lengths, dtype=np.uint32))
+    _replace_npy(index_dir, 'passage_offsets.npy', offsets)
+    _replace_file(index_dir, 'passages.txt', b''.join(encoded))
+    _replace_file(index_dir, 'terms.json', json.dumps(terms, ensure_ascii=False).encode('utf-8'))
+    manifest = {
+        'version': INDEX_VERSION,
+        'files': current_files,
+        'passages': len(passages),
+        'average_length': (sum(doc_lengths) / len(doc_lengths)) if doc_lengths else 0.0,
+    }
+    _replace_file(index_dir, 'manifest.json', json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+
+    logger.info("Knowledge index built: %d files (%d changed), %d passages, %d terms in %.2fs",
+                len(current_files), changed, len(passages), len(terms), time.perf_counter() - started)
+    return True
+
+
+def _part_path(files_dir, relative_path):
+    return os.path.join(files_dir, hashlib.sha1(relative_path.encode('utf-8')).hexdigest() + '.json')
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    _replace_file(os.path.dirname(path), os.path.basename(path), json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+
+def _replace_file(directory, name, data):
+    temporary_path = os.path.join(directory, name + '.tmp')
+    with open(temporary_path, 'wb') as output_file:
+        output_file.write(data)
+    os.replace(temporary_path, os.path.join(directory, name))
+
+
+def _replace_npy(directory, name, array):
+    temporary_path = os.path.join(directory, name + '.tmp')
+    with open(temporary_path, 'wb') as output_file:
+        np.save(output_file, array)
+    os.replace(temporary_path, os.path.join(directory, name))
+
+####################################
+
+# THE "KNOWLEDGE_BASE" CLASS
+
+# Opens the index (building or updating it first) and searches it.
+# If the corpus directory does not exist, the knowledge base is empty and 'retrieve' returns an empty string.
+
+
+class KnowledgeBase:
+    def __init__(self, corpus_dir, index_dir, top_k=3, token_budget=600):
+        self.corpus_dir = corpus_dir
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self._lock = threading.Lock()
+        self._index = None
+        self.refresh()
+
+    # Rebuild the index if the corpus changed, and (re)open it
+    def refresh(self):
+        if not os.path.isdir(self.corpus_dir):
+            return
+        try:
+            rebuilt = build_index(self.corpus_dir, self.index_dir)
+        except OSError as e:
+            logger.exception("Failed to build the knowledge index: {}".format(e))
+            return
+        if rebuilt or self._index is None:
+            index = self._open()
+            with self._lock:
+                self._index = index
+
+    def _open(self):
+        def load(name):
+            return np.load(os.path.join(self.index_dir, name), mmap_mode='r')
+
+        manifest = _read_json(os.path.join(self.index_dir, 'manifest.json'))
+        terms = _read_json(os.path.join(self.index_dir, 'terms.json'))
+        if not manifest or terms is None or not manifest['passages']:
+            return None
+        with open(os.path.join(self.index_dir, 'passages.txt'), 'rb') as passages_file:
+            passages = mmap.mmap(passages_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return {
+            'terms': terms,
+            'doc_ids': load('doc_ids.npy'),
+            'tfs': load('tfs.npy'),
+            'doc_lengths': load('doc_lengths.npy').astype(np.float32),
+            'offsets': load('passage_offsets.npy'),
+            'passages': passages,
+            'count': manifest['passages'],
+            'average_length': manifest['average_length'] or 1.0,
+            'heap_bytes': None,  # computed by 'memory_usage' on first use
+        }
+
+    # The memory of the index (see 'memory.py'): the dictionary of the terms and the passage lengths
+    # are on the heap, the other arrays and the passages are files mapped into memory
+    def memory_usage(self):
+        with self._lock:
+            index = self._index
+        if index is None:
+            return {'bytes': 0, 'mapped_bytes': 0, 'passages': 0}
+        if index['heap_bytes'] is None:
+            terms = index['terms']
+            index['heap_bytes'] = sys.getsizeof(terms) + index['doc_lengths'].nbytes + sum(
+                sys.getsizeof(term) + sys.getsizeof(entry) + sum(sys.getsizeof(number) for number in entry)
+                for term, entry in terms.items())
+        mapped = sum(index[name].nbytes for name in ('doc_ids', 'tfs', 'offsets')) + len(index['passages'])
+        return {'bytes': index['heap_bytes'], 'mapped_bytes': mapped, 'passages': index['count']}
+
+    # Returns the top-k passages as a list of (score, text), best first
+    def search(self, query, top_k=None):
+        with self._lock:
+            index = self._index
+        if index is None:
+            return []
+        started = time.perf_counter()
+        top_k = top_k or self.top_k
+
+        scores = np.zeros(index['count'], dtype=np.float32)
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * index['doc_lengths'] / index['average_length'])
+        for term in set(tokenize(query)):
+            entry = index['terms'].get(term)
+            if entry is None:
+                continue
+            offset, count = entry
+            doc_ids = index['doc_ids'][offset:offset + count]
+            tfs = index['tfs'][offset:offset + count].astype(np.float32)
+            idf = math.log(1 + (index['count'] - count + 0.5) / (count + 0.5))
+            # The passage numbers of one term are unique, so a plain fancy-indexed addition is enough
+            scores[doc_ids] += idf * tfs * (BM25_K1 + 1) / (tfs + length_norm[doc_ids])
+
+        found = np.flatnonzero(scores)
+        if len(found) > top_k:
+            found = found[np.argpartition(scores[found], -top_k)[-top_k:]]
+        found = found[np.argsort(-scores[found])]
+
+        results = []
+        for doc_id in found:
+            start, end = int(index['offsets'][doc_id]), int(index['offsets'][doc_id + 1])
+            results.append((float(scores[doc_id]), index['passages'][start:end].decode('utf-8')))
+        metrics.observe('knowledge_base.search_seconds', time.perf_counter() - started)
+        return results
+
+    # Returns the best passages for the query joined into one text, within the token budget
+    def retrieve(self, query, token_budget=None):
+        budget_chars = (token_budget or self.token_budget) * CHARS_PER_TOKEN
+        selected = []
+        used = 0
+        for _, passage in self.search(query):
+            if used + len(passage) > budget_chars:
+                if selected:
+                    break
+                passage = passage[:budget_chars]
+            selected.append(passage)
+            used += len(passage)
+        return '\n\n'.join(selected)
+
+####################################
+
+# REBUILDING THE INDEX FROM THE COMMAND LINE
+
+
+if __name__ == '__main__':
+    from settings import get_config
+
+    logging.basicConfig(level=logging.INFO)
+    if build_index(get_config().knowledge_dir, get_config().knowledge_index_dir):
+        print("The knowledge index was rebuilt")
+    else:
+        print("The knowledge index is up to date")
@@ -0,0 +1,246 @@
+# "MYSHLENEK", the graceful shutdown and the restarts
+# Used by 'main.py' and 'cli.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# When the process was killed, the polling loop stopped in the middle of an update: the OpenAI call
+# was wasted, the answer was never sent, and since the offset of the updates was not saved,
+# the same updates were fetched (and paid for) again by the next process.
+
+# Now SIGTERM (and Ctrl+C) only asks the bot to stop ('request_stop'). The polling loop then:
+# 1. stops taking new updates;
+# 2. lets the generations in flight finish, for up to 'drain_seconds' (see 'settings.py'),
+#    and cancels the ones still running after that;
+# 3. saves the offset of the updates ('OFFSET_CHECKPOINT') and writes the conversations to disk.
+# The answers are sent by the workers themselves, so when the workers are done, nothing is left to send.
+
+####################################
+
+# THE OFFSET OF THE UPDATES
+
+# The offset passed to 'get_updates' tells Telegram which updates were handled: the older ones are
+# forgotten by Telegram. 'PENDING_UPDATES' keeps the updates still queued or being handled,
+# and the safe offset is just before the oldest of them (or the newest update, if none is pending).
+# The updates of different chats finish in any order, so the updates that finished after the oldest
+# pending one are kept too ('finished'), until the safe offset passes them.
+# The polling loop asks Telegram with the safe offset and saves it with the finished updates after every poll,
+# so after a crash or an unfinished drain the next process gets the updates after the safe offset again,
+# skips the finished ones ('UpdateOffsets.finished') and handles only the unfinished ones.
+# 'UPDATE_OFFSETS' keeps all of it for one bot; every bot has its own offset file (see 'offset_path').
+
+####################################
+
+# THE SOCKET HANDOFF (THE WEBHOOK MODE)
+
+# In the webhook mode ('python cli.py webhook'), SIGUSR2 starts a new process with the same command line
+# and passes it the listening socket (its number is in the MYSHLENEK_LISTEN_FD environment variable).
+# The old process then stops accepting, finishes the request it is handling and exits,
+# while the new one accepts the connections from the same socket, so no connection is refused.
+# (With gunicorn, use its own USR2 / TERM signals instead: they do the same.)
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+LISTEN_FD_VARIABLE = 'MYSHLENEK_LISTEN_FD'
+
+####################################
+
+# THE STOP REQUEST
+
+_stopping = threading.Event()
+
+
+def request_stop(reason="stop requested"):
+    if not _stopping.is_set():
+        logger.error("Stopping: %s", reason)
+    _stopping.set()
+
+
+def stop_requested():
+    return _stopping.is_set()
+
+
+# Sleeps for up to 'timeout' seconds, waking up at once when the stop is requested; returns True then
+def wait_for_stop(timeout):
+    return _stopping.wait(timeout)
+
+
+def install_stop_handlers(on_stop=None):
+    def handler(signum, frame):
+        request_stop(signal.Signals(signum).name)
+        if on_stop is not None:
+            # Not in the signal handler itself: the stopping may need the thread it interrupted
+            threading.Thread(target=on_stop, name='stop', daemon=True).start()
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, handler)
+
+####################################
+
+# THE "OFFSET_CHECKPOINT" CLASS
+
+# Keeps the offset and the IDs of the updates finished after it in a small JSON file, replaced atomically,
+# so it is never half-written. 'load' returns both (0 and no IDs on the first start).
+
+
+class OffsetCheckpoint:
+    def __init__(self, path):
+        self.path = path
+        self._saved = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as offset_file:
+                data = json.load(offset_file)
+            last_update_id = int(data['last_update_id'])
+            finished = [int(update_id) for update_id in data.get('finished', ()) if int(update_id) > last_update_id]
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            last_update_id, finished = 0, []
+        self._saved = (last_update_id, finished)
+        return last_update_id, finished
+
+    def save(self, last_update_id, finished=()):
+        finished = sorted(finished)
+        if (last_update_id, finished) == self._saved:
+            return
+        temporary_path = self.path + '.tmp'
+        try:
+            with open(temporary_path, 'w', encoding='utf-8') as offset_file:
+                json.dump({'last_update_id': last_update_id, 'finished': finished}, offset_file)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logger.exception("Failed to save the offset of the updates: {}".format(e))
+            return
+        self._saved = (last_update_id, finished)
+
+####################################
+
+# THE "PENDING_UPDATES" CLASS
+
+# 'finished' are the IDs of the updates that finished (or had no work at all), kept while they are after
+# the safe offset; it starts with the finished updates saved by the previous process.
+
+
+class PendingUpdates:
+    def __init__(self, finished=()):
+        self._lock = threading.Lock()
+        self._futures = {}  # update_id -> Future of the work of the update
+        self._finished = set(finished)
+
+    def add(self, update_id, future):
+        if future is None:
+            self._discard(update_id)
+            return
+        with self._lock:
+            self._futures[update_id] = future
+        future.add_done_callback(lambda _: self._discard(update_id))
+
+    def _discard(self, update_id):
+        with self._lock:
+            self._futures.pop(update_id, None)
+            self._finished.add(update_id)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._futures)
+
+    def finished(self, update_id):
+        with self._lock:
+            return update_id in self._finished
+
+    # The offset to confirm to Telegram: everything before the oldest pending update
+    def safe_offset(self, last_update_id):
+        return self.snapshot(last_update_id)[0]
+
+    # The safe offset and the IDs of the updates finished after it; forgets the finished IDs before it
+    def snapshot(self, last_update_id):
+        with self._lock:
+            offset = min(self._futures) - 1 if self._futures else last_update_id
+            self._finished = {update_id for update_id in self._finished if update_id > offset}
+            return offset, sorted(self._finished)
+
+####################################
+
+# THE "UPDATE_OFFSETS" CLASS
+
+# The offset file, the pending updates and the ID of the last update dispatched, for one bot.
+# 'finished' tells if an update fetched again was already handled (by this process or the previous one).
+
+
+class UpdateOffsets:
+    def __init__(self, path):
+        self.checkpoint = OffsetCheckpoint(path)
+        self.last_update_id, finished = self.checkpoint.load()
+        self.pending = PendingUpdates(finished)
+
+    def safe_offset(self):
+        return self.pending.safe_offset(self.last_update_id)
+
+    def finished(self, update_id):
+        return self.pending.finished(update_id)
+
+    def snapshot(self):
+        return self.pending.snapshot(self.last_update_id)
+
+    # Saves the current snapshot, or the one taken before (see 'drain' in 'main.py')
+    def save(self, snapshot=None):
+        self.checkpoint.save(*(snapshot or self.snapshot()))
+
+
+# The offset file of a bot: the 'offset_file' setting for the default bot,
+# and the same name with the name of the bot before the extension for the others
+def offset_path(path, bot_name=None):
+    if not bot_name:
+        return path
+    root, extension = os.path.splitext(path)
+    return '{}.{}{}'.format(root, bot_name, extension)
+
+####################################
+
+# THE SOCKET HANDOFF
+
+# 'inherited_socket' returns the listening socket passed by the previous process, or None.
+# 'hand_off_socket' starts the next process with the socket; the caller then stops serving.
+
+
+def inherited_socket():
+    fd = os.environ.pop(LISTEN_FD_VARIABLE, None)
+    if not fd:
+        return None
+    listening_socket = socket.socket(fileno=int(fd))
+    logger.error("Took over the listening socket %s", listening_socket.getsockname())
+    return listening_socket
+
+
+def hand_off_socket(listening_socket):
+    fd = listening_socket.fileno()
+    os.set_inheritable(fd, True)
+    environ = dict(os.environ)
+    environ[LISTEN_FD_VARIABLE] = str(fd)
+    process = subprocess.Popen([sys.executable] + sys.argv, env=environ, pass_fds=(fd,))
+    logger.error("Handed the listening socket over to process %d", process.pid)
+    return process
+
+
+# SIGUSR2 hands the socket of the server over to a new process and stops the server gracefully
+def install_handoff_handler(server):
+    def handler(signum, frame):
+        hand_off_socket(server.socket)
+        request_stop("the socket was handed over")
+        threading.Thread(target=server.shutdown, name='stop', daemon=True).start()
+
+    signal.signal(signal.SIGUSR2, handler)
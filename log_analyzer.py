@@ -0,0 +1,336 @@
+# "MYSHLENEK", the log analyzer
+# Usage: python cli.py logs [error.log] [--bucket 1h] [--since 2023-03-06] [--until 2023-03-07] [--json]
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Answers questions like "what was yesterday's p95 OpenAI latency, or the error rate" from 'error.log',
+# without ad-hoc grepping. For every time bucket (an hour by default) it prints:
+# - the number of messages received;
+# - the number of OpenAI requests, and the count of every status code
+#   (401, 429, 5xx... from "OpenAI API request failed with status code N"; 200 for a generated response;
+#   'failed' for a request that got no status: a connection error, a timeout, the deadline,
+#   from "OpenAI API request failed: ...", or an answer without any text);
+# - the error rate and the percentiles (p50, p95, p99) of the OpenAI latency,
+#   from "Sending request to OpenAI" to the end of the request of the same trace.
+
+# A request ends with the first of these lines after it: the failure, "Generated response",
+# or "After generate_response(): response = ..." (the only end of a successful request in the old logs,
+# where "Generated response" was never written; it is a failure if the response is the failure message).
+# The other lines of the same request (the "After generate_response()" line after a failure) are not counted
+# again, and an "After generate_response()" line without a request (an answer from the semantic cache)
+# is not a request at all.
+
+# It reads both formats of the log (see 'configure_logging' in 'main.py'):
+# 1. the text format: a line starting with the time, the level and the optional trace
+#    ('[<trace ID> chat <chat ID>] '), then the message, often followed by more lines
+#    (the conversation histories, the 'NoneType: None' tails), which are skipped;
+# 2. the structured format: one JSON object per line, with the time in milliseconds.
+# The text format has whole seconds only, so its latencies are rounded to seconds.
+# Without a trace ID (the old logs), a request ends with the next of these lines in the file.
+
+####################################
+
+# HOW IT IS FAST
+
+# The file is memory-mapped, not read into memory, and split into chunks at line boundaries.
+# Every chunk is scanned by one regular expression in a separate process, so the large logs use
+# all the processor cores. The expression only matches the few kinds of lines that matter,
+# so the interpreter does no work at all for the other lines, and the times are parsed once per second
+# of the log (they are cached). The results of the chunks are then merged in the order of the file,
+# with the requests still pending at the end of a chunk, so a request that starts in one chunk
+# and ends in the next one is counted the same way as inside one chunk, with its latency.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import argparse
+import calendar
+import itertools
+import mmap
+import os
+import re
+import sys
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from metrics import percentile
+
+# The events; every group name gets the prefix of the format ('text_' or 'json_')
+EVENT = (rb'(?P<{0}event>Received message|Sending request to OpenAI|Generated response'
+         rb'|After generate_response\(\): response = (?P<{0}sorry>Seems, something happened)?'
+         rb'|OpenAI API request failed(?: with status code (?P<{0}status>\d+))?|Something went wrong while generating)')
+
+# The text format and the structured format, in one expression, so the file is scanned once.
+# It starts with the newline before the line rather than with '^': the regular expressions
+# find a literal first character much faster, so the lines that do not matter are skipped at once.
+# FIRST_LINE matches the first line of the file, which has no newline before it.
+_EVENT_LINE = (
+    rb'(?:(?P<text_time>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) \w+ (?:\[(?P<text_trace>\w+) chat [^\]\n]*\] )?'
+    + EVENT.replace(b'{0}', b'text_')
+    + rb'|\{"time":"(?P<json_time>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)\.(?P<json_ms>\d{3})","level":"\w+",'
+    + rb'(?:"trace":"(?P<json_trace>\w+)","chat":"[^"\n]*",)?"message":"' + EVENT.replace(b'{0}', b'json_') + rb')')
+LINE = re.compile(b'\n' + _EVENT_LINE)
+FIRST_LINE = re.compile(_EVENT_LINE)
+
+# The positions of the groups in 'match.groups()', for each format (faster than looking them up by name)
+TEXT, JSON = [[LINE.groupindex[prefix + name] - 1 for name in ('time', 'trace', 'event', 'sorry', 'status')]
+              for prefix in ('text_', 'json_')]
+JSON_MS = LINE.groupindex['json_ms'] - 1
+
+FAILED = 'failed'  # the status of a request that got no status code
+
+CHUNK_BYTES = 64 * 1024 * 1024
+BUCKETS = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '6h': 21600, '1d': 86400}
+
+####################################
+
+# THE "BUCKET_STATS" CLASS
+
+# The counts and the latencies of one time bucket.
+
+
+class BucketStats:
+    __slots__ = ('received', 'requests', 'statuses', 'latencies')
+
+    def __init__(self):
+        self.received = 0
+        self.requests = 0
+        self.statuses = Counter()
+        self.latencies = array('d')
+
+    def merge(self, other):
+        self.received += other.received
+        self.requests += other.requests
+        self.statuses.update(other.statuses)
+        self.latencies.extend(other.latencies)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        finished = sum(self.statuses.values())
+        errors = finished - self.statuses.get(200, 0)
+        return {
+            'received': self.received,
+            'requests': self.requests,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=lambda item: str(item[0]))},
+            'error_rate': errors / finished if finished else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+        }
+
+####################################
+
+# THE "ANALYZE_RANGE" FUNCTION
+
+# Scans the bytes from 'start' to 'end' of the file (in a separate process) and returns
+# a dictionary: bucket start time -> 'BucketStats', the number of matched lines,
+# the ends of the requests that may have started before 'start' (the first event of their trace in the range),
+# and the state of every trace at 'end' (the start time of its pending request, or None).
+# 'analyze' counts those first ends with the state of the previous ranges: an "After generate_response()"
+# line ends a request only if one was pending, and a request that started in the previous range gets its latency.
+# 'since' and 'until' (seconds since the epoch, or None) limit the time of the events.
+
+
+def analyze_range(path, start, end, bucket_seconds, since=None, until=None):
+    buckets = {}
+    epochs = {}  # the time text -> seconds since the epoch, since most lines share the second
+    # trace ID ('' without a trace) -> time of "Sending request to OpenAI", or None once the request ended
+    started = {}
+    leading = []  # (trace ID, an "After" line, status, seconds, time) of the first ends of the traces
+    matched = 0
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        matches = LINE.finditer(data, start - 1, end) if start else itertools.chain(
+            filter(None, [FIRST_LINE.match(data, 0, end)]), LINE.finditer(data, 0, end))
+        for match in matches:
+            groups = match.groups()
+            if groups[TEXT[0]] is not None:
+                stamp, fraction = groups[TEXT[0]], 0.0
+                trace_id, event, sorry, status = [groups[index] for index in TEXT[1:]]
+            else:
+                stamp, fraction = groups[JSON[0]], int(groups[JSON_MS]) / 1000.0
+                trace_id, event, sorry, status = [groups[index] for index in JSON[1:]]
+            trace_id = trace_id or b''
+            seconds = epochs.get(stamp)
+            if seconds is None:
+                if len(epochs) > 100000:
+                    epochs.clear()
+                seconds = epochs[stamp] = calendar.timegm(time.strptime(stamp.decode('ascii').replace('T', ' '), '%Y-%m-%d %H:%M:%S'))
+            moment = seconds + fraction
+            if (since is not None and moment < since) or (until is not None and moment >= until):
+                continue
+
+            if event == b'Received message':
+                _bucket(buckets, seconds, bucket_seconds).received += 1
+                started.setdefault(trace_id, None)
+            elif event == b'Sending request to OpenAI':
+                _bucket(buckets, seconds, bucket_seconds).requests += 1
+                started[trace_id] = moment
+            elif trace_id not in started:
+                # The first event of the trace in the range: the request may have started before it
+                leading.append((trace_id, event.startswith(b'After'), _status(event, sorry, status), seconds, moment))
+                started[trace_id] = None
+            else:
+                request_started = started[trace_id]
+                if request_started is None:
+                    continue  # the end of a request already counted, or of no request at all
+                started[trace_id] = None
+                bucket = _bucket(buckets, seconds, bucket_seconds)
+                bucket.statuses[_status(event, sorry, status)] += 1
+                bucket.latencies.append(moment - request_started)
+            matched += 1
+    return buckets, matched, leading, started
+
+
+def _status(event, sorry, status):
+    if status is not None:
+        return int(status)
+    if event == b'Generated response' or (event.startswith(b'After') and sorry is None):
+        return 200
+    return FAILED
+
+
+def _bucket(buckets, seconds, bucket_seconds):
+    bucket_start = seconds - seconds % bucket_seconds
+    bucket = buckets.get(bucket_start)
+    if bucket is None:
+        bucket = buckets[bucket_start] = BucketStats()
+    return bucket
+
+####################################
+
+# THE "ANALYZE" FUNCTION
+
+# Splits the file into chunks at line boundaries, analyzes them in parallel ('workers' processes,
+# all the cores by default; a small file is analyzed in this process) and merges the results.
+
+
+def split_chunks(path, chunk_bytes=CHUNK_BYTES):
+    size = os.path.getsize(path)
+    if size == 0:
+        return []
+    chunks = []
+    with open(path, 'rb') as log_file, mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        start = 0
+        while start < size:
+            end = data.find(b'\n', min(start + chunk_bytes, size) - 1)
+            end = size if end < 0 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def analyze(path, bucket_seconds=3600, since=None, until=None, workers=None, chunk_bytes=CHUNK_BYTES):
+    chunks = split_chunks(path, chunk_bytes)
+    if len(chunks) <= 1:
+        results = [analyze_range(path, start, end, bucket_seconds, since, until) for start, end in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(analyze_range, path, start, end, bucket_seconds, since, until)
+                       for start, end in chunks]
+            results = [future.result() for future in futures]
+
+    merged = {}
+    matched = 0
+    pending = {}  # trace ID -> time of the request still pending at the end of the previous chunks
+    for buckets, chunk_matched, leading, states in results:
+        matched += chunk_matched
+        for bucket_start, stats in buckets.items():
+            if bucket_start in merged:
+                merged[bucket_start].merge(stats)
+            else:
+                merged[bucket_start] = stats
+        for trace_id, after, status, seconds, moment in leading:
+            request_started = pending.get(trace_id)
+            if after and request_started is None:
+                matched -= 1  # the end of no request (an answer from the semantic cache)
+                continue
+            bucket = _bucket(merged, seconds, bucket_seconds)
+            bucket.statuses[status] += 1
+            if request_started is not None:
+                bucket.latencies.append(moment - request_started)
+        pending.update(states)
+        pending = {trace_id: moment for trace_id, moment in pending.items() if moment is not None}
+    return dict(sorted(merged.items())), matched
+
+####################################
+
+# THE REPORT
+
+
+def format_time(seconds):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(seconds))
+
+
+def parse_time(text):
+    for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return calendar.timegm(time.strptime(text, time_format))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("invalid time: {} (expected YYYY-MM-DD[ HH:MM[:SS]])".format(text))
+
+
+def parse_bucket(text):
+    if text in BUCKETS:
+        return BUCKETS[text]
+    try:
+        return int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid bucket: {} (one of {}, or seconds)".format(text, ', '.join(BUCKETS)))
+
+
+def print_report(buckets, out=sys.stdout):
+    total = BucketStats()
+    out.write("{:<17} {:>8} {:>8} {:>7} {:>8} {:>8} {:>8}  {}\n".format(
+        'bucket', 'received', 'openai', 'errors', 'p50', 'p95', 'p99', 'statuses'))
+    rows = [(format_time(bucket_start), stats) for bucket_start, stats in buckets.items()]
+    for bucket_start, stats in buckets.items():
+        total.merge(stats)
+    rows.append(('total', total))
+    for label, stats in rows:
+        summary = stats.summary()
+        out.write("{:<17} {:>8} {:>8} {:>6.1f}% {:>7.2f}s {:>7.2f}s {:>7.2f}s  {}\n".format(
+            label, summary['received'], summary['requests'], summary['error_rate'] * 100,
+            summary['p50'], summary['p95'], summary['p99'],
+            ' '.join('{}:{}'.format(status, count) for status, count in summary['statuses'].items())))
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description="Aggregate the OpenAI latency, status codes and throughput from the log")
+    parser.add_argument('path', nargs='?', default=None, help="the log file (the 'log_file' setting by default)")
+    parser.add_argument('--bucket', type=parse_bucket, default=3600, help="the time bucket: " + ', '.join(BUCKETS) + " or seconds")
+    parser.add_argument('--since', type=parse_time, default=None, help="only the events from this time (YYYY-MM-DD[ HH:MM])")
+    parser.add_argument('--until', type=parse_time, default=None, help="only the events before this time")
+    parser.add_argument('--workers', type=int, default=None, help="the number of processes (all the cores by default)")
+    parser.add_argument('--json', action='store_true', help="print the buckets as JSON")
+    return parser
+
+
+def main(args):
+    import codec
+
+    path = args.path
+    if path is None:
+        from settings import get_config
+        path = get_config().log_file
+    started = time.perf_counter()
+    buckets, matched = analyze(path, args.bucket, args.since, args.until, args.workers)
+    elapsed = time.perf_counter() - started
+    if args.json:
+        report = {format_time(bucket_start): stats.summary() for bucket_start, stats in buckets.items()}
+        sys.stdout.write(codec.dumps(report).decode('utf-8') + '\n')
+    else:
+        print_report(buckets)
+        size = os.path.getsize(path)
+        print("{} events in {:.1f} MB, analyzed in {:.2f}s ({:.0f} MB/s)".format(
+            matched, size / 1e6, elapsed, size / 1e6 / elapsed if elapsed else 0.0))
+    return buckets
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
@@ -69,22 +69,25 @@
 
 # THE EXTERNAL LIBRARIES AND FILES in use:
 
-import os
 import logging
 import json
 import requests
 import time
 from json.decoder import JSONDecodeError
+from settings import get_config
 
 ####################################
 
 # THE VARIABLE ENVIRONMENT
 
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-TELEGRAM_API_KEY = os.getenv('TELEGRAM_API_KEY')
-CHAT_ID = os.getenv('CHAT_ID')
-API_HASH = os.getenv('API_HASH')
-API_ID = os.getenv('API_ID')
+# The environment variables are read once, by 'settings.py', the same way as for 'main.py'.
+
+config = get_config()
+OPENAI_API_KEY = config.openai_api_key
+TELEGRAM_API_KEY = config.telegram_api_key
+CHAT_ID = config.chat_id
+API_HASH = config.api_hash
+API_ID = config.api_id
 
 ####################################
 
@@ -19,7 +19,16 @@
 # The script consists of the 4 functions: 'SEND_MESSAGE', 'GENERATE_RESPONSE', 'HANDLE_MESSAGE' and 'GET_UPDATES',
 # which are described in details below.
 
-# The script also has the 'POLL_INTERVAL' constant and the 'MAIN LOOP'. Both are described in details below.
+# The script also has the 'POLL_INTERVAL' setting and the 'MAIN LOOP'. Both are described in details below.
+
+# The 'MAIN LOOP' does not call 'HANDLE_MESSAGE' directly: the 'DISPATCH_UPDATE' function queues each update
+# on the scheduler (see 'scheduler.py'), so a generation in flight can be cancelled by '/stop', '/reset'
+# or a newer message from the same chat (see 'cancellation.py').
+
+# One process can host several bots (see 'THE BOTS' in 'settings.py'). Every update belongs to one of them,
+# and the functions below take the 'BOT' it came to: the answer is generated with the persona, the model
+# and the limits of that bot, and sent back by that bot to the chat the update came from.
+# Without the 'bots' setting, everything goes through the 'default' bot, as before.
 
 # It also has the logging system, described in details below as well.
 
@@ -54,7 +63,7 @@
 # 8. The 'GET_UPDATES' function, the 'HANDLE_MESSAGE' function, and the 'GENERATE_RESPONSE' function
 # all use the logger object to log messages and errors to the console and a log file.
 
-# 9. The 'POLL_INTERVAL' constant is used for the 'MAIN LOOP'
+# 9. The 'POLL_INTERVAL' setting is used for the 'MAIN LOOP'
 # to control the frequency of polling for updates from the Telegram API.
 
 # Overall, the data flow in the script involves retrieving updates from the Telegram API,
@@ -71,10 +80,28 @@
 
 import logging
 import json
-import requests
+import threading
 import time
+import signal
 from json.decoder import JSONDecodeError
-from settings import TELEGRAM_API_KEY, CHAT_ID, OPENAI_API_KEY
+from settings import get_config, on_reload, reload_config
+from cancellation import GenerationCancelled
+import traffic
+import profiling
+import lifecycle
+import codec
+import output_length
+import tracing
+import metrics
+import memory
+import resilience
+
+# Importing this file does no work: it does not open files, start threads or load the caches.
+# Even the 'requests' library (the slowest import) is imported by the functions that use it.
+# The logging is set up by 'configure_logging', the caches and the stores are created on first use
+# (see 'THE COMPONENTS' below), and the polling loop runs only in 'run_polling'.
+# So the file can be imported by 'wsgi.py', 'cli.py' and the tools in milliseconds,
+# and it is safe to import it before the web server forks its workers.
 
 ####################################
 
@@ -87,26 +114,64 @@ from settings import TELEGRAM_API_KEY, CHAT_ID, OPENAI_API_KEY
 # The console handler is also set to log at the debug level and writes messages to the console.
 # The format of the log message is set using a formatter that includes the timestamp, log level, and message.
 
+# The handlers are attached to the root logger, so the log messages of the other parts of the bot
+# (the scheduler, the caches, the tracing) go to the same file and console.
+# 'configure_logging' is called by the entry points ('run_polling', 'wsgi.py', 'replay.py');
+# calling it again does nothing.
+
 # Set up the logger
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 # Create a formatter to format the log messages
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-# Create a file handler to write the log messages to a file
-file_handler = logging.FileHandler('error.log')
-file_handler.setLevel(logging.DEBUG)
-file_handler.setFormatter(formatter)
-
-# Create a console handler to write the log messages to the console
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.DEBUG)
-console_handler.setFormatter(formatter)
-
-# Add the handlers to the logger
-logger.addHandler(file_handler)
-logger.addHandler(console_handler)
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(trace)s%(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+
+# The structured format of the log file (the 'log_format' setting 'json'): one JSON object per line,
+# with the time in milliseconds, the trace and the chat as separate fields, and the traceback
+# only if there is one (so no 'NoneType: None' tails). 'log_analyzer.py' reads both formats.
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + '.{:03d}'.format(int(record.msecs)),
+            'level': record.levelname,
+        }
+        if getattr(record, 'trace_id', None):
+            entry['trace'] = record.trace_id
+            entry['chat'] = str(record.chat_id)
+        entry['message'] = record.getMessage()
+        if record.exc_info and record.exc_info[0] is not None:
+            entry['exception'] = self.formatException(record.exc_info)
+        return codec.dumps(entry).decode('utf-8')
+
+file_handler = None
+console_handler = None
+
+
+def configure_logging(console=True):
+    global file_handler, console_handler
+    if file_handler is not None:
+        return
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+
+    # Create a file handler to write the log messages to a file
+    file_handler = logging.FileHandler(get_config().log_file)
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(StructuredFormatter() if get_config().log_format == 'json' else formatter)
+
+    # Add the trace filter to the handler: inside the trace of an update it puts the trace ID and the chat ID
+    # before the message (see 'tracing.py'), so all the log lines of one message can be found together
+    file_handler.addFilter(tracing.TraceLogFilter())
+    root_logger.addHandler(file_handler)
+
+    # Create a console handler to write the log messages to the console
+    if console:
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(logging.DEBUG)
+        console_handler.setFormatter(formatter)
+        console_handler.addFilter(tracing.TraceLogFilter())
+        root_logger.addHandler(console_handler)
 
 # As you can see below, the script uses the 'logger.exception' method.
 # This method of the logging module in Python is used
@@ -143,13 +208,177 @@ logger.addHandler(console_handler)
 
 ####################################
 
+# THE COMPONENTS
+
+# The semantic cache, the knowledge base, the conversation store, the scheduler and the HTTP session
+# are created the first time they are needed, by 'get_component', and then reused by all the bots.
+# The HTTP session keeps the connections to the Telegram and OpenAI APIs open between the requests.
+# Their modules (some of them load NumPy) are imported only then, too.
+# 'set_component' replaces a component, for example 'replay.py' uses it to set the number of workers.
+
+# The components are created with the values of the settings (see 'settings.py'). When the settings
+# are reloaded, '_apply_config' passes the new values to the components that already exist,
+# so the sizes and the limits change without a restart.
+
+_components = {}
+_components_lock = threading.Lock()
+
+
+def _create_semantic_cache():
+    from semantic_cache import SemanticCache
+    config = get_config()
+    return SemanticCache(config.semantic_cache_dir, config.semantic_cache_capacity, config.semantic_cache_threshold)
+
+
+def _create_knowledge_base():
+    from knowledge_base import KnowledgeBase
+    config = get_config()
+    return KnowledgeBase(config.knowledge_dir, config.knowledge_index_dir, config.knowledge_top_k, config.knowledge_token_budget)
+
+
+def _create_conversation_store():
+    from conversation_store import ConversationStore
+    return ConversationStore(get_config().conversation_dir, get_config().conversation_idle_seconds)
+
+
+def _create_scheduler():
+    from scheduler import Scheduler
+    return Scheduler(get_config().max_concurrent_generations)
+
+
+def _create_rate_limiter():
+    from scheduler import RateLimiter
+    return RateLimiter()
+
+
+def _create_usage_ledger():
+    from usage_ledger import UsageLedger
+    return UsageLedger(get_config().usage_file, get_config().usage_window_seconds)
+
+
+def _create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=get_config().max_concurrent_generations + 2)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+COMPONENT_FACTORIES = {
+    'semantic_cache': _create_semantic_cache,
+    'knowledge_base': _create_knowledge_base,
+    'conversation_store': _create_conversation_store,
+    'scheduler': _create_scheduler,
+    'rate_limiter': _create_rate_limiter,
+    'usage_ledger': _create_usage_ledger,
+    'http': _create_http_session,
+}
+
+
+def get_component(name):
+    component = _components.get(name)
+    if component is None:
+        with _components_lock:
+            component = _components.get(name)
+            if component is None:
+                component = _components[name] = COMPONENT_FACTORIES[name]()
+    return component
+
+
+def set_component(name, component):
+    with _components_lock:
+        _components[name] = component
+
+
+# The components created so far (the memory accounting measures them, see 'memory.py')
+def get_components():
+    with _components_lock:
+        return dict(_components)
+
+
+def start_memory_monitor():
+    memory.memory_monitor.attach(get_components)
+    memory.memory_monitor.start()
+
+
+# The admin endpoint (see 'admin.py'), if 'admin_port' is set, in the polling mode and in the webhook mode.
+# With several webhook workers (gunicorn), the first one to bind the port serves it, so its profiler,
+# settings and memory are those of that worker; the others log it and go on without it.
+
+_admin_server = None
+
+
+def start_admin_endpoint():
+    global _admin_server
+    admin_port = get_config().admin_port
+    with _components_lock:
+        if not admin_port or _admin_server is not None:
+            return _admin_server
+        from admin import start_admin_server
+        try:
+            _admin_server = start_admin_server(admin_port, get_components=get_components)
+        except OSError as e:
+            logger.error("Admin endpoint not started on port %d: %s", admin_port, e)
+        return _admin_server
+
+
+# Every SPILL_INTERVAL seconds, a daemon thread moves the conversations of the chats idle for
+# 'conversation_idle_seconds' to disk (see 'conversation_store.py'), in the polling mode and in the webhook mode;
+# a store not created yet is left alone.
+
+SPILL_INTERVAL = 30.0
+_spill_thread = None
+
+
+def start_spill_timer():
+    global _spill_thread
+    with _components_lock:
+        if _spill_thread is not None:
+            return
+        _spill_thread = threading.Thread(target=_spill_idle_conversations, name='conversation-spill', daemon=True)
+    _spill_thread.start()
+
+
+def _spill_idle_conversations():
+    while not lifecycle.wait_for_stop(SPILL_INTERVAL):
+        conversation_store = get_components().get('conversation_store')
+        if conversation_store is None:
+            continue
+        try:
+            conversation_store.spill_idle()
+        except Exception as e:
+            logger.exception("Failed to spill the idle conversations: {}".format(e))
+
+
+@on_reload
+def _apply_config(old, new):
+    with _components_lock:
+        components = dict(_components)
+    if 'scheduler' in components:
+        components['scheduler'].resize(new.max_concurrent_generations)
+    if 'semantic_cache' in components:
+        components['semantic_cache'].threshold = new.semantic_cache_threshold
+    if 'knowledge_base' in components:
+        components['knowledge_base'].top_k = new.knowledge_top_k
+        components['knowledge_base'].token_budget = new.knowledge_token_budget
+    if 'conversation_store' in components:
+        components['conversation_store'].idle_seconds = new.conversation_idle_seconds
+
+####################################
+
 # THE "SEND_MESSAGE" FUNCTION
 
 # This function sends a message to the User with the help of Telegram API.
 # The function takes a string argument 'text', which represents the message to be sent.
 # If the 'text' argument is empty, an error message is logged, and the function returns None.
 
-# The Telegram API URL is constructed using the Telegram API key, chat ID, and the 'text' argument.
+# The optional 'chat_id' argument is the chat to send the message to, and 'bot' is the bot that sends it;
+# by default, the 'chat_id' of the bot and the 'default' bot (see 'settings.py').
+
+# The Telegram API URL is constructed using the Telegram API key of the bot, chat ID, and the 'text' argument.
 
 # A POST request is then sent to the Telegram API, and the response is checked for any HTTP errors.
 # If there is an error, an error message is logged, and the function returns None.
@@ -158,7 +387,9 @@ logger.addHandler(console_handler)
 # Otherwise, an error message is logged, and the function returns None.
 
 
-def send_message(text):
+def send_message(text, chat_id=None, bot=None):
+    import requests
+
     # Check if the message text is empty
     if not text:
         # If the message text is empty, log an error message and return None
@@ -166,11 +397,14 @@ def send_message(text):
         logger.error(error_msg)
         return None
 
-    # Construct the Telegram API URL using the Telegram API key and chat ID, and the message text
-    url = 'https://api.telegram.org/bot' + TELEGRAM_API_KEY + '/sendMessage?chat_id=' + CHAT_ID + '&text=' + text
+    # Construct the Telegram API URL using the Telegram API key of the bot and chat ID, and the message text
+    config = get_config()
+    bot = bot or config.bot()
+    chat_id = chat_id or bot.chat_id
+    url = config.telegram_api_url + '/bot' + bot.telegram_api_key + '/sendMessage?chat_id=' + chat_id + '&text=' + text
 
     # Send a POST request to the Telegram API with the constructed URL
-    response = requests.post(url)
+    response = get_component('http').post(url, timeout=config.telegram_timeout)
 
     # Check if the response has an HTTP error status code
     try:
@@ -185,7 +419,7 @@ def send_message(text):
 
     # Try to parse the response JSON data
     try:
-        response_json = response.json()
+        response_json = codec.loads(response.content)
     except json.JSONDecodeError as e:
         # If the response JSON data cannot be parsed,
         # log an error message with the decoding error and raw response text, and return None
@@ -214,14 +448,40 @@ def send_message(text):
 # The prompt argument is a string that represents the starting point of the conversation,
 # while conversation_history is a list of strings that contains the previous conversation history.
 
+# The optional 'cancel_token' argument is a 'CancelToken' (see 'cancellation.py').
+# The answer is requested as a stream, so the generation can be aborted in the middle:
+# when the token is cancelled, the stream is closed and 'GenerationCancelled' is raised.
+
+# The optional 'knowledge' argument is the reference material found in the knowledge base
+# (see 'knowledge_base.py'). If it is not empty, it is put in front of the prompt.
+
+# The optional 'model' argument is the model to use (see 'model_routes' in 'settings.py');
+# by default it is the model of the bot. The optional 'bot' argument gives the persona ('prompt'),
+# put in front of everything else, and the 'max_tokens' and 'temperature' of the request.
+# The other parameters of the request and the timeouts are read from the settings on every call,
+# so a reload applies to the next request.
+
+# The optional 'plan' argument is the 'OutputPlan' of the message (see 'output_length.py'): it sets
+# the 'max_tokens', and its style instruction is added after the message.
+# If the plan continues a cut answer, its text is sent as it is, so the model goes on from where it stopped.
+# The function fills in the prompt it sent, the answer and the 'finish_reason' of the plan.
+
+KNOWLEDGE_HEADER = "Reference material (use it to answer briefly and precisely):\n"
+CONVERSATION_HEADER = "Conversation:\n"
+
+
+def generate_response(prompt, conversation_history, cancel_token=None, knowledge=None, model=None, bot=None, plan=None):
+    config = get_config()
+    bot = bot or config.bot()
 
-def generate_response(prompt, conversation_history):
     # Checks if the conversation_history is a string, and if it is not, joins the list using a newline character
     # to create a string. Similarly, it converts the prompt variable to a string if it is not already a string.
     if not isinstance(conversation_history, str):
         conversation_history = '\n'.join(conversation_history)
     if not isinstance(prompt, str):
         prompt = str(prompt)
+    # Time the building of the prompt as a span of the trace of the update (see 'tracing.py')
+    tracing.start_span('prompt_build')
     # Log the prompt that is being sent to the OpenAI API
     logger.error("Prompt: %s", prompt)
 
@@ -250,63 +510,198 @@ def generate_response(prompt, conversation_history):
         prompt = conversation_history.strip() + prompt[len(conversation_history):].lstrip()
     logger.error("After concatenation: prompt = %s conversation_history = %s", prompt, conversation_history)
 
+    # Put the reference material in front of the conversation, so the model can answer briefly from it
+    if knowledge:
+        prompt = KNOWLEDGE_HEADER + knowledge + '\n\n' + CONVERSATION_HEADER + prompt
+
+    # Put the persona of the bot in front of everything
+    if bot.prompt:
+        prompt = bot.prompt + '\n\n' + prompt
+
+    # Ask for an answer of the planned length, or continue the cut answer as it is
+    if plan is not None:
+        if plan.continuation:
+            prompt = plan.continuation
+        elif plan.instruction:
+            prompt = prompt + '\n' + plan.instruction + '\n'
+        plan.prompt = prompt
+
     # Sends a request to the OpenAI API to generate a response using the provided prompt.
     # It creates a dictionary of parameters to be sent to the API.
     # It also sets the headers for the API request, including the content type and authorization key.
     data = {
-        "model": "gpt-4-1106-preview",
+        "model": model or bot.openai_model,
         "prompt": prompt,
-        "temperature": 0.9,
-        "max_tokens": 2200,
+        "temperature": bot.temperature,
+        "max_tokens": plan.max_tokens if plan is not None else bot.max_tokens,
         "top_p": 1,
-        "n": 1
+        "n": 1,
+        "stream": True,
+        "stream_options": {"include_usage": True}  # the tokens of the request, for the usage ledger
     }
 
-    # Convert the data to a JSON string
-    json_data = json.dumps(data)
-
-    # Validate the query before sending it
+    # Convert the data to JSON bytes, once (see 'codec.py'): the same bytes are sent and logged.
+    # Data that cannot be serialized is an invalid query, and it is not sent
     try:
-        json.loads(json_data)
-        logger.error("Data sent to OpenAI API: %s", data)
-    except ValueError:
-        error_msg = "Invalid request data:{}".format(json_data)
+        body = codec.encode(data)
+    except (TypeError, ValueError):
+        error_msg = "Invalid request data:{}".format(data)
         logger.exception(error_msg)
         return "Seems, something happened, sorry."
 
     # Set the headers for the API request
     headers = {
         "Content-Type": "application/json",
-        "Authorization": "Bearer {}".format(OPENAI_API_KEY)
+        "Authorization": "Bearer {}".format(config.openai_api_key)
     }
 
     # Log the request data before sending it
-    logger.error("Sending request to OpenAI with data: %s", data)
+    logger.error("Sending request to OpenAI with data: %s", body)
+
+    tracing.end_span('prompt_build', prompt_chars=len(prompt), body_bytes=len(body), request_key=body.key)
+
+    # Do not even start the request if the generation was cancelled while the prompt was being prepared
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
 
     # Sends the API request using the requests library and checks the status code of the response.
-    # If the status code is 200, it parses the response JSON and returns the generated text from the API.
+    # If the status code is 200, it reads the streamed answer chunk by chunk and returns the generated text.
     # If the status code is not 200, the function returns "Seems, something happened, sorry".
-    response = requests.post('https://api.openai.com/v1/completions', json=data, headers=headers)
-    if response.status_code == 200:
-        response_data = response.json()
-        if len(response_data['choices']) > 0:
-            return response_data['choices'][0]['text']
-    else:
-        error_msg = "OpenAI API request failed with status code {}".format(response.status_code)
-        logger.exception(error_msg)
-        return "Seems, something happened, sorry."
+    # The connection errors, the timeouts and the statuses 429 and 5xx are retried, and the whole call,
+    # the streamed answer included, must end by the deadline (see 'resilience.py').
+    deadline = resilience.Deadline(config.openai_total_timeout)
+    started = time.monotonic()
+    with tracing.span('openai', model=data['model'], prompt_tokens=len(prompt) // 4, max_tokens=data['max_tokens'],
+                      output_kind=plan.kind if plan is not None else None):
+        try:
+            response = resilience.post(get_component('http'), config.openai_api_url + '/v1/completions', body.body,
+                                       headers, config, deadline, cancel_token)
+        except (resilience.DeadlineExceeded, OSError) as e:
+            # The requests errors are 'OSError' too
+            error_msg = "OpenAI API request failed: {}".format(e)
+            logger.exception(error_msg)
+            tracing.mark_failed(error_msg)
+            return "Seems, something happened, sorry."
+        tracing.set_attributes(status=response.status_code)
+        if cancel_token is not None:
+            cancel_token.attach(response)
+        try:
+            if response.status_code != 200:
+                error_msg = "OpenAI API request failed with status code {}".format(response.status_code)
+                logger.exception(error_msg)
+                tracing.mark_failed(error_msg)
+                return "Seems, something happened, sorry."
+
+            generated_response = read_completion_stream(response, cancel_token, plan, deadline)
+        except (resilience.DeadlineExceeded, OSError, ValueError) as e:
+            # The stream can also break in the middle: a read timeout or a reset connection is an 'OSError',
+            # and a cut chunk is not valid JSON. The request is not sent again, since a part of the answer
+            # was already generated (and paid for), and the deadline is often close.
+            error_msg = "OpenAI API request failed: {}".format(e)
+            logger.exception(error_msg)
+            tracing.mark_failed(error_msg)
+            return "Seems, something happened, sorry."
+        finally:
+            if cancel_token is not None:
+                cancel_token.detach()
+            response.close()
+            # The answer was being generated, so the tokens were used, even if the generation was cancelled
+            # or failed: they go to the usage ledger all the same
+            if plan is not None and response.status_code == 200:
+                finish_usage(plan, data['model'], prompt, started)
+
+    if generated_response is None or not generated_response.strip():
+        # If the function has not got any text by this point (or only white space, which cannot be sent),
+        # an error occurred and it returns "Seems, something happened, sorry"
+        logger.exception("Something went wrong while generating a response")
+        tracing.mark_failed("empty completion")
+        return "Seems, something happened, sorry"
 
     # Add logging for successful response
-    generated_response = response_data['choices'][0]['text']
     logger.error("Generated response: %s", generated_response)
+    if plan is not None:
+        plan.answer = generated_response
+    return generated_response
+
+
+# Sets the 'usage' of the plan for the usage ledger: the tokens reported by the API, or an estimate
+# if it did not report them (a cancelled or broken stream never does): 4 characters per token of the prompt,
+# and one token per chunk of the answer received
+def finish_usage(plan, model, prompt, started):
+    usage = plan.usage or {}
+    plan.usage = {
+        'model': model,
+        'prompt_tokens': usage.get('prompt_tokens', len(prompt) // 4),
+        'completion_tokens': usage.get('completion_tokens', plan.streamed_tokens),
+        'seconds': time.monotonic() - started,
+    }
 
-    # If the function has not returned by this point, an error occurred
-    # and it returns "Seems, something happened, sorry"
-    error_msg = "OpenAI API request failed with status code {}".format(response.status_code)
-    print("Error message:", error_msg)
-    logging.error("Error message: %s", error_msg)
-    logger.exception("Something went wrong while generating a response")
-    return "Seems, something happened, sorry"
+####################################
+
+# THE "READ_COMPLETION_STREAM" FUNCTION
+
+# The OpenAI API sends a streamed answer as "server-sent events":
+# lines starting with 'data: ' that hold a JSON chunk with the next piece of text,
+# and the final 'data: [DONE]' line.
+
+# The function checks the cancel token before every chunk.
+# If the token was cancelled, the response has already been closed by the token,
+# so reading fails or stops, and 'GenerationCancelled' is raised either way.
+# It returns the joined text, or None if the stream did not contain any choices.
+# The number of chunks (one token each) is added to the current span as 'completion_tokens',
+# and the 'finish_reason' of the last chunk ('length' if the answer was cut) to the span and the 'plan'.
+# The 'usage' of the last chunk (the tokens of the request, sent after the text) goes to the 'plan' too,
+# with the number of chunks received, also when the reading is cancelled or fails.
+# If the 'deadline' of the call passes (see 'resilience.py'), 'DeadlineExceeded' is raised; a chunk that
+# does not come at all is limited by the read timeout of the request, and the error of the connection
+# is raised (the caller, 'generate_response', turns all of them into the failure message).
+
+
+def read_completion_stream(response, cancel_token=None, plan=None, deadline=None):
+    pieces = []
+    got_choices = False
+    finish_reason = None
+    usage = None
+    try:
+        for line in response.iter_lines():
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            if deadline is not None:
+                deadline.check()
+            if not line or not line.startswith(b'data: '):
+                continue
+            payload = line[len(b'data: '):]
+            if payload.strip() == b'[DONE]':
+                break
+            chunk = codec.loads(payload)
+            if chunk.get('choices'):
+                got_choices = True
+                pieces.append(chunk['choices'][0].get('text') or '')
+                finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+            if chunk.get('usage'):
+                usage = chunk['usage']
+    except GenerationCancelled:
+        raise
+    except Exception:
+        # A connection error after cancellation is the cancellation itself
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+        raise
+    finally:
+        # What was received so far, even if the stream was cancelled or broken (see 'finish_usage')
+        if plan is not None:
+            plan.streamed_tokens = len(pieces)
+            plan.usage = usage
+    tracing.set_attributes(completion_tokens=len(pieces), finish_reason=finish_reason)
+    if plan is not None:
+        plan.finish_reason = finish_reason
+        if finish_reason == 'length':
+            metrics.increment('output_length.truncated')
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+    if not got_choices:
+        return None
+    return ''.join(pieces)
 
 ####################################
 
@@ -320,8 +715,35 @@ def generate_response(prompt, conversation_history):
 # The 'update' argument contains the data from the User's message,
 # and the 'conversation_history' argument is a string containing the previous conversation history.
 
+# The optional 'cancel_token' argument is passed on to 'generate_response'.
+# If the generation is cancelled, no message is sent, and the conversation history
+# is returned with the User's message but without an answer.
+
+# Before calling 'generate_response', the function asks the semantic cache (see 'semantic_cache.py')
+# whether a question close enough to this one was already answered, and if so, reuses that answer.
+# New answers are stored in the cache, unless the request failed.
+
+# The function also retrieves the passages of the knowledge base relevant to the message,
+# and passes them to 'generate_response' as the reference material,
+# together with the model routed to the chat (see 'model_routes' in 'settings.py').
+
+# The optional 'bot' argument is the bot the update came to (the 'default' bot if it is not given).
+# The answer is sent by that bot to the chat of the update. The answers of each bot are cached
+# in their own namespace of the semantic cache, since the personas answer differently.
+# A question asked in the middle of a conversation is cached with its context (the chat and the recent turns),
+# so its answer is reused only in the same chat, after the same turns.
+
+# The optional 'plan' argument is the 'OutputPlan' of the message (see 'output_length.py').
+# A plan continuing a cut answer skips the cache and the knowledge base, and the cut answers are not cached.
 
-def handle_message(update, conversation_history=""):
+FAILED_RESPONSES = ("Seems, something happened, sorry.", "Seems, something happened, sorry")
+
+
+def handle_message(update, conversation_history="", cancel_token=None, bot=None, plan=None):
+    from semantic_cache import conversation_context
+
+    bot = bot or get_config().bot()
+    cache_namespace = '' if bot.is_default else bot.name
     try:
         # Check if the update has a 'message' field and a 'text' field
         if 'message' not in update or 'text' not in update['message']:
@@ -337,6 +759,9 @@ def handle_message(update, conversation_history=""):
         conversation_history_msg = "Conversation history: {}".format(conversation_history)
         logger.exception(conversation_history_msg)
 
+        # The context of the question for the semantic cache: the chat and its recent turns, if any
+        cache_context = conversation_context(chat_key(bot, get_chat_id(update, bot)), conversation_history)
+
         # Add the received message to the conversation history if it is not empty
         if text.strip():
             conversation_history += '\n' + text
@@ -345,13 +770,33 @@ def handle_message(update, conversation_history=""):
         before_generate_response_msg = "Before generate_response(): prompt = {}, conversation_history = {}".format(text, conversation_history)
         logger.exception(before_generate_response_msg)
 
-        # Generate a response using the incoming message as the prompt and the conversation history as context
-        response = generate_response(text, conversation_history)
+        # Reuse the answer to a close enough question, or generate a response using the incoming message
+        # as the prompt and the conversation history as context
+        continuing = plan is not None and plan.continuation
+        response = None
+        if not continuing:
+            with tracing.span('semantic_cache') as cache_span:
+                response = get_component('semantic_cache').lookup(text, cache_namespace, cache_context)
+                if cache_span is not None:
+                    cache_span.attributes['hit'] = response is not None
+        if response is None:
+            knowledge = None
+            if not continuing:
+                with tracing.span('retrieval'):
+                    knowledge = get_component('knowledge_base').retrieve(text)
+            model = (plan.model if plan is not None else None) or get_config().model_for(get_chat_id(update, bot), bot)
+            response = generate_response(text, conversation_history, cancel_token, knowledge, model, bot, plan)
+            if response not in FAILED_RESPONSES and not continuing and not (plan is not None and plan.truncated):
+                get_component('semantic_cache').store(text, response, cache_namespace, cache_context)
 
         # Log the generated response
         after_generate_response_msg = "After generate_response(): response = {}".format(response)
         logger.exception(after_generate_response_msg)
 
+        # The generation could have been cancelled right after it finished; then the answer is dropped
+        if cancel_token is not None:
+            cancel_token.raise_if_cancelled()
+
         # If a response was generated, add it to the conversation history
         if response is not None:
             conversation_history += '\n' + response  # add the response to the conversation history
@@ -360,8 +805,20 @@ def handle_message(update, conversation_history=""):
         after_concatenation_msg = "After concatenation: conversation_history = {}".format(conversation_history)
         logger.exception(after_concatenation_msg)
 
-        # Send the generated response as a message to the Telegram API
-        send_message(response)
+        # A cut answer is sent with the note about "continue"; the history keeps the answer itself
+        sent_response = response
+        if plan is not None and plan.truncated and response not in FAILED_RESPONSES:
+            sent_response = response + output_length.CONTINUE_NOTE
+
+        # Send the generated response as a message to the Telegram API, to the chat the update came from
+        with tracing.span('send_message'):
+            send_message(sent_response, get_chat_id(update, bot), bot)
+
+    except GenerationCancelled as e:
+        # If the generation was cancelled ('/stop', a reset or a newer message),
+        # nobody will read the answer, so nothing is sent
+        logger.error("Generation cancelled: {}".format(e))
+        tracing.set_trace_attributes(cancelled=str(e))
 
     except (KeyError, ValueError) as e:
         # If an error occurs while handling the update,
@@ -380,7 +837,8 @@ def handle_message(update, conversation_history=""):
 # The function takes an optional argument 'offset'
 # which is used to specify the message offset to start retrieving updates from.
 # If no offset is provided, the function retrieves all available updates.
-# The function constructs the Telegram API URL using the Telegram API key and the 'getUpdates' method.
+# The optional 'bot' argument is the bot to get the updates of (the 'default' bot if it is not given).
+# The function constructs the Telegram API URL using the Telegram API key of the bot and the 'getUpdates' method.
 # The 'offset' parameter is added to the request parameters if it is provided,
 # and a GET request is sent to the Telegram API.
 # If the response status code is 200, the JSON data from the response is parsed,
@@ -389,22 +847,24 @@ def handle_message(update, conversation_history=""):
 # Otherwise, an error message is logged, and an empty list is returned.
 
 
-def get_updates(offset=None):
+def get_updates(offset=None, bot=None):
     # Construct the URL to retrieve updates from the Telegram API using the Telegram API key and offset
-    url = "https://api.telegram.org/bot" + TELEGRAM_API_KEY + "/getUpdates"
+    config = get_config()
+    bot = bot or config.bot()
+    url = config.telegram_api_url + "/bot" + bot.telegram_api_key + "/getUpdates"
     params = {}
     if offset:
         params['offset'] = offset
 
     # Send a GET request to the Telegram API with the constructed URL and optional offset parameter
-    response = requests.get(url, params=params)
+    response = get_component('http').get(url, params=params, timeout=config.telegram_timeout)
     renews = []
 
     # Check if the response has an HTTP status code of 200 (OK)
     if response.status_code == 200:
         try:
             # Try to parse the response JSON data and extract the 'result' field
-            result = response.json()["result"]
+            result = codec.loads(response.content)["result"]
         except JSONDecodeError as e:
             # If the response JSON data cannot be parsed,
             # log an error message with the decoding error and return an empty list
@@ -433,53 +893,322 @@ def get_updates(offset=None):
 
 ####################################
 
-# THE "POLL_INTERVAL" LINE
+# THE "POLL_INTERVAL" SETTING AND THE OTHER TUNING VALUES
+
+# The 'poll_interval' setting (12 seconds by default) specifies the time interval between each poll
+# for updates from the Telegram API. It can be changed as desired to adjust the frequency of polling.
+
+# Like the other tuning values ('max_concurrent_generations', the number of worker threads that may
+# generate answers at the same time; 'metrics_log_interval'; 'conversation_idle_seconds', the idle time
+# after which the conversation of a chat is compressed and moved to disk), it is kept in 'settings.py'
+# and read by the main loop on every iteration, so it can be changed without restarting the bot:
+# edit 'config.json' and send SIGHUP to the process, or use the admin endpoint (see 'admin.py').
+
+# The commands that cancel the generation in flight for the chat.
+# '/stop' only cancels it, '/reset' also clears the conversation history of the chat.
+STOP_COMMANDS = ('/stop',)
+RESET_COMMANDS = ('/reset', '/start')
+
+####################################
+
+# THE "GET_CHAT_ID" FUNCTION
+
+# This function returns the ID of the chat the update came from,
+# or the 'chat_id' of the bot (see 'settings.py') if the update does not have one.
+
+# 'chat_key' is the key of the chat in the scheduler, the rate limiter and the conversation store.
+# The same chat ID can come to several bots, so for the bots other than the default one
+# the name of the bot is put in front of it.
+
+# 'has_message_text' tells whether the update is a text message in a chat, the only kind the bot answers.
 
-# This independence line of the script defines a constant variable 'POLL_INTERVAL',
-# which is used to specify the time interval (in seconds) between each poll for updates from the Telegram API.
-# The comment in the code suggests that the value of this constant can be changed as desired
-# to adjust the frequency of polling.
 
-# Since this line is not part of either the main loop or the get_updates() function,
-# it is executed when the script is loaded and before any of the other functions are called.
-# Once the constant is defined, its value is used in the main loop to control the frequency of polling.
+def get_chat_id(update, bot=None):
+    chat = update.get('message', {}).get('chat') or {}
+    chat_id = chat.get('id')
+    return str(chat_id) if chat_id is not None else (bot or get_config().bot()).chat_id
 
 
-POLL_INTERVAL = 12  # Change the value as desired
+# Only the updates with the text of a message, in a known chat, are answered
+def has_message_text(update):
+    message = update.get('message')
+    return isinstance(message, dict) and isinstance(message.get('text'), str) and bool(message.get('chat'))
+
+
+def chat_key(bot, chat_id):
+    return chat_id if bot.is_default else '{}:{}'.format(bot.name, chat_id)
+
+####################################
+
+# THE "DISPATCH_UPDATE" FUNCTION
+
+# This function decides what to do with an update received by the 'MAIN LOOP'.
+# It does not wait for the answer, so the loop can keep polling while answers are generated:
+# - an update without the text of a message (an edited message, a button, a photo or a sticker,
+#   a change of the members of the chat) is dropped at once: it is not an answer to generate,
+#   so it must not supersede the generation in flight for its chat, nor fall back to the 'chat_id' of the bot;
+# - '/stop' cancels the generation in flight for the chat;
+# - '/reset' cancels it and clears the conversation history of the chat;
+# - a message over the rate limit of the chat is dropped;
+# - any other message supersedes the generation in flight for the chat
+#   (the scheduler cancels it) and is queued to be handled by 'process_update',
+#   ahead of the chats that used more tokens lately (see 'usage_ledger.py').
+
+# Every update gets a trace (see 'tracing.py'), which is finished when the work of the update ends.
+
+# The optional 'bot' argument is the bot the update came to (the 'default' bot if it is not given);
+# the chats of different bots are kept apart (see 'chat_key'). 'source' tells the trace where the update
+# came from: the polling loop or the webhook (see 'wsgi.py'), which goes through this function too,
+# so both entry points plan the answer length, keep the conversations and count the tokens the same way.
+
+# The work of the update returns the new conversation history of the chat
+# (None if the work was cancelled before it started, or failed).
+
+# The conversation history is kept per chat in the conversation store (see 'conversation_store.py'),
+# which keeps the active chats in memory and moves the idle ones to disk.
+# It is read and written only by the work of the chat itself, which the scheduler runs one at a time.
+
+
+def dispatch_update(update, bot=None, source='polling'):
+    bot = bot or get_config().bot()
+    if not has_message_text(update):
+        logger.info("Ignored update %s without a message text", update.get('update_id'))
+        metrics.increment('ignored_updates')
+        return None
+    chat_id = get_chat_id(update, bot)
+    key = chat_key(bot, chat_id)
+    command = update['message']['text'].strip().lower()
+
+    # Start the trace of the update; the scheduler carries it into the worker (see 'tracing.py')
+    trace = tracing.start_trace('update', update_id=update.get('update_id'), chat_id=chat_id, bot=bot.name, source=source)
+    with tracing.activate(trace):
+        if command in STOP_COMMANDS:
+            if get_component('scheduler').cancel(key, "stop"):
+                logger.error("Generation stopped by the User in chat %s", chat_id)
+            tracing.finish_trace(trace)
+            return None
+
+        # Refuse the messages of a chat that sends more than 'rate_limit_per_minute' of them
+        if not get_component('rate_limiter').allow(key, bot.rate_limit_per_minute):
+            logger.error("Rate limit exceeded in chat %s, the message is dropped", chat_id)
+            metrics.increment('rate_limited')
+            tracing.set_trace_attributes(rate_limited=True)
+            tracing.finish_trace(trace)
+            return None
+
+        tracing.start_span('queue')
+        if command in RESET_COMMANDS:
+            return get_component('scheduler').submit(key, reset_conversation, key)
+
+        # The chats that used fewer tokens lately are served first (see 'usage_ledger.py')
+        priority = get_component('usage_ledger').priority(key, get_config().chat_token_budget)
+        return get_component('scheduler').submit(key, process_update, update, bot, priority=priority)
+
+
+def process_update(update, bot=None, cancel_token=None):
+    tracing.end_span('queue')
+    bot = bot or get_config().bot()
+    key = chat_key(bot, get_chat_id(update, bot))
+    conversation_store = get_component('conversation_store')
+    conversation = conversation_store.checkout(key)
+    text = update.get('message', {}).get('text', '')
+    error = None
+    plan = None
+    try:
+        conversation_history = conversation.render()
+        plan = output_length.plan_output(text, conversation, bot, get_config())
+        apply_token_budget(key, plan)
+        with profiling.slow_update_trap(update):
+            new_history = handle_message(update, conversation_history, cancel_token, bot, plan)
+        conversation.add_exchange(text, new_history[len(conversation_history):])
+        # Keep the cut answer for "continue"; a cancelled generation leaves the previous one as it was
+        if cancel_token is None or not cancel_token.cancelled:
+            conversation.partial = plan.partial()
+        return new_history
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # The tokens of every generation are counted, the cancelled and the failed ones too,
+        # so superseding one's own messages does not get around the token budget
+        if plan is not None and plan.usage is not None:
+            get_component('usage_ledger').record(key, **plan.usage)
+        conversation_store.checkin(key, conversation)
+        tracing.finish_trace(error=error)
+
+
+# A chat over its token budget gets shorter answers and a cheaper model, if they are set (see 'settings.py')
+def apply_token_budget(key, plan):
+    config = get_config()
+    if not get_component('usage_ledger').over_budget(key, config.chat_token_budget):
+        return
+    metrics.increment('usage.over_budget')
+    tracing.set_trace_attributes(over_budget=True)
+    if config.over_budget_max_tokens:
+        plan.max_tokens = min(plan.max_tokens, config.over_budget_max_tokens)
+    plan.model = config.over_budget_model
+
+
+def reset_conversation(chat_id, cancel_token=None):
+    tracing.end_span('queue')
+    get_component('conversation_store').reset(chat_id)
+    logger.error("Conversation history reset for chat %s", chat_id)
+    tracing.finish_trace()
 
 ####################################
 
 # THE MAIN LOOP
 
 # This main loop of the script continuously polls the Telegram API
-# for updates every N seconds using the 'get_updates' function.
+# for updates every N seconds using the 'get_updates' function, for every bot in turn ('poll_bot').
 
-# If there are updates, the loop iterates over each update and calls the 'handle_message' function
-# with the update and the conversation history.
+# If there are updates, the loop iterates over each update and passes it to the 'dispatch_update' function,
+# which queues it to be handled by the 'handle_message' function on one of the scheduler's workers.
 
-# The conversation history is updated with the response generated by the 'handle_message' function.
+# The conversation history of the chat is updated with the response generated by the 'handle_message' function.
 # If there is an exception raised while handling the update, an error message is logged.
 
+# Every new update is also saved by the traffic recorder, if the recording is turned on (see 'traffic.py').
+
 # The loop then sleeps for N seconds before polling the Telegram API again.
+# Every 'metrics_log_interval' seconds it logs the metrics (cache hit rate, lookup latency and so on).
+
+# The loop is in the 'run_polling' function, which is called only when the script is run directly,
+# so other scripts (such as 'wsgi.py' and 'replay.py') can import the functions of the bot.
 
-conversation_history = ""  # Initialize the conversation history as an empty string
-last_update_id = 0 # Initialize the last update ID as 0
-while True:
-    # Poll the Telegram API for updates using the 'get_updates' function
-    updates = get_updates(last_update_id)
+# The loop runs until SIGTERM (or Ctrl+C) asks it to stop (see 'lifecycle.py'). Then it stops polling,
+# waits up to 'drain_seconds' for the answers being generated, saves the offset of the updates
+# and writes the conversations and the cache to disk. The offset is also saved after every poll,
+# and a new process starts from it, so an update is fetched again only if it was not handled.
 
-    # If there are updates, iterate over each update and handle it using the 'handle_message' function
+# Before the loop starts, the logging is set up, the admin endpoint is started (if ADMIN_PORT is set,
+# see 'admin.py'), the SIGUSR1 signal is set to toggle the sampling profiler (see 'profiling.py'),
+# the SIGHUP signal is set to reload the settings (see 'settings.py'),
+# and the components are created, so the first message does not wait for the knowledge index.
+# The memory accounting then starts measuring them (see 'memory.py'), and the spill timer starts moving
+# the idle conversations to disk (see 'start_spill_timer').
+
+# The signal handler only wakes a thread that does the reloading, so the loop is never stopped
+# in the middle of a request, and a bad configuration file is logged and ignored.
+
+_reload_requested = threading.Event()
+
+
+def _reload_on_request():
+    while True:
+        _reload_requested.wait()
+        _reload_requested.clear()
+        try:
+            reload_config()
+        except ValueError as e:
+            logger.exception("Configuration not reloaded: {}".format(e))
+
+
+# The same handler is installed by 'cli.py webhook'. Under gunicorn, SIGHUP belongs to its master process,
+# which starts new workers with the new settings; the admin endpoint (POST /config/reload) reloads
+# the worker serving it (see 'start_admin_endpoint').
+
+_reload_thread = None
+
+
+def install_reload_signal_handler():
+    global _reload_thread
+    if not hasattr(signal, 'SIGHUP'):
+        return
+    if _reload_thread is None:
+        _reload_thread = threading.Thread(target=_reload_on_request, name='config-reload', daemon=True)
+        _reload_thread.start()
+    signal.signal(signal.SIGHUP, lambda signum, frame: _reload_requested.set())
+
+
+def run_polling():
+    configure_logging()
+    start_admin_endpoint()
+    profiling.install_signal_handler()
+    install_reload_signal_handler()
+    lifecycle.install_stop_handlers()
+    for name in COMPONENT_FACTORIES:
+        get_component(name)
+    start_memory_monitor()
+    start_spill_timer()
+
+    offsets = {}  # bot name -> UpdateOffsets of the bot (see 'lifecycle.py')
+    last_metrics_log = time.monotonic()
+    while not lifecycle.stop_requested():
+        # Poll the Telegram API for the updates of every bot (the bots can be added by a reload)
+        for bot in get_config().bots.values():
+            if not bot.telegram_api_key:
+                continue
+            if bot.name not in offsets:
+                path = lifecycle.offset_path(get_config().offset_file, None if bot.is_default else bot.name)
+                offsets[bot.name] = lifecycle.UpdateOffsets(path)
+            poll_bot(bot, offsets[bot.name])
+
+        # Log the metrics from time to time
+        if time.monotonic() - last_metrics_log >= get_config().metrics_log_interval:
+            last_metrics_log = time.monotonic()
+            logger.error("Metrics: %s", metrics.format_snapshot())
+
+        # Sleep for N seconds before polling the Telegram API again (or until the stop is requested)
+        lifecycle.wait_for_stop(get_config().poll_interval)
+
+    drain(offsets)
+
+
+def poll_bot(bot, offsets):
+    # Poll the Telegram API for updates using the 'get_updates' function,
+    # confirming only the updates that are already handled
+    updates = get_updates(offsets.safe_offset(), bot)
+
+    # If there are updates, iterate over each update and dispatch it to the scheduler
     if updates:
         for update in updates:
             update_id = update["update_id"]
-            if update_id > last_update_id:
-                last_update_id = update_id
+            if update_id > offsets.last_update_id:
+                offsets.last_update_id = update_id
+                if offsets.finished(update_id):
+                    # Handled by the previous process, after an update it left unfinished
+                    continue
+                traffic.record(update)
                 try:
-                    conversation_history = handle_message(update, conversation_history)
+                    offsets.pending.add(update_id, dispatch_update(update, bot))
                 except Exception as e:
                     error_msg = "Error handling update: {}".format(e)
                     print("Debug:", error_msg)
                     logging.exception(error_msg)
 
-    # Sleep for N seconds before polling the Telegram API again
-    time.sleep(POLL_INTERVAL)
+    # Save the offset, so a new process does not fetch the handled updates again
+    offsets.save()
+
+
+# The offsets (with the finished updates) are taken before the unfinished work is cancelled
+# (a cancelled work item also ends), so the updates cancelled by the drain are neither confirmed
+# nor saved as finished, and the next process handles them.
+
+
+# The webhook mode drains the same way, with no offsets (see 'wsgi.py' and 'cli.py').
+
+
+def drain(offsets):
+    scheduler = get_component('scheduler')
+    logger.error("Draining: %d work items queued", scheduler.memory_usage()['queued'])
+    scheduler.wait_idle(get_config().drain_seconds)
+    snapshots = {name: bot_offsets.snapshot() for name, bot_offsets in offsets.items()}
+    scheduler.drain(0)
+    for name, bot_offsets in offsets.items():
+        bot_offsets.save(snapshots[name])
+    flush_components()
+    logger.error("Drained, the offsets of the updates are %s",
+                 {name: offset for name, (offset, _) in snapshots.items()})
+
+
+# Writes the conversations and the cache to disk (only the ones that were created)
+def flush_components():
+    components = get_components()
+    for name in ('conversation_store', 'semantic_cache'):
+        if name in components:
+            components[name].flush()
+
+
+if __name__ == '__main__':
+    run_polling()
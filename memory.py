@@ -0,0 +1,203 @@
+# "MYSHLENEK", the memory accounting
+# Used by 'main.py' and 'admin.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# A memory leak used to show up only when the operating system killed the process.
+# Now the 'MEMORY_MONITOR' measures the memory every 'memory_sample_interval' seconds (see 'settings.py'):
+# - the resident size of the process (RSS), and how much it changed since the previous sample;
+# - the memory of every component of the bot that can tell it (its 'memory_usage' method):
+#   the conversation store (with the largest chats), the semantic cache, the knowledge index,
+#   the scheduler queue, the rate limiter and the usage ledger. 'bytes' is the memory on the heap, 'mapped_bytes'
+#   the files mapped into memory, which the system can drop and read back at any time;
+# - if 'memory_trace_frames' is set, a tracemalloc snapshot, compared with the previous one:
+#   the lines of code whose allocations grew the most are the first suspects of a leak.
+#   tracemalloc slows down every allocation, so it is off by default; it can be turned on
+#   and off while the bot runs (through the admin endpoint, for example).
+
+# The numbers go to the metrics as gauges ('memory.rss_bytes', 'memory.conversation_store.bytes'...),
+# and the whole last report is returned by GET /memory of the admin endpoint (see 'admin.py').
+
+####################################
+
+# THE EVICTION
+
+# On every sample:
+# - the histories of the chats holding more than 'memory_chat_max_kb' lose their oldest turns;
+# - the scheduler, the rate limiter and the usage ledger forget the chats with nothing going on.
+# When the resident size passes 'memory_high_water_mb', the alarm is logged and counted
+# ('memory.alarms'), and the bot evicts what it can: every conversation not in use is written
+# to disk (see 'conversation_store.py') and the garbage collector is run. The report tells
+# how much memory the eviction gave back; if it is not enough, the leak is somewhere else,
+# and the tracemalloc comparison shows where.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+TOP_ALLOCATIONS = 10  # the number of lines of code shown by the tracemalloc comparison
+
+####################################
+
+# THE "RSS_BYTES" FUNCTION
+
+# The resident size of the process, from /proc on Linux; elsewhere the peak resident size
+# ('resource' gives only that), or None if even that is not available.
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+####################################
+
+# THE "MEMORY_MONITOR" CLASS
+
+# 'attach' gives the monitor a function returning the components of the bot (a dictionary name -> object).
+# 'sample' measures the memory, applies the eviction and returns the report;
+# 'start' runs 'sample' in a daemon thread every 'memory_sample_interval' seconds.
+
+
+class MemoryMonitor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._get_components = dict
+        self._thread = None
+        self._snapshot = None  # the previous tracemalloc snapshot
+        self._rss = None  # the previous resident size
+        self.last_report = None
+
+    def attach(self, get_components):
+        self._get_components = get_components
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='memory-monitor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        from settings import get_config
+
+        while True:
+            time.sleep(get_config().memory_sample_interval)
+            try:
+                self.sample()
+            except Exception as e:
+                logger.exception("Memory sampling failed: {}".format(e))
+
+    def sample(self):
+        from settings import get_config
+
+        config = get_config()
+        with self._lock:
+            components = self._get_components()
+            self._trim_chats(components, config)
+
+            rss = rss_bytes()
+            report = {
+                'time': time.time(),
+                'rss_bytes': rss,
+                'rss_change_bytes': rss - self._rss if rss is not None and self._rss is not None else None,
+                'components': self._component_usage(components),
+                'allocations': self._compare_allocations(config.memory_trace_frames),
+            }
+            high_water = config.memory_high_water_mb
+            if high_water and rss is not None and rss > high_water * 1024 * 1024:
+                report['alarm'] = self._evict(components, rss, high_water)
+                rss = rss_bytes()
+            self._rss = rss
+
+            if rss is not None:
+                metrics.set_gauge('memory.rss_bytes', rss)
+            for name, usage in report['components'].items():
+                for key in ('bytes', 'mapped_bytes'):
+                    if key in usage:
+                        metrics.set_gauge('memory.{}.{}'.format(name, key), usage[key])
+            self.last_report = report
+        return report
+
+    @staticmethod
+    def _component_usage(components):
+        usage = {}
+        for name, component in sorted(components.items()):
+            memory_usage = getattr(component, 'memory_usage', None)
+            if memory_usage is None:
+                continue
+            try:
+                usage[name] = memory_usage()
+            except Exception as e:
+                logger.exception("Failed to measure the memory of {}: {}".format(name, e))
+        return usage
+
+    @staticmethod
+    def _trim_chats(components, config):
+        if config.memory_chat_max_kb and 'conversation_store' in components:
+            components['conversation_store'].trim(int(config.memory_chat_max_kb * 1024))
+        for name in ('scheduler', 'rate_limiter', 'usage_ledger'):
+            if name in components:
+                components[name].forget_idle_chats()
+
+    # Starts, stops or compares the tracemalloc snapshots; returns the lines of code that allocated
+    # the most since the previous sample (an empty list on the first snapshot), or None if tracemalloc is off
+    def _compare_allocations(self, frames):
+        if not frames:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            self._snapshot = None
+            return None
+        if not tracemalloc.is_tracing() or tracemalloc.get_traceback_limit() != frames:
+            tracemalloc.stop()
+            tracemalloc.start(frames)
+            self._snapshot = None
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')))
+        previous, self._snapshot = self._snapshot, snapshot
+        if previous is None:
+            return []
+        return [
+            {'place': str(difference.traceback), 'size_change_bytes': difference.size_diff,
+             'count_change': difference.count_diff, 'size_bytes': difference.size}
+            for difference in snapshot.compare_to(previous, 'lineno')[:TOP_ALLOCATIONS]
+        ]
+
+    @staticmethod
+    def _evict(components, rss, high_water):
+        logger.error("Memory high-water mark passed: %.1f MB resident, the mark is %.1f MB",
+                     rss / 1024 / 1024, high_water)
+        metrics.increment('memory.alarms')
+        spilled = 0
+        if 'conversation_store' in components:
+            spilled = components['conversation_store'].flush()
+        collected = gc.collect()
+        after = rss_bytes()
+        freed = rss - after if after is not None else None
+        logger.error("Memory eviction: %d conversations written to disk, %d objects collected, %s bytes freed",
+                     spilled, collected, freed)
+        return {'spilled_conversations': spilled, 'collected_objects': collected, 'freed_bytes': freed}
+
+
+memory_monitor = MemoryMonitor()
@@ -0,0 +1,135 @@
+# "MYSHLENEK", the metrics registry
+# Used by 'main.py' and the other modules of the bot
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# This module keeps simple in-process metrics, so that the behaviour of the bot can be seen
+# without grepping the 'error.log' file:
+# - counters ('increment'), for example the number of cache lookups and hits;
+# - gauges ('set_gauge'), for example the current cache hit rate;
+# - timings ('observe' and the 'timer' context manager), for example the cache lookup latency.
+
+# The timings keep the last TIMING_WINDOW values, so the percentiles describe the recent behaviour.
+# All the functions are thread-safe, because the updates are handled by several worker threads.
+
+# 'snapshot' returns all the metrics as a dictionary, and 'format_snapshot' as one log line.
+# 'timing_percentile' returns one percentile of one timing, for the code that adapts to it.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+####################################
+
+# THE REGISTRY
+
+TIMING_WINDOW = 1024  # Change the value as desired
+
+_lock = threading.Lock()
+_counters = {}  # name -> number
+_gauges = {}  # name -> number
+_timings = {}  # name -> deque of the last TIMING_WINDOW values (seconds)
+_timing_totals = {}  # name -> number of values ever observed
+
+
+def increment(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def set_gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    with _lock:
+        values = _timings.get(name)
+        if values is None:
+            values = _timings[name] = deque(maxlen=TIMING_WINDOW)
+        values.append(seconds)
+        _timing_totals[name] = _timing_totals.get(name, 0) + 1
+
+
+@contextmanager
+def timer(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started)
+
+####################################
+
+# THE "SNAPSHOT" FUNCTION
+
+# Returns a copy of all the metrics.
+# Each timing is summarised by its total count and the mean, p50, p95, p99 and max of its window.
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timings = {name: (sorted(values), _timing_totals[name]) for name, values in _timings.items()}
+
+    summary = {}
+    for name, (values, total) in timings.items():
+        if not values:
+            continue
+        summary[name] = {
+            "count": total,
+            "mean": sum(values) / len(values),
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        }
+    return {"counters": counters, "gauges": gauges, "timings": summary}
+
+
+# The percentile 'p' of the window of one timing, or None if it has fewer than 'min_count' values
+def timing_percentile(name, p, min_count=1):
+    with _lock:
+        values = _timings.get(name)
+        if values is None or len(values) < min_count:
+            return None
+        values = sorted(values)
+    return percentile(values, p)
+
+
+def format_snapshot():
+    data = snapshot()
+    parts = ["{}={}".format(name, value) for name, value in sorted(data["counters"].items())]
+    parts += ["{}={:.4g}".format(name, value) for name, value in sorted(data["gauges"].items())]
+    parts += ["{} p50={:.4f}s p95={:.4f}s".format(name, value["p50"], value["p95"])
+              for name, value in sorted(data["timings"].items())]
+    return ", ".join(parts)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
+        _timing_totals.clear()
+
+####################################
+
+# THE "PERCENTILE" FUNCTION
+
+# Nearest-rank percentile of an already sorted list of values.
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    rank = int(round(p / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
@@ -0,0 +1,142 @@
+# "MYSHLENEK", the output-length control
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# 'generate_response' used to ask for 'max_tokens' 2200 whatever the question, and the generation time
+# grows with the length of the answer, so a short question got a long and slow answer.
+
+# Now every message is sorted into one of three kinds by cheap local rules ('classify'):
+# - 'quick'       : a short question about a fact or a term;
+# - 'explanation' : a "why" or "how" question, or a longer message;
+# - 'exercise'    : a task, an exercise, a request for steps or examples, or a very long message.
+# The kind sets the 'max_tokens' of the request ('quick_max_tokens' and 'explanation_max_tokens' in
+# 'settings.py', never more than the 'max_tokens' of the bot) and a short style instruction
+# added after the message, so the model itself aims at the right length.
+# There are no stop sequences: the completions usually start with empty lines, so a stop at the first
+# empty line would cut most quick answers to nothing.
+
+# If the answer was cut by the limit, the prompt and the partial answer are kept with the conversation
+# of the chat. When the User sends "continue" (see CONTINUE_COMMANDS), the model is asked to go on
+# from exactly that text, with the full 'max_tokens' of the bot, instead of starting the answer again.
+# The cut answer is sent with a short note about it ('CONTINUE_NOTE'), so the User knows it goes on
+# and how to get the rest; the note is not kept in the history or in the partial answer.
+
+# The chats that often ask to continue get longer answers: every "continue" raises the 'length_bias'
+# of the conversation, which fades with every other message, and a high bias moves the next messages
+# one kind up.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import re
+
+import metrics
+
+QUICK = 'quick'
+EXPLANATION = 'explanation'
+EXERCISE = 'exercise'
+KINDS = (QUICK, EXPLANATION, EXERCISE)
+
+STYLE_INSTRUCTIONS = {
+    QUICK: "(Answer in one or two sentences.)",
+    EXPLANATION: "(Explain clearly and briefly, in a few short paragraphs.)",
+    EXERCISE: "",
+}
+
+CONTINUE_COMMANDS = ('/continue', 'continue', 'продолжи', 'продолжай', 'дальше')
+CONTINUE_NOTE = '\n\n(The answer was cut short. Send "continue" / "продолжи" to get the rest.)'
+
+EXERCISE_WORDS = re.compile(
+    r'\b(exercise|task|problem|solve|step by step|steps|examples?|write|plan|'
+    r'задач|упражнен|реши|решени|пошагов|шаг|пример|напиши|составь|разбери)', re.IGNORECASE)
+EXPLANATION_WORDS = re.compile(
+    r'\b(why|how\b|explain|describe|compare|difference|'
+    r'почему|зачем|как\b|объясни|расскажи|опиши|сравни|чем отлича)', re.IGNORECASE)
+
+QUICK_MAX_CHARS = 80  # a message longer than that is never a quick question
+EXERCISE_MIN_CHARS = 400  # a message longer than that is treated as an exercise
+BIAS_DECAY = 0.7
+BIAS_THRESHOLD = 0.5
+
+####################################
+
+# THE "CLASSIFY" FUNCTION
+
+# Returns the kind of the message; 'length_bias' is the bias of the chat (see above).
+
+
+def classify(text, length_bias=0.0):
+    text = text.strip()
+    if len(text) >= EXERCISE_MIN_CHARS or EXERCISE_WORDS.search(text):
+        kind = EXERCISE
+    elif EXPLANATION_WORDS.search(text) or len(text) > QUICK_MAX_CHARS:
+        kind = EXPLANATION
+    else:
+        kind = QUICK
+    if length_bias >= BIAS_THRESHOLD and kind != EXERCISE:
+        kind = KINDS[KINDS.index(kind) + 1]
+    return kind
+
+####################################
+
+# THE "OUTPUT_PLAN" CLASS
+
+# The length settings of one request, passed to 'generate_response', which fills in the prompt it sent,
+# the answer it got and the 'finish_reason' reported by the API ('length' means the answer was cut).
+# 'continuation' is the text to continue (the prompt and the partial answer), or None.
+# 'model' replaces the model of the chat, for a chat over its token budget (see 'usage_ledger.py'), and
+# 'usage' gets the model, the tokens and the seconds of the request, for the ledger,
+# and 'streamed_tokens' the number of chunks of the answer received (an estimate of its tokens).
+
+
+class OutputPlan:
+    __slots__ = ('kind', 'max_tokens', 'instruction', 'continuation', 'prompt', 'answer', 'finish_reason',
+                 'model', 'usage', 'streamed_tokens')
+
+    def __init__(self, kind, max_tokens, instruction='', continuation=None):
+        self.kind = kind
+        self.max_tokens = max_tokens
+        self.instruction = instruction
+        self.continuation = continuation
+        self.prompt = None
+        self.answer = None
+        self.finish_reason = None
+        self.model = None
+        self.usage = None
+        self.streamed_tokens = 0
+
+    @property
+    def truncated(self):
+        return self.finish_reason == 'length'
+
+    # The text to continue from, if the answer was cut by the limit
+    def partial(self):
+        if not self.truncated or self.prompt is None or self.answer is None:
+            return None
+        return self.prompt + self.answer
+
+####################################
+
+# THE "PLAN_OUTPUT" FUNCTION
+
+# Makes the plan for the message 'text' of the chat of 'conversation' (see 'conversation_store.py'),
+# sent to 'bot' (see 'settings.py'), and updates the 'length_bias' of the conversation.
+
+
+def plan_output(text, conversation, bot, config):
+    continuing = text.strip().lower() in CONTINUE_COMMANDS
+    conversation.length_bias = conversation.length_bias * BIAS_DECAY + (1.0 if continuing else 0.0)
+
+    if continuing and conversation.partial:
+        metrics.increment('output_length.continued')
+        return OutputPlan(EXERCISE, bot.max_tokens, continuation=conversation.partial)
+
+    kind = classify(text, conversation.length_bias)
+    limit = {QUICK: config.quick_max_tokens, EXPLANATION: config.explanation_max_tokens}.get(kind)
+    max_tokens = min(limit, bot.max_tokens) if limit else bot.max_tokens
+    metrics.increment('output_length.' + kind)
+    return OutputPlan(kind, max_tokens, STYLE_INSTRUCTIONS[kind])
@@ -0,0 +1,199 @@
+# "MYSHLENEK", the profiling hooks
+# Used by 'main.py' and 'admin.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# When a message takes 40 seconds, we need to know where the time went:
+# the prompt building in 'generate_response', the logging, or the network.
+# This module gives two tools for that.
+
+# 1. The 'SAMPLING_PROFILER'.
+#    When it is started, a background thread looks at the stacks of all the other threads every
+#    'interval' seconds and counts them. When it is stopped, the counts are written to the PROFILE_DIR
+#    directory in the "folded stacks" format ('frame;frame;frame count' per line), which is read by
+#    flamegraph.pl, speedscope and similar tools.
+#    It is toggled by the SIGUSR1 signal (in the polling mode) or by the admin endpoint (see 'admin.py').
+#    When it is not running, there is no thread and no cost at all.
+
+# 2. The 'SLOW_UPDATE_TRAP'.
+#    If SLOW_UPDATE_SECONDS is set (see 'settings.py'), every update is handled under 'cProfile',
+#    and if its handling took longer than the threshold, the profile ('.prof', readable with 'pstats'
+#    or snakeviz) is saved to the PROFILE_DIR directory together with the raw update ('.json').
+#    cProfile measures wall-clock time, so the time spent waiting for the network is visible too.
+#    When SLOW_UPDATE_SECONDS is not set, the trap only measures the handling time for the metrics.
+#    Only one update is profiled at a time: a cProfile profiler takes the profiling hook of the whole
+#    process (on Python 3.12 and later, the one 'sys.monitoring' slot of the profilers, and a second one
+#    fails to start), so the updates handled by the other workers meanwhile are only timed.
+#    The profiled update is the one that started first; a slow update among the others is counted
+#    in the metrics ('slow_updates_unprofiled') but its profile is not saved.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import cProfile
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE "SAMPLING_PROFILER" CLASS
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._counts = Counter()
+        self._started = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return False
+            self._counts = Counter()
+            self._stop.clear()
+            self._started = time.time()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        logger.error("Sampling profiler started")
+        return True
+
+    # Stop the sampling and write the folded stacks; returns the path of the file, or None if it was not running
+    def stop(self, directory):
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return None
+            self._stop.set()
+            thread.join()
+            self._thread = None
+            counts = self._counts
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'sample-{}.folded'.format(time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started))))
+        with open(path, 'w', encoding='utf-8') as folded_file:
+            for stack, count in counts.most_common():
+                folded_file.write('{} {}\n'.format(stack, count))
+        logger.error("Sampling profiler stopped, %d samples written to %s", sum(counts.values()), path)
+        return path
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, 'thread'))
+                self._counts[';'.join(reversed(stack))] += 1
+
+
+sampling_profiler = SamplingProfiler()
+
+####################################
+
+# THE "TOGGLE_SAMPLING" FUNCTION AND THE SIGNAL HANDLER
+
+# 'toggle_sampling' starts the sampling profiler, or stops it and writes its stacks.
+# 'install_signal_handler' makes the SIGUSR1 signal call it. Signal handlers can only be installed
+# from the main thread, so it is done by the polling loop and by 'cli.py webhook', not by the gunicorn workers
+# (gunicorn uses SIGUSR1 itself; there, the admin endpoint, started by the first worker to bind ADMIN_PORT,
+# is the way to toggle the profiler of that worker, see 'start_admin_endpoint' in 'main.py').
+
+
+def toggle_sampling():
+    from settings import get_config
+
+    if sampling_profiler.running:
+        return sampling_profiler.stop(get_config().profile_dir)
+    sampling_profiler.start()
+    return None
+
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR1', None)):
+    if signum is None:
+        return False
+    # The work is done in a separate thread, because 'stop' waits for the sampling thread
+    signal.signal(signum, lambda *_: threading.Thread(target=toggle_sampling, daemon=True).start())
+    return True
+
+####################################
+
+# THE "SLOW_UPDATE_TRAP" CONTEXT MANAGER
+
+# Wraps the handling of one update (see 'process_update' in 'main.py'), from the polling loop or the webhook.
+
+
+_profiler_lock = threading.Lock()  # held while an update is profiled
+
+
+@contextmanager
+def slow_update_trap(update):
+    from settings import get_config
+
+    config = get_config()
+    started = time.perf_counter()
+    if not config.slow_update_seconds or not _profiler_lock.acquire(blocking=False):
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe('handle_message_seconds', elapsed)
+            if config.slow_update_seconds and elapsed >= config.slow_update_seconds:
+                metrics.increment('slow_updates')
+                metrics.increment('slow_updates_unprofiled')
+        return
+
+    try:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - started
+            metrics.observe('handle_message_seconds', elapsed)
+            if elapsed >= config.slow_update_seconds:
+                metrics.increment('slow_updates')
+                _save_slow_update(config.profile_dir, update, profiler, elapsed)
+    finally:
+        _profiler_lock.release()
+
+
+def _save_slow_update(directory, update, profiler, elapsed):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, 'slow-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), update.get('update_id', 'unknown')))
+        profiler.dump_stats(base + '.prof')
+        with open(base + '.json', 'w', encoding='utf-8') as update_file:
+            json.dump({'elapsed': elapsed, 'update': update}, update_file, ensure_ascii=False)
+        logger.error("Slow update (%.1fs), profile saved to %s.prof", elapsed, base)
+    except OSError as e:
+        logger.exception("Failed to save the profile of a slow update: {}".format(e))
@@ -0,0 +1,291 @@
+# "MYSHLENEK", the record-and-replay load generator
+# Usage: python replay.py traffic.rec [--speed 1|N|max] [--workers N] [--openai-latency S] [--openai-tokens N]
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# This script feeds the updates recorded by the traffic recorder (see 'traffic.py') back into the bot,
+# to reproduce production incidents and to measure the capacity of the bot with realistic arrival patterns.
+
+# The updates go through the same path as in production ('dispatch_update', the scheduler, 'handle_message'),
+# but the Telegram API and the OpenAI API are replaced with local stand-ins (see 'START_STAND_INS' below),
+# so the replay costs nothing and does not send anything to the Users.
+
+# The '--speed' option sets how fast the recording is replayed:
+# 1 keeps the original arrival times, N makes the gaps between the updates N times shorter,
+# and 'max' sends all the updates at once.
+
+# At the end the script prints the number of updates, the throughput,
+# and the percentiles of the time from the arrival of an update to the end of its handling.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import argparse
+import json
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from metrics import percentile
+from traffic import read_traffic
+
+####################################
+
+# THE "START_STAND_INS" FUNCTION
+
+# Starts a local HTTP server that answers like the Telegram API and the OpenAI API:
+# - '/bot<token>/sendMessage' and '/bot<token>/getUpdates' return an empty successful result;
+# - '/v1/completions' returns 'openai_tokens' pieces of text over 'openai_latency' seconds,
+#   as a stream of server-sent events if the request asks for a stream, or as one JSON answer otherwise;
+#   a smaller 'max_tokens' of the request cuts the answer (and its time), with the 'finish_reason' 'length'.
+#   While the 'server.openai_statuses' list is not empty, a request to '/v1/completions' takes its first status
+#   and gets only that status back (for example 429 or 503, with 'Retry-After: 0'), to check the retries.
+# Returns the server and its base URL. The counters of the requests are in 'server.counters',
+# and the chat ID and the text of every sent message in the 'server.sent' list.
+# For the checks (see 'conftest.py'), every answer of '/v1/completions' puts its prompt into
+# the 'server.completions_started' queue when it starts (a stream after its first piece of text),
+# and waits there while the 'server.gate' event is cleared, so a check can hold a generation
+# in the middle of its answer without sleeping.
+
+
+def start_stand_ins(openai_latency=1.0, openai_tokens=50, openai_statuses=()):
+    counters = {'sendMessage': 0, 'getUpdates': 0, 'completions': 0}
+    counters_lock = threading.Lock()
+    statuses = list(openai_statuses)
+    sent = []
+    completions_started = queue.Queue()
+    gate = threading.Event()
+    gate.set()
+
+    class StandInHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def _count(self, name):
+            with counters_lock:
+                counters[name] += 1
+
+        def _send_json(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _read_body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def do_GET(self):
+            if self.path.split('?')[0].endswith('/getUpdates'):
+                self._count('getUpdates')
+                self._send_json({'ok': True, 'result': []})
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            body = self._read_body()
+            path = self.path.split('?')[0]
+            if path.endswith('/sendMessage'):
+                self._count('sendMessage')
+                query = parse_qs(self.path.partition('?')[2])
+                with counters_lock:
+                    sent.append((query.get('chat_id', [''])[0], query.get('text', [''])[0]))
+                self._send_json({'ok': True, 'result': {}})
+            elif path.endswith('/completions'):
+                self._count('completions')
+                request = json.loads(body or b'{}')
+                with counters_lock:
+                    status = statuses.pop(0) if statuses else None
+                if status is not None:
+                    completions_started.put(request.get('prompt', ''))
+                    gate.wait()
+                    self._fail(status)
+                else:
+                    self._complete(request)
+            else:
+                self.send_error(404)
+
+        def _fail(self, status):
+            body = json.dumps({'error': {'message': 'stand-in status {}'.format(status)}}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _complete(self, request):
+            delay = openai_latency / max(openai_tokens, 1)
+            tokens = min(openai_tokens, request.get('max_tokens') or openai_tokens)
+            finish_reason = 'length' if tokens < openai_tokens else 'stop'
+            if not request.get('stream'):
+                completions_started.put(request.get('prompt', ''))
+                gate.wait()
+                time.sleep(delay * tokens)
+                self._send_json({'choices': [{'text': ' word' * tokens, 'finish_reason': finish_reason}],
+                                 'usage': {'prompt_tokens': len(request.get('prompt', '')) // 4,
+                                           'completion_tokens': tokens}})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            try:
+                for token in range(tokens - 1):
+                    time.sleep(delay)
+                    self.wfile.write(b'data: {"choices":[{"text":" word"}]}\n\n')
+                    self.wfile.flush()
+                    if token == 0:
+                        completions_started.put(request.get('prompt', ''))
+                        gate.wait()
+                time.sleep(delay)
+                self.wfile.write('data: {{"choices":[{{"text":" word","finish_reason":"{}"}}]}}\n\n'.format(finish_reason).encode())
+                if (request.get('stream_options') or {}).get('include_usage'):
+                    usage = {'prompt_tokens': len(request.get('prompt', '')) // 4, 'completion_tokens': tokens}
+                    self.wfile.write(b'data: ' + json.dumps({'choices': [], 'usage': usage}).encode() + b'\n\n')
+                self.wfile.write(b'data: [DONE]\n\n')
+            except OSError:
+                # The bot closed the stream (the generation was cancelled)
+                pass
+            self.close_connection = True
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    server.counters = counters
+    server.openai_statuses = statuses
+    server.sent = sent
+    server.completions_started = completions_started
+    server.gate = gate
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_port)
+
+####################################
+
+# THE "LOAD_BOT" FUNCTION
+
+# Points the bot at the stand-ins and imports it. The bot keeps its files (logs, caches, conversations)
+# in a temporary directory, so the replay does not touch the files of the production bot.
+
+
+def load_bot(base_url, workers=None, verbose=False):
+    os.environ.update({
+        'TELEGRAM_API_URL': base_url,
+        'OPENAI_API_URL': base_url,
+        'TELEGRAM_API_KEY': 'replay',
+        'OPENAI_API_KEY': 'replay',
+        'CHAT_ID': '0',
+    })
+    os.environ.pop('TRAFFIC_RECORD_FILE', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix='myshlenek-replay-'))
+
+    import main as bot
+    from scheduler import Scheduler
+
+    bot.configure_logging(console=verbose)
+    if workers:
+        bot.set_component('scheduler', Scheduler(workers))
+    return bot
+
+####################################
+
+# THE "RUN_REPLAY" FUNCTION
+
+# Feeds the recorded updates to 'bot.dispatch_update' at the given speed ('None' means the maximum speed)
+# and waits until all of them are handled. Returns the statistics as a dictionary.
+
+
+def run_replay(bot, records, speed=1.0):
+    latencies = []
+    latencies_lock = threading.Lock()
+    futures = []
+
+    def on_done(arrived):
+        def callback(_):
+            with latencies_lock:
+                latencies.append(time.perf_counter() - arrived)
+        return callback
+
+    first_arrival = records[0][0] if records else 0.0
+    started = time.perf_counter()
+    for recorded_at, _, update in records:
+        if speed:
+            wait = started + (recorded_at - first_arrival) / speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        arrived = time.perf_counter()
+        future = bot.dispatch_update(update)
+        if future is not None:
+            future.add_done_callback(on_done(arrived))
+            futures.append(future)
+
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'updates': len(records),
+        'handled': len(latencies),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+####################################
+
+# THE "MAIN" FUNCTION
+
+
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("the speed must be positive or 'max'")
+    return speed
+
+
+def build_parser(parser=None):
+    parser = parser or argparse.ArgumentParser(description="Replay recorded Telegram updates against local stand-ins")
+    parser.add_argument('file', help="the file written by the traffic recorder")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="1 (real time), N (N times faster) or 'max'")
+    parser.add_argument('--workers', type=int, default=None, help="the number of concurrency slots of the bot")
+    parser.add_argument('--openai-latency', type=float, default=1.0, help="seconds per answer of the OpenAI stand-in")
+    parser.add_argument('--openai-tokens', type=int, default=50, help="pieces of text per answer of the OpenAI stand-in")
+    parser.add_argument('--verbose', action='store_true', help="keep the log of the bot on the console")
+    return parser
+
+
+def main(args):
+    records = list(read_traffic(os.path.abspath(args.file)))
+    server, base_url = start_stand_ins(args.openai_latency, args.openai_tokens)
+    bot = load_bot(base_url, args.workers, args.verbose)
+    try:
+        stats = run_replay(bot, records, args.speed)
+    finally:
+        server.shutdown()
+
+    print("Updates: {updates}, handled: {handled}, time: {seconds:.2f}s, throughput: {throughput:.2f}/s".format(**stats))
+    print("Latency: p50 {p50:.3f}s, p95 {p95:.3f}s, p99 {p99:.3f}s, max {max:.3f}s".format(**stats))
+    print("Stand-in requests: {}".format(server.counters))
+    return stats
+
+
+if __name__ == '__main__':
+    main(build_parser().parse_args())
@@ -0,0 +1,213 @@
+# "MYSHLENEK", the resilient OpenAI requests
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# A single failed request to the OpenAI API used to cost the User the whole answer: a brief 502 or a 429
+# became "Seems, something happened, sorry.", and a connection error gave no answer at all.
+
+# 'post' sends the request of 'generate_response' with:
+# 1. the deadlines: the connect timeout and the read timeout of every attempt (see 'settings.py'),
+#    and the 'DEADLINE' of the whole call ('openai_total_timeout'), which covers the retries, the backoff
+#    and the reading of the streamed answer (see 'read_completion_stream' in 'main.py');
+# 2. the retries: a connection error, a timeout, or the status 429, 500, 502, 503 or 504 is retried
+#    up to 'openai_max_retries' times. Before every retry the function waits for the time given by the
+#    'Retry-After' header of the response, or otherwise for a random time ("full jitter") of up to
+#    'openai_backoff_seconds', doubled after every attempt and never more than 'openai_backoff_max_seconds',
+#    so the retries of many chats do not hit the API at the same moment. No retry is made if the wait
+#    would pass the deadline; the wait ends at once if the generation is cancelled;
+# 3. the hedging (if 'openai_hedge_percentile' is set, for example 95): if the response has not come
+#    after that percentile of the recent response times, the same request is sent a second time,
+#    and the first response to come wins. The other one is closed as soon as it comes, which stops
+#    its streamed answer, so the extra cost is small. The response time is the time until the status
+#    and the headers of the response (the waiting in the queues of the API and the connection),
+#    not the time of the streamed answer, which a second request would not make shorter.
+
+# The retries and the hedged requests are counted in the metrics ('openai.retries', 'openai.hedged',
+# 'openai.hedge_won'), and the response times are the 'openai.response_seconds' timing.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import email.utils
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+HEDGE_MIN_SAMPLES = 20  # the hedging starts when that many response times are known
+HEDGE_MIN_SECONDS = 0.05
+
+####################################
+
+# THE "DEADLINE" CLASS
+
+# The time by which the whole call must be over; None seconds means no deadline.
+# 'check' raises 'DEADLINE_EXCEEDED' once it has passed.
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds if seconds else None
+
+    def remaining(self):
+        if self.expires is None:
+            return float('inf')
+        return max(self.expires - time.monotonic(), 0.0)
+
+    def check(self):
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise DeadlineExceeded("the deadline of {}s passed".format(self.seconds))
+
+####################################
+
+# THE BACKOFF
+
+# The wait asked for by the 'Retry-After' header (seconds, or an HTTP date), or None
+
+
+def retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def backoff_delay(attempt, base, cap):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+####################################
+
+# THE "POST" FUNCTION
+
+# Returns the response of the last attempt: a successful one, one with a status that is not retried,
+# or the last failed one. Raises the error of the last attempt if it got no response at all,
+# 'DEADLINE_EXCEEDED' if the deadline passed, and 'GENERATION_CANCELLED' if the generation was cancelled
+# during a wait. 'config' gives the timeouts and the retry settings (see 'settings.py').
+
+
+def post(session, url, data, headers, config, deadline, cancel_token=None):
+    import requests
+
+    attempt = 0
+    while True:
+        deadline.check()
+        timeout = (config.openai_connect_timeout, min(config.openai_read_timeout, deadline.remaining()))
+
+        def send():
+            started = time.monotonic()
+            response = session.post(url, data=data, headers=headers, stream=True, timeout=timeout)
+            metrics.observe('openai.response_seconds', time.monotonic() - started)
+            return response
+
+        response = None
+        try:
+            response = _send_hedged(send, config.openai_hedge_percentile)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            failure = e
+            delay = None
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            failure = "status code {}".format(response.status_code)
+            delay = retry_after(response)
+
+        if attempt >= config.openai_max_retries:
+            return _give_up(response, failure)
+        if delay is None:
+            delay = backoff_delay(attempt, config.openai_backoff_seconds, config.openai_backoff_max_seconds)
+        if delay >= deadline.remaining():
+            return _give_up(response, failure)
+        if response is not None:
+            response.close()
+
+        attempt += 1
+        metrics.increment('openai.retries')
+        logger.error("Retrying the OpenAI request in %.2fs (retry %d of %d): %s",
+                     delay, attempt, config.openai_max_retries, failure)
+        if cancel_token is not None:
+            cancel_token.wait(delay)
+            cancel_token.raise_if_cancelled()
+        else:
+            time.sleep(delay)
+
+
+def _give_up(response, failure):
+    if response is not None:
+        return response
+    raise failure
+
+####################################
+
+# THE HEDGING
+
+# Runs 'send' and, if it has not returned after the hedging delay, runs it once more in parallel;
+# returns the first successful response, or the result of the first attempt if none succeeded.
+
+
+def _send_hedged(send, hedge_percentile):
+    delay = None
+    if hedge_percentile:
+        delay = metrics.timing_percentile('openai.response_seconds', hedge_percentile, HEDGE_MIN_SAMPLES)
+    if delay is None:
+        return send()
+
+    first = _run_in_thread(send)
+    if wait([first], max(delay, HEDGE_MIN_SECONDS)).done:
+        return first.result()
+    metrics.increment('openai.hedged')
+    second = _run_in_thread(send)
+
+    pending = [first, second]
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().status_code == 200:
+                for other in (first, second):
+                    if other is not future:
+                        other.add_done_callback(_close_response)
+                if future is second:
+                    metrics.increment('openai.hedge_won')
+                return future.result()
+    # No attempt succeeded: the result of the first one is returned (or raised), the other one is closed
+    _close_response(second)
+    return first.result()
+
+
+def _run_in_thread(func):
+    future = Future()
+
+    def run():
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name='openai-hedge', daemon=True).start()
+    return future
+
+
+def _close_response(future):
+    if future.exception() is None:
+        future.result().close()
@@ -0,0 +1,222 @@
+# "MYSHLENEK", the generation scheduler
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The 'MAIN LOOP' used to call 'handle_message' directly, so while one answer was being generated
+# the bot could not even see the next update (for example, a '/stop' command).
+
+# The 'SCHEDULER' runs the work for each update on a small pool of worker threads
+# (the concurrency slots), and keeps one 'CancelToken' per chat for the work in flight:
+# - 'submit' cancels the previous work of the same chat (it is superseded) and queues the new one;
+# - 'cancel' cancels the work of a chat without queueing anything;
+# - the work of one chat runs strictly one after another (a lock per chat),
+#   so the conversation history of a chat is never updated by two workers at once;
+# - a work item that was cancelled while still waiting in the queue does not run at all,
+#   so it never holds a slot;
+# - the work runs in a copy of the context of 'submit', so the current trace of the update
+#   (see 'tracing.py') follows it into the worker;
+# - 'resize' changes the number of slots while the bot runs (see 'settings.py'): the new work goes
+#   to a new pool of the new size, and the old pool finishes the work already given to it and then stops;
+# - 'drain' waits for all the queued work to finish, for up to a deadline, then cancels the rest
+#   and stops the workers (see 'lifecycle.py');
+# - the queued work is not run in the order of arrival but by its 'priority', given to 'submit':
+#   the bot gives the chats that used fewer tokens lately a lower (better) number, so one heavy chat
+#   cannot keep all the slots busy while the others wait (see 'usage_ledger.py').
+#   The pool itself only gets a '_run_next' call for every submitted work, which takes the best work
+#   queued at that moment.
+
+# The 'RATE_LIMITER' counts the messages of each chat, so a chat sending too many of them
+# can be refused before its work is even queued.
+
+# Both keep a little state for every chat; 'forget_idle_chats' drops the state of the chats
+# that have nothing going on, and the memory accounting calls it regularly (see 'memory.py').
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import contextvars
+import heapq
+import itertools
+import logging
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from cancellation import CancelToken
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE "SCHEDULER" CLASS
+
+
+class Scheduler:
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generation')
+        self._lock = threading.Lock()
+        self._in_flight = {}  # chat_id -> CancelToken of the latest work of the chat
+        self._chat_locks = {}  # chat_id -> threading.Lock serializing the work of the chat
+        self._futures = set()  # the Futures of the work not finished yet, in all the pools
+        self._queue = []  # heap of the queued work: (priority, sequence number, chat_id, ...)
+        self._sequence = itertools.count()
+
+    # Queue 'func(*args, cancel_token=token)' for the chat, superseding its previous work.
+    # The work with the lowest 'priority' (a tuple) runs first; equal priorities run in order.
+    def submit(self, chat_id, func, *args, priority=()):
+        token = CancelToken()
+        future = Future()
+        context = contextvars.copy_context()
+        with self._lock:
+            previous = self._in_flight.get(chat_id)
+            self._in_flight[chat_id] = token
+            chat_lock = self._chat_locks.setdefault(chat_id, threading.Lock())
+        if previous is not None and previous.cancel("superseded"):
+            logger.info("Superseded the generation in flight for chat %s", chat_id)
+        with self._lock:
+            self.executor.submit(self._run_next)  # runs once the lock is released
+            heapq.heappush(self._queue, (priority, next(self._sequence), chat_id, chat_lock, token, func, args, future, context))
+            self._futures.add(future)
+        future.add_done_callback(self._forget)
+        return future
+
+    # Every 'submit' gives the pool one '_run_next', which runs the best work queued at that moment
+    def _run_next(self):
+        with self._lock:
+            _, _, chat_id, chat_lock, token, func, args, future, context = heapq.heappop(self._queue)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(context.run(self._run, chat_id, chat_lock, token, func, args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    # Cancel the work in flight for the chat; returns True if there was something to cancel
+    def cancel(self, chat_id, reason="stop"):
+        with self._lock:
+            token = self._in_flight.pop(chat_id, None)
+        return token is not None and token.cancel(reason)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    # Forget the locks of the chats with no work, so the dictionary does not grow with every chat ever seen;
+    # a lock that is held, or may be taken by queued work, is kept. Returns the number forgotten.
+    def forget_idle_chats(self):
+        with self._lock:
+            idle = [chat_id for chat_id, chat_lock in self._chat_locks.items()
+                    if chat_id not in self._in_flight and not chat_lock.locked()]
+            for chat_id in idle:
+                del self._chat_locks[chat_id]
+        return len(idle)
+
+    # The queued work and the per-chat state (see 'memory.py')
+    def memory_usage(self):
+        with self._lock:
+            return {
+                'bytes': sys.getsizeof(self._in_flight) + sys.getsizeof(self._chat_locks) + sys.getsizeof(self._futures),
+                'queued': len(self._futures),
+                'chats': len(self._chat_locks),
+            }
+
+    # Change the number of slots; the work already queued on the old pool still runs there
+    def resize(self, max_workers):
+        with self._lock:
+            if max_workers == self.max_workers:
+                return
+            old_executor = self.executor
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='generation')
+            self.max_workers = max_workers
+        old_executor.shutdown(wait=False)
+        logger.error("Scheduler resized to %d workers", max_workers)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    # Wait up to 'timeout' seconds for the queued work; returns the number of work items not finished
+    def wait_idle(self, timeout):
+        with self._lock:
+            futures = list(self._futures)
+        return len(wait(futures, timeout)[1])
+
+    # Wait up to 'timeout' seconds for the queued work, cancel what is left and stop the workers;
+    # returns the number of work items that had to be cancelled
+    def drain(self, timeout):
+        not_done = self.wait_idle(timeout)
+        with self._lock:
+            tokens = list(self._in_flight.values())
+            self._in_flight.clear()
+        for token in tokens:
+            token.cancel("shutdown")
+        self.executor.shutdown(wait=True)
+        if not_done:
+            logger.error("Drain deadline passed, cancelled %d unfinished work items", not_done)
+        return not_done
+
+    def _run(self, chat_id, chat_lock, token, func, args):
+        with chat_lock:
+            try:
+                # Work that was cancelled while queued never runs
+                if token.cancelled:
+                    logger.info("Skipped cancelled work for chat %s (%s)", chat_id, token.reason)
+                    return None
+                return func(*args, cancel_token=token)
+            except Exception as e:
+                logger.exception("Error handling update: {}".format(e))
+                return None
+            finally:
+                with self._lock:
+                    if self._in_flight.get(chat_id) is token:
+                        del self._in_flight[chat_id]
+
+####################################
+
+# THE "RATE_LIMITER" CLASS
+
+# A token bucket per chat: a chat may send 'limit' messages per minute, in bursts of up to 'limit'.
+# The limit is passed to every 'allow' call, so a new limit from the settings applies at once.
+# A limit of None (or zero) lets everything through.
+
+
+class RateLimiter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}  # chat_id -> [tokens left, time of the last refill]
+
+    def allow(self, chat_id, limit):
+        if not limit:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(chat_id, [float(limit), now])
+            bucket[0] = min(float(limit), bucket[0] + (now - bucket[1]) * limit / 60.0)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                return False
+            bucket[0] -= 1.0
+            return True
+
+    # Forget the buckets not used for a minute: they are full again, the same as a new bucket
+    def forget_idle_chats(self):
+        deadline = time.monotonic() - 60.0
+        with self._lock:
+            idle = [chat_id for chat_id, bucket in self._buckets.items() if bucket[1] <= deadline]
+            for chat_id in idle:
+                del self._buckets[chat_id]
+        return len(idle)
+
+    def memory_usage(self):
+        with self._lock:
+            bucket_bytes = sys.getsizeof([0.0, 0.0]) + 2 * sys.getsizeof(0.0)
+            return {'bytes': sys.getsizeof(self._buckets) + len(self._buckets) * bucket_bytes, 'chats': len(self._buckets)}
@@ -0,0 +1,432 @@
+# "MYSHLENEK", the semantic answer cache
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The Users ask the same TRIZ questions with different wording, so an exact-match cache would miss them.
+# This cache finds a previously answered question that is close enough to the new one,
+# and returns the stored answer instead of calling the OpenAI API again.
+
+# It consists of two parts:
+# 1. The 'HASHED_NGRAM_EMBEDDER', a local, offline embedder.
+#    It turns a text into a vector of fixed size by hashing its character n-grams (3, 4 and 5 characters)
+#    into buckets with a +1/-1 sign (the "hashing trick"). Everything is computed with NumPy,
+#    without a Python loop over the n-grams, and no model or network is needed.
+# 2. The 'SEMANTIC_CACHE', a brute-force matrix index.
+#    The vectors of the stored questions are the rows of one matrix, so a lookup is a single
+#    matrix-vector product (cosine similarity, because all the vectors are normalised).
+#    A stored answer is returned if the best similarity is at least 'threshold'.
+
+# The matrix is kept in a '.npy' file opened as a memory-mapped array, so it "loads" instantly
+# and is paged in by the operating system as needed. The questions and answers are appended
+# to a JSON lines file next to it. When the cache is full, the oldest slot is overwritten.
+
+# Several processes can share one cache directory (the workers of gunicorn, see 'wsgi.py'):
+# - a store takes the lock file of the directory ('lock', with 'fcntl.flock'), reads the entries the other
+#   processes appended since its last read, and only then picks the next slot, so two processes never
+#   write the same slot with their own counters;
+# - a lookup reads the new entries of the other processes first (only the complete lines), and re-embeds
+#   the stored question of the best slot to check that the vector still belongs to it: another process
+#   may have written the vector of a new entry and not yet its line;
+# - a file rewritten by the compaction (a new inode) is read again from the start.
+# Without 'fcntl' (on Windows) there is no lock, and the cache directory must not be shared.
+
+# Every answer belongs to a namespace (the bot that gave it, see 'settings.py'), and a lookup
+# only returns answers of its own namespace, so the bots share one cache without mixing their personas.
+# The default namespace is the empty string, which is not written to the file at all.
+
+# The similarity of the wording is not enough to reuse an answer, so every answer also has a key
+# ('cache_key'), and a lookup only returns the answers with the same key:
+# - the numbers of the question: "the 15th principle" and "the 16th principle" differ in one character,
+#   and are close in wording, but they are different questions;
+# - the context: a question asked in the middle of a conversation ("can you give an example of that?")
+#   is answered from that conversation, so its answer is kept for the same chat and the same recent turns
+#   only (see 'conversation_context'), and is never given to another chat. The first question
+#   of a conversation has no context, so its answer can be reused by every chat of the bot.
+# The key is a 64-bit hash, kept for every slot in the 'slot_keys' array.
+
+# The 'threshold' (see 'settings.py') was calibrated on the pairs at the end of this file, with 'calibrate':
+# the closest pair of different questions is about 0.88 similar, a paraphrase can be anything from 0.5 to 1.0,
+# so only the near-identical rewordings (0.93 and above) are reused. Run 'python semantic_cache.py'
+# to calibrate it again after changing the embedder.
+
+# The hit rate and the lookup latency are reported through 'metrics.py'.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE "HASHED_NGRAM_EMBEDDER" CLASS
+
+# 'dim' is the size of the vectors, 'ngram_sizes' are the lengths of the character n-grams.
+# The text is lowercased, and everything that is not a letter or a digit becomes a single space,
+# so punctuation and spacing do not change the vector.
+
+_NON_WORD = re.compile(r'[\W_]+')
+_MULTIPLIER = np.uint64(0x100000001B3)
+_MIX = np.uint64(0xFF51AFD7ED558CCD)
+
+
+class HashedNgramEmbedder:
+    def __init__(self, dim=1024, ngram_sizes=(3, 4, 5)):
+        self.dim = dim
+        self.ngram_sizes = tuple(ngram_sizes)
+        # The powers of the multiplier used to hash each n-gram size as a polynomial of its characters
+        self._powers = {
+            n: np.array([int(_MULTIPLIER) ** (n - 1 - k) % 2 ** 64 for k in range(n)], dtype=np.uint64)
+            for n in self.ngram_sizes
+        }
+
+    @staticmethod
+    def normalize(text):
+        return ' ' + _NON_WORD.sub(' ', text.lower()).strip() + ' '
+
+    def embed(self, text):
+        codes = np.frombuffer(self.normalize(text).encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+        vector = np.zeros(self.dim, dtype=np.float64)
+        with np.errstate(over='ignore'):
+            for n in self.ngram_sizes:
+                if len(codes) < n:
+                    continue
+                # One hash per n-gram: the polynomial of its characters, then a multiplicative mix
+                hashes = (sliding_window_view(codes, n) * self._powers[n]).sum(axis=1, dtype=np.uint64)
+                hashes = (hashes + np.uint64(n)) * _MIX
+                hashes ^= hashes >> np.uint64(29)
+                buckets = (hashes % np.uint64(self.dim)).astype(np.intp)
+                signs = np.where(hashes >> np.uint64(63), -1.0, 1.0)
+                vector += np.bincount(buckets, weights=signs, minlength=self.dim)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.astype(np.float32)
+
+####################################
+
+# THE "CACHE_KEY" AND "CONVERSATION_CONTEXT" FUNCTIONS
+
+# 'cache_key' returns the key of a question: a hash of its numbers and of its context (an int64).
+# 'conversation_context' returns the context of a question asked in the chat 'scope':
+# nothing at the start of a conversation, otherwise the chat and the last 'chars' characters of its history.
+
+_NUMBERS = re.compile(r'\d+')
+CONTEXT_CHARS = 2000
+
+
+def cache_key(prompt, context=''):
+    numbers = ' '.join(number.lstrip('0') or '0' for number in _NUMBERS.findall(prompt))
+    digest = hashlib.blake2b((numbers + '\n' + context).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def conversation_context(scope, history, chars=CONTEXT_CHARS):
+    history = history.strip()
+    if not history:
+        return ''
+    return '{}\n{}'.format(scope, history[-chars:])
+
+####################################
+
+# THE "SEMANTIC_CACHE" CLASS
+
+# 'path' is the directory of the cache files ('vectors.npy' and 'entries.jsonl'),
+# 'capacity' is the maximum number of stored answers, 'threshold' is the minimal cosine similarity of a hit,
+# and 'min_chars' is the minimal length of a question worth caching (short follow-ups like "and why?"
+# depend on the conversation, not on their wording, so they are never looked up).
+# The namespace of each slot is kept as a small number in the 'slot_namespaces' array, and its key
+# in the 'slot_keys' array, so filtering by namespace and by key is one vectorised comparison each.
+
+
+class SemanticCache:
+    def __init__(self, path, capacity=10000, threshold=0.93, min_chars=24, embedder=None):
+        self.path = path
+        self.capacity = capacity
+        self.threshold = threshold
+        self.min_chars = min_chars
+        self.embedder = embedder or HashedNgramEmbedder()
+        self._lock = threading.Lock()
+        self._lookups = 0
+        self._hits = 0
+
+        os.makedirs(path, exist_ok=True)
+        self._vectors_path = os.path.join(path, 'vectors.npy')
+        self._entries_path = os.path.join(path, 'entries.jsonl')
+        self._lock_path = os.path.join(path, 'lock')
+        self._namespace_ids = {'': 0}  # namespace -> its number in 'slot_namespaces'
+        self._clear()
+        with self._file_lock():
+            self.vectors = self._open_vectors()
+            lines = self._read_entries()
+            # Rewrite the file if overwritten slots make it much larger than needed
+            if lines > 2 * self.capacity:
+                self._compact()
+
+    # Forgets the entries read so far
+    def _clear(self):
+        self.entries = [None] * self.capacity  # slot -> (prompt, answer, namespace, key)
+        self.slot_namespaces = np.zeros(self.capacity, dtype=np.int32)
+        self.slot_keys = np.zeros(self.capacity, dtype=np.int64)
+        self._written = 0  # the number of entries ever written (by all the processes)
+        self._entries_offset = 0  # the bytes of 'entries.jsonl' read so far
+        self._entries_inode = None
+
+    # The lock of the cache directory, shared by all the processes that use it
+    @contextlib.contextmanager
+    def _file_lock(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _open_vectors(self):
+        shape = (self.capacity, self.embedder.dim)
+        if os.path.exists(self._vectors_path):
+            vectors = np.load(self._vectors_path, mmap_mode='r+')
+            if vectors.shape == shape and vectors.dtype == np.float32:
+                return vectors
+            logger.error("Semantic cache %s has a different shape, it is rebuilt", self._vectors_path)
+            del vectors
+            if os.path.exists(self._entries_path):
+                os.remove(self._entries_path)
+        return np.lib.format.open_memmap(self._vectors_path, mode='w+', dtype=np.float32, shape=shape)
+
+    # Reads the entries appended since the last read, by this process or another one;
+    # a later entry of the same slot overwrites the earlier one. Returns the number of lines read.
+    def _read_entries(self):
+        try:
+            status = os.stat(self._entries_path)
+        except FileNotFoundError:
+            return 0
+        if status.st_ino == self._entries_inode and status.st_size == self._entries_offset:
+            return 0
+        with open(self._entries_path, 'rb') as entries_file:
+            inode = os.fstat(entries_file.fileno()).st_ino
+            if inode != self._entries_inode:
+                # A new file (the first read, or the file was compacted): read it from the start
+                self._clear()
+                self._entries_inode = inode
+            entries_file.seek(self._entries_offset)
+            data = entries_file.read()
+        # A line that is still being written is read the next time
+        end = data.rfind(b'\n') + 1
+        lines = 0
+        for line in data[:end].splitlines():
+            lines += 1
+            try:
+                entry = json.loads(line)
+                slot = entry['slot']
+                namespace = entry.get('namespace', '')
+                # The entries written before the keys existed had no context
+                key = entry.get('key', cache_key(entry['prompt']))
+                self.entries[slot] = (entry['prompt'], entry['answer'], namespace, key)
+            except (ValueError, KeyError, IndexError, TypeError):
+                continue
+            self.slot_namespaces[slot] = self._namespace_id(namespace)
+            self.slot_keys[slot] = key
+            self._written = max(self._written, entry['n'] + 1)
+        self._entries_offset += end
+        return lines
+
+    def _compact(self):
+        written = self._written
+        temporary_path = self._entries_path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as entries_file:
+            for slot, entry in enumerate(self.entries):
+                if entry is None:
+                    continue
+                # Keep the original write number of the slot, so the order of overwriting is preserved
+                n = written - ((written - 1 - slot) % self.capacity) - 1
+                entries_file.write(self._format_entry(n, slot, *entry))
+        os.replace(temporary_path, self._entries_path)
+        status = os.stat(self._entries_path)
+        self._entries_inode = status.st_ino
+        self._entries_offset = status.st_size
+
+    def _namespace_id(self, namespace):
+        return self._namespace_ids.setdefault(namespace, len(self._namespace_ids))
+
+    @staticmethod
+    def _format_entry(n, slot, prompt, answer, namespace='', key=0):
+        entry = {'n': n, 'slot': slot, 'prompt': prompt, 'answer': answer, 'key': key}
+        if namespace:
+            entry['namespace'] = namespace
+        return json.dumps(entry, ensure_ascii=False) + '\n'
+
+    def cacheable(self, prompt):
+        return len(prompt.strip()) >= self.min_chars
+
+    # Returns the stored answer of the closest question in the namespace with the same key, or None;
+    # 'context' is the context of the question (see 'conversation_context')
+    def lookup(self, prompt, namespace='', context=''):
+        if not self.cacheable(prompt):
+            return None
+        started = time.perf_counter()
+        vector = self.embedder.embed(prompt)
+        key = cache_key(prompt, context)
+        with self._lock:
+            self._read_entries()
+            answer = None
+            size = min(self._written, self.capacity)
+            namespace_id = self._namespace_ids.get(namespace)
+            if size and namespace_id is not None:
+                similarities = self.vectors[:size] @ vector
+                similarities[self.slot_keys[:size] != key] = -1.0
+                if len(self._namespace_ids) > 1:
+                    similarities[self.slot_namespaces[:size] != namespace_id] = -1.0
+                best = int(np.argmax(similarities))
+                entry = self.entries[best]
+                if similarities[best] >= self.threshold and entry is not None:
+                    if self._belongs(entry[0], best):
+                        answer = entry[1]
+                        logger.info("Semantic cache hit (similarity %.3f): %s", similarities[best], entry[0])
+                    else:
+                        metrics.increment('semantic_cache.stale_slots')
+            self._lookups += 1
+            if answer is not None:
+                self._hits += 1
+            hit_rate = self._hits / self._lookups
+        metrics.observe('semantic_cache.lookup_seconds', time.perf_counter() - started)
+        metrics.increment('semantic_cache.lookups')
+        if answer is not None:
+            metrics.increment('semantic_cache.hits')
+        metrics.set_gauge('semantic_cache.hit_rate', hit_rate)
+        return answer
+
+    def store(self, prompt, answer, namespace='', context=''):
+        if not self.cacheable(prompt) or not answer:
+            return
+        vector = self.embedder.embed(prompt)
+        key = cache_key(prompt, context)
+        with self._lock, self._file_lock():
+            # The entries of the other processes first, so the slot is the next one of all the processes
+            self._read_entries()
+            n = self._written
+            slot = n % self.capacity
+            self.vectors[slot] = vector
+            with open(self._entries_path, 'a', encoding='utf-8') as entries_file:
+                entries_file.write(self._format_entry(n, slot, prompt, answer, namespace, key))
+            self._read_entries()
+            size = min(self._written, self.capacity)
+        metrics.increment('semantic_cache.stores')
+        metrics.set_gauge('semantic_cache.size', size)
+
+    # Checks that the vector of the slot is the vector of its stored question
+    def _belongs(self, prompt, slot):
+        return float(self.embedder.embed(prompt) @ self.vectors[slot]) >= 0.999
+
+    # The memory of the cache (see 'memory.py'): the entries are on the heap,
+    # the vectors are a file mapped into memory (the system can drop and reload their pages)
+    def memory_usage(self):
+        with self._lock:
+            entries = list(self.entries)
+        size = sys.getsizeof(entries) + self.slot_namespaces.nbytes + self.slot_keys.nbytes
+        for entry in entries:
+            if entry is not None:
+                size += sys.getsizeof(entry) + sum(sys.getsizeof(item) for item in entry)
+        return {'bytes': size, 'mapped_bytes': self.vectors.nbytes, 'entries': len(entries) - entries.count(None)}
+
+    def flush(self):
+        with self._lock:
+            self.vectors.flush()
+
+####################################
+
+# THE CALIBRATION
+
+# 'calibrate' measures the similarity of the pairs of questions that mean the same ('paraphrases')
+# and of the pairs that do not ('distinct'), and returns the lowest threshold that keeps every distinct pair
+# with the same key at least 'margin' below it, with the share of the paraphrases it still reuses.
+# The pairs below are the questions the Users ask the bot, reworded the way they reword them.
+
+PARAPHRASE_PAIRS = [
+    ("What is TRIZ?", "what is triz"),
+    ("What is TRIZ?", "What's TRIZ?"),
+    ("Who invented TRIZ?", "Who is the inventor of TRIZ?"),
+    ("What is an ideal final result in TRIZ?", "What is the ideal final result in TRIZ"),
+    ("Explain the contradiction matrix of TRIZ", "Can you explain the TRIZ contradiction matrix?"),
+    ("What are the 40 inventive principles?", "What are the 40 inventive principles of TRIZ?"),
+    ("What is a technical contradiction?", "What is a technical contradiction in TRIZ?"),
+    ("What is the difference between a technical and a physical contradiction?",
+     "What's the difference between technical and physical contradictions?"),
+    ("What is the 15th inventive principle of TRIZ?", "What is the 15th inventive principle in TRIZ?"),
+    ("How do I resolve a physical contradiction?", "How can I resolve a physical contradiction?"),
+    ("What is su-field analysis?", "What is Su-Field analysis in TRIZ?"),
+    ("Explain the principle of segmentation", "Please explain the segmentation principle"),
+    ("Explain the principle of the other way round", "Explain the principle of the other way around"),
+    ("Tell me about the laws of technical systems evolution", "Tell me about the laws of evolution of technical systems"),
+    ("Что такое ТРИЗ?", "Что такое ТРИЗ"),
+    ("Кто придумал ТРИЗ?", "Кто придумал ТРИЗ"),
+    ("Что такое идеальный конечный результат?", "что такое идеальный конечный результат в ТРИЗ?"),
+]
+
+DISTINCT_PAIRS = [
+    ("What is the 15th inventive principle of TRIZ?", "What is the 16th inventive principle of TRIZ?"),
+    ("Explain the 35th inventive principle", "Explain the 36th inventive principle"),
+    ("What is a technical contradiction?", "What is a physical contradiction?"),
+    ("What is the ideal final result?", "What is the ideal system?"),
+    ("Explain the principle of segmentation", "Explain the principle of extraction"),
+    ("What is the principle of local quality in TRIZ?", "What is the principle of universality in TRIZ?"),
+    ("How do I resolve a physical contradiction?", "How do I formulate a physical contradiction?"),
+    ("How can the principle of dynamics be applied to a bicycle?", "How can the principle of dynamics be applied to a car?"),
+    ("What is the difference between a technical contradiction and an administrative contradiction?",
+     "What is the difference between a technical contradiction and a physical contradiction?"),
+    ("Give me an example of the principle of segmentation", "Give me an example of the principle of asymmetry"),
+    ("Give me an example of the principle of segmentation in software development",
+     "Give me an example of the principle of segmentation in mechanical engineering"),
+    ("Explain the contradiction matrix of TRIZ", "Explain the ARIZ algorithm of TRIZ"),
+    ("What is su-field analysis?", "What is function analysis?"),
+    ("Что такое техническое противоречие?", "Что такое физическое противоречие?"),
+    ("Объясни принцип дробления", "Объясни принцип вынесения"),
+]
+
+
+def calibrate(paraphrases=PARAPHRASE_PAIRS, distinct=DISTINCT_PAIRS, margin=0.05, embedder=None):
+    embedder = embedder or HashedNgramEmbedder()
+
+    def similarity(first, second):
+        if cache_key(first) != cache_key(second):
+            return -1.0  # never reused, whatever the wording
+        return float(embedder.embed(first) @ embedder.embed(second))
+
+    closest_distinct = max(similarity(first, second) for first, second in distinct)
+    threshold = min(round(closest_distinct + margin, 2), 1.0)
+    similarities = [similarity(first, second) for first, second in paraphrases]
+    return {
+        'threshold': threshold,
+        'closest_distinct': closest_distinct,
+        'paraphrases_reused': sum(value >= threshold for value in similarities) / len(similarities),
+    }
+
+
+if __name__ == '__main__':
+    print(calibrate())
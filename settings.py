@@ -1,6 +1,340 @@
+# "MYSHLENEK", the settings
+# Used by all the parts of the bot
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# All the settings of the bot are kept in one 'CONFIG' object, created the first time 'get_config'
+# is called (not at import time). Every part of the bot calls 'get_config' when it needs a value,
+# so a new configuration takes effect everywhere at once.
+
+# The values come from (each one overriding the previous):
+# 1. the defaults of the 'CONFIG' class below;
+# 2. the environment variables (the field name in upper case, for example POLL_INTERVAL);
+# 3. the JSON file named by the 'config_file' setting ('config.json' by default), if it exists;
+# 4. the overrides sent to the admin endpoint (see 'admin.py').
+
+# Importing this module does nothing but define the class and the functions,
+# so it can be imported by any script or tool at no cost.
+
+####################################
+
+# THE RELOADING
+
+# 'reload_config' reads the environment and the file again and builds a new 'CONFIG' object.
+# If any value is invalid, a 'ValueError' is raised and the running configuration is kept as it was.
+# Otherwise the new object replaces the old one in a single assignment, so no part of the bot
+# ever sees a mix of old and new values, and the functions registered with 'on_reload' are called
+# to apply the changes to the running components (for example the number of workers of the scheduler).
+
+# The polling loop and the webhook server of 'cli.py' reload the configuration on the SIGHUP signal,
+# and the admin endpoint on request, so the bot can be tuned under load without a restart.
+
+####################################
+
+# THE BOTS
+
+# One process can host several Telegram bots (for example, with different personas). They are described
+# by the 'bots' setting, a JSON object mapping the name of each bot to its own values:
+#   {"tutor": {"telegram_api_key": "...", "prompt": "You are a patient TRIZ tutor.", "max_tokens": 800}}
+# Every value of a bot that is not given is taken from the common settings (see the 'BOT' class).
+# The bot of the common 'telegram_api_key' and 'chat_id' is always there, as the 'default' bot,
+# so a configuration with one bot does not change at all.
+# The bots share everything else: the workers, the HTTP connections, the caches and the stores.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import json
+import logging
 import os
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-TELEGRAM_API_KEY = os.getenv('TELEGRAM_API_KEY')
-CHAT_ID = os.getenv('CHAT_ID')
-API_HASH = os.getenv('API_HASH')
-API_ID = os.getenv('API_ID')
+import threading
+from dataclasses import dataclass, fields, replace, asdict
+
+logger = logging.getLogger(__name__)
+
+####################################
+
+# THE "CONFIG" CLASS
+
+# The fields, their types and their default values.
+# An empty value, or zero for the optional features (see OPTIONAL_FIELDS), means "turned off" (None).
+
+
+@dataclass(frozen=True)
+class Config:
+    # The API keys and the chat of the bot
+    openai_api_key: str = None
+    telegram_api_key: str = None
+    chat_id: str = None
+    api_hash: str = None
+    api_id: str = None
+
+    # The API base URLs (they are changed by 'replay.py' to point to local stand-ins)
+    telegram_api_url: str = 'https://api.telegram.org'
+    openai_api_url: str = 'https://api.openai.com'
+
+    # The files and directories of the bot
+    config_file: str = 'config.json'
+    log_file: str = 'error.log'
+    log_format: str = 'text'  # 'text', or 'json' for one JSON object per line (see 'log_analyzer.py')
+    semantic_cache_dir: str = 'semantic_cache'
+    knowledge_dir: str = 'knowledge'
+    knowledge_index_dir: str = 'knowledge_index'
+    conversation_dir: str = 'conversations'
+    profile_dir: str = 'profiles'
+    trace_file: str = 'traces.jsonl'
+    traffic_record_file: str = None
+    offset_file: str = 'update_offset.json'
+    usage_file: str = 'usage.bin'
+
+    # The polling, the concurrency and the rate limit
+    poll_interval: float = 12.0
+    max_concurrent_generations: int = 4
+    rate_limit_per_minute: int = None  # messages per chat per minute
+    metrics_log_interval: float = 600.0
+    drain_seconds: float = 60.0  # how long the generations in flight may take to finish on SIGTERM
+    conversation_idle_seconds: float = 1800.0
+
+    # The bots hosted by the process besides the default one (see 'THE BOTS' above)
+    bots: dict = None
+
+    # The model and its routing: 'model_routes' maps a chat ID to the model used for that chat
+    openai_model: str = 'gpt-4-1106-preview'
+    model_routes: dict = None
+    max_tokens: int = 2200
+    temperature: float = 0.9
+    # The 'max_tokens' of the quick questions and of the explanations (see 'output_length.py');
+    # zero means the 'max_tokens' of the bot
+    quick_max_tokens: int = 300
+    explanation_max_tokens: int = 900
+
+    # The timeouts, in seconds
+    telegram_timeout: float = 30.0
+    openai_connect_timeout: float = 10.0
+    openai_read_timeout: float = 60.0
+    openai_total_timeout: float = 180.0  # the whole OpenAI call, with the retries and the streamed answer
+
+    # The retries of the OpenAI requests (see 'resilience.py'): how many, the first backoff and the longest one,
+    # and the percentile of the response time after which a second (hedged) request is sent (None: never)
+    openai_max_retries: int = 2
+    openai_backoff_seconds: float = 0.5
+    openai_backoff_max_seconds: float = 8.0
+    openai_hedge_percentile: float = None
+
+    # The token budgets (see 'usage_ledger.py'): the tokens a chat may use in the rolling window
+    # ('usage_window_seconds' takes effect after a restart), and for the chats over it,
+    # the 'max_tokens' of the answers and the model (None: the usual ones)
+    usage_window_seconds: float = 3600.0
+    chat_token_budget: int = None
+    over_budget_max_tokens: int = None
+    over_budget_model: str = None
+
+    # The caches and the retrieval ('semantic_cache_capacity' takes effect after a restart)
+    semantic_cache_capacity: int = 10000
+    semantic_cache_threshold: float = 0.93  # calibrated, see 'semantic_cache.py'
+    knowledge_top_k: int = 3
+    knowledge_token_budget: int = 600
+
+    # The profiling, the tracing and the admin endpoint
+    slow_update_seconds: float = None
+    trace_slow_seconds: float = 10.0
+    trace_sample_rate: float = 0.01
+    admin_port: int = None
+
+    # The memory accounting (see 'memory.py'): how often the memory is measured, the resident size
+    # above which the bot evicts what it can, the largest history a chat may keep in memory,
+    # and the number of frames tracemalloc keeps per allocation (zero: tracemalloc is off)
+    memory_sample_interval: float = 60.0
+    memory_high_water_mb: float = None
+    memory_chat_max_kb: float = None
+    memory_trace_frames: int = 0
+
+    def model_for(self, chat_id, bot=None):
+        default = bot.openai_model if bot is not None else self.openai_model
+        return (self.model_routes or {}).get(str(chat_id), default)
+
+    def bot(self, name=None):
+        bot = (self.bots or {}).get(name or DEFAULT_BOT)
+        if bot is None:
+            raise ValueError("Unknown bot: {}".format(name))
+        return bot
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        values = {}
+        for field in fields(cls):
+            raw = environ.get(field.name.upper())
+            if raw is not None:
+                values[field.name] = raw
+        return cls.from_values(values)
+
+    # Builds a configuration from raw values (strings from the environment, or JSON values),
+    # converting them to the types of the fields; raises 'ValueError' on an unknown field or a bad value
+    @classmethod
+    def from_values(cls, values, base=None):
+        types = {field.name: field.type for field in fields(cls)}
+        converted = {}
+        for name, raw in values.items():
+            if name not in types:
+                raise ValueError("Unknown setting: {}".format(name))
+            converted[name] = _convert(name, types[name], raw)
+        return replace(base or cls(), **converted)
+
+
+####################################
+
+# THE "BOT" CLASS
+
+# The values of one bot. The ones left out in the 'bots' setting are taken from the common settings
+# when the configuration is loaded, so a 'BOT' object always has all of them.
+# 'prompt' is the persona of the bot, put in front of every prompt sent to the model.
+
+DEFAULT_BOT = 'default'
+
+
+@dataclass(frozen=True)
+class Bot:
+    name: str
+    telegram_api_key: str = None
+    chat_id: str = None
+    openai_model: str = None
+    prompt: str = None
+    max_tokens: int = None
+    temperature: float = None
+    rate_limit_per_minute: int = None
+
+    @property
+    def is_default(self):
+        return self.name == DEFAULT_BOT
+
+
+def _resolve_bots(config):
+    raw_bots = dict(config.bots or {})
+    if DEFAULT_BOT not in raw_bots:
+        raw_bots[DEFAULT_BOT] = {}
+    types = {field.name: field.type for field in fields(Bot)}
+    bots = {}
+    for name, raw in raw_bots.items():
+        if not isinstance(raw, dict):
+            raise ValueError("The settings of the bot {} must be a JSON object".format(name))
+        values = {}
+        for field_name in types:
+            if field_name == 'name':
+                continue
+            value = _convert(field_name, types[field_name], raw.get(field_name))
+            values[field_name] = value if value is not None else getattr(config, field_name, None)
+        unknown = set(raw) - set(types)
+        if unknown:
+            raise ValueError("Unknown settings of the bot {}: {}".format(name, ', '.join(sorted(unknown))))
+        bots[str(name)] = Bot(name=str(name), **values)
+    return replace(config, bots=bots)
+
+
+OPTIONAL_FIELDS = ('admin_port', 'slow_update_seconds', 'rate_limit_per_minute', 'quick_max_tokens',
+                   'explanation_max_tokens', 'memory_high_water_mb', 'memory_chat_max_kb',
+                   'openai_total_timeout', 'openai_hedge_percentile', 'chat_token_budget', 'over_budget_max_tokens')
+SECRET_FIELDS = ('openai_api_key', 'telegram_api_key', 'api_hash', 'api_id')
+
+
+def _convert(name, field_type, raw):
+    if raw is None or (isinstance(raw, str) and not raw.strip()):
+        return None
+    try:
+        if field_type is dict:
+            value = json.loads(raw) if isinstance(raw, str) else raw
+            if not isinstance(value, dict):
+                raise ValueError("a JSON object is expected")
+            return {str(key): item for key, item in value.items()}
+        if field_type is int:
+            value = int(raw)
+        elif field_type is float:
+            value = float(raw)
+        else:
+            return str(raw)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid value for {}: {!r} ({})".format(name, raw, e))
+    if name in OPTIONAL_FIELDS and not value:
+        return None
+    if value < 0:
+        raise ValueError("Invalid value for {}: {!r} (must not be negative)".format(name, raw))
+    return value
+
+####################################
+
+# THE "GET_CONFIG", "RELOAD_CONFIG" AND "ON_RELOAD" FUNCTIONS
+
+_lock = threading.Lock()
+_config = None
+_overrides = {}  # the values set through the admin endpoint
+_listeners = []  # functions called with (old, new) after a reload
+
+
+def get_config():
+    global _config
+    if _config is None:
+        with _lock:
+            if _config is None:
+                _config = _load(_overrides)
+    return _config
+
+
+def _load(overrides):
+    config = Config.from_env()
+    if config.config_file and os.path.exists(config.config_file):
+        with open(config.config_file, encoding='utf-8') as config_file:
+            try:
+                values = json.load(config_file)
+            except ValueError as e:
+                raise ValueError("Invalid JSON in {}: {}".format(config.config_file, e))
+        if not isinstance(values, dict):
+            raise ValueError("{} must hold a JSON object".format(config.config_file))
+        config = Config.from_values(values, config)
+    return _resolve_bots(Config.from_values(overrides, config))
+
+
+# Reloads the configuration, adding the given overrides to the ones already set; returns the new one
+def reload_config(overrides=None):
+    global _config, _overrides
+    with _lock:
+        new_overrides = dict(_overrides)
+        new_overrides.update(overrides or {})
+        new = _load(new_overrides)  # raises ValueError, and then nothing changes
+        old = _config
+        _config = new
+        _overrides = new_overrides
+        listeners = list(_listeners)
+
+    changed = sorted(name for name, value in asdict(new).items() if old is None or getattr(old, name) != value)
+    logger.error("Configuration reloaded, changed: %s", ', '.join(changed) or 'nothing')
+    for listener in listeners:
+        try:
+            listener(old, new)
+        except Exception as e:
+            logger.exception("Failed to apply the new configuration: {}".format(e))
+    return new
+
+
+def on_reload(listener):
+    with _lock:
+        if listener not in _listeners:
+            _listeners.append(listener)
+    return listener
+
+####################################
+
+# THE "DESCRIBE_CONFIG" FUNCTION
+
+# Returns the active configuration as a dictionary for the admin endpoint, with the secrets hidden.
+
+
+def describe_config(config=None):
+    values = asdict(config or get_config())
+    for section in [values] + list((values.get('bots') or {}).values()):
+        for name in SECRET_FIELDS:
+            if section.get(name):
+                section[name] = '***'
+    return values
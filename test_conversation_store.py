@@ -0,0 +1,105 @@
+# "MYSHLENEK", the checks of the conversation store
+# Usage: python -m pytest -q test_conversation_store.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks that a conversation being written to the cold tier (see 'conversation_store.py') is never lost:
+# a 'checkout' of the chat during the write takes the same conversation back, and a 'reset' during
+# the write is not undone by the file. The write is held in the middle by events, not by sleeps.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import threading
+
+import pytest
+
+import conversation_store
+from conversation_store import BOT, USER, ConversationStore
+
+####################################
+
+# THE FIXTURES
+
+
+# Holds every 'compress' (the write of a spilled conversation) until 'resume' is set;
+# 'writing' is set when a write has started
+@pytest.fixture
+def held_write(monkeypatch):
+    writing = threading.Event()
+    resume = threading.Event()
+    compress = conversation_store.Conversation.compress
+
+    def held_compress(conversation):
+        writing.set()
+        assert resume.wait(10)
+        return compress(conversation)
+
+    monkeypatch.setattr(conversation_store.Conversation, 'compress', held_compress)
+    yield writing, resume
+    resume.set()
+
+
+def chat(store, chat_id, *texts):
+    conversation = store.checkout(chat_id)
+    for text in texts:
+        conversation.add(USER, text)
+        conversation.add(BOT, "an answer to " + text)
+    store.checkin(chat_id, conversation)
+    return conversation
+
+
+def spill_in_background(store):
+    spilling = threading.Thread(target=store.spill_idle, kwargs={'idle_seconds': -1})
+    spilling.start()
+    return spilling
+
+####################################
+
+# THE CHECKS
+
+
+def test_a_checkout_during_the_spill_takes_the_same_conversation(tmp_path, held_write):
+    writing, resume = held_write
+    store = ConversationStore(str(tmp_path))
+    first = chat(store, 'chat', "the first question")
+    spilling = spill_in_background(store)
+    assert writing.wait(10)
+
+    assert chat(store, 'chat', "the second question") is first
+    resume.set()
+    spilling.join(10)
+
+    assert store.hot_chats() == 1
+    store.flush()
+    texts = [turn.text for turn in ConversationStore(str(tmp_path)).checkout('chat').turns]
+    assert texts[0::2] == ["the first question", "the second question"]
+
+
+def test_a_reset_during_the_spill_is_not_undone(tmp_path, held_write):
+    writing, resume = held_write
+    store = ConversationStore(str(tmp_path))
+    chat(store, 'chat', "a question")
+    spilling = spill_in_background(store)
+    assert writing.wait(10)
+
+    store.reset('chat')
+    resume.set()
+    spilling.join(10)
+
+    assert store.checkout('chat').turns == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_a_spilled_conversation_comes_back(tmp_path):
+    store = ConversationStore(str(tmp_path))
+    conversation = chat(store, 'chat', "a question")
+    conversation.partial = "a cut answer"
+    assert store.flush() == 1 and store.hot_chats() == 0
+
+    rehydrated = store.checkout('chat')
+    assert [turn.text for turn in rehydrated.turns] == ["a question", "an answer to a question"]
+    assert rehydrated.partial == "a cut answer"
@@ -0,0 +1,80 @@
+# "MYSHLENEK", the checks of the offset of the updates
+# Usage: python -m pytest -q test_lifecycle.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks that a new process handles again the updates the previous one left unfinished,
+# and only them (see 'lifecycle.py'), whatever the order in which the updates finished,
+# and that the drain does not confirm the updates it had to cancel (with the bot of 'conftest.py').
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+from concurrent.futures import Future
+
+from conftest import message, sent_to
+from lifecycle import OffsetCheckpoint, UpdateOffsets
+
+####################################
+
+# THE CHECKS
+
+
+def dispatch(offsets, update_ids):
+    futures = {}
+    for update_id in update_ids:
+        offsets.last_update_id = update_id
+        futures[update_id] = Future()
+        offsets.pending.add(update_id, futures[update_id])
+    return futures
+
+
+def test_the_updates_finished_after_a_pending_one_are_not_handled_again(tmp_path):
+    path = str(tmp_path / 'offset.json')
+    offsets = UpdateOffsets(path)
+    futures = dispatch(offsets, (10, 11, 12))
+    futures[11].set_result(None)
+    offsets.pending.add(13, None)  # an update without work (an ignored update or '/stop')
+    offsets.last_update_id = 13
+    offsets.save()
+
+    restarted = UpdateOffsets(path)
+    assert restarted.last_update_id == 9
+    assert [update_id for update_id in (10, 11, 12, 13) if not restarted.finished(update_id)] == [10, 12]
+
+
+def test_the_finished_updates_are_forgotten_once_confirmed(tmp_path):
+    path = str(tmp_path / 'offset.json')
+    offsets = UpdateOffsets(path)
+    futures = dispatch(offsets, (10, 11))
+    futures[11].set_result(None)
+    assert offsets.snapshot() == (9, [11])
+    futures[10].set_result(None)
+    assert offsets.snapshot() == (11, [])
+    offsets.save()
+    assert UpdateOffsets(path).last_update_id == 11
+
+
+def test_an_old_offset_file_is_still_read(tmp_path):
+    path = tmp_path / 'offset.json'
+    path.write_text('{"last_update_id": 42}')
+    offsets = UpdateOffsets(str(path))
+    assert offsets.last_update_id == 42 and not offsets.finished(43)
+
+
+def test_the_drain_leaves_the_cancelled_updates_unconfirmed(bot, server, held, tmp_path):
+    path = str(tmp_path / 'offset.json')
+    offsets = UpdateOffsets(path)
+    for update_id, chat_id in ((10, 104), (11, 105)):
+        offsets.last_update_id = update_id
+        offsets.pending.add(update_id, bot.dispatch_update(message(update_id, chat_id, "a question")))
+    held.wait_started()
+    held.wait_started()
+    bot.drain({'default': offsets})
+
+    last_update_id, finished = OffsetCheckpoint(path).load()
+    assert last_update_id < 10 and 10 not in finished and 11 not in finished
+    assert sent_to(server, 104) == [] and sent_to(server, 105) == []
@@ -0,0 +1,92 @@
+# "MYSHLENEK", the checks of the log analyzer
+# Usage: python -m pytest -q test_log_analyzer.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks how the log analyzer (see 'log_analyzer.py') counts the ends of the OpenAI requests,
+# in the old logs (no trace, no "Generated response") and in the structured ones,
+# and that splitting the file into chunks does not change the result.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import os
+
+import pytest
+
+from log_analyzer import analyze
+
+DAY = 86400
+
+# The old text format: a success, a failure with a status code, a failure without one,
+# and an answer from the semantic cache (no request at all)
+LEGACY_LOG = """\
+2023-03-06 16:21:47 ERROR Received message: What is TRIZ?
+2023-03-06 16:21:47 ERROR Sending request to OpenAI with data: {'prompt': 'What is TRIZ?'}
+2023-03-06 16:21:49 ERROR After generate_response(): response = TRIZ is the theory of inventive problem solving.
+NoneType: None
+2023-03-06 16:22:36 ERROR Received message: Are you living?
+2023-03-06 16:22:36 ERROR Sending request to OpenAI with data: {'prompt': 'Are you living?'}
+2023-03-06 16:22:37 ERROR OpenAI API request failed with status code 401
+2023-03-06 16:22:37 ERROR After generate_response(): response = Seems, something happened, sorry.
+2023-03-06 16:23:10 ERROR Received message: Hello
+2023-03-06 16:23:10 ERROR Sending request to OpenAI with data: {'prompt': 'Hello'}
+2023-03-06 16:23:15 ERROR OpenAI API request failed: HTTPSConnectionPool(host='api.openai.com', port=443): Read timed out.
+2023-03-06 16:23:15 ERROR After generate_response(): response = Seems, something happened, sorry.
+2023-03-06 16:24:00 ERROR Received message: What is TRIZ?
+2023-03-06 16:24:00 ERROR After generate_response(): response = TRIZ is the theory of inventive problem solving.
+"""
+
+STRUCTURED_LOG = """\
+{"time":"2023-03-06T16:21:47.100","level":"ERROR","trace":"a1","chat":"5","message":"Received message: Hi"}
+{"time":"2023-03-06T16:21:47.200","level":"ERROR","trace":"a1","chat":"5","message":"Sending request to OpenAI"}
+{"time":"2023-03-06T16:21:48.700","level":"ERROR","trace":"a1","chat":"5","message":"Generated response: Hello"}
+{"time":"2023-03-06T16:21:48.800","level":"ERROR","trace":"a1","chat":"5","message":"After generate_response(): response = Hello"}
+"""
+
+####################################
+
+# THE CHECKS
+
+
+def summary(path, **options):
+    buckets, _ = analyze(str(path), bucket_seconds=DAY, **options)
+    assert len(buckets) == 1
+    stats = next(iter(buckets.values()))
+    return stats.summary(), sorted(stats.latencies)
+
+
+@pytest.fixture
+def legacy_log(tmp_path):
+    path = tmp_path / 'error.log'
+    path.write_text(LEGACY_LOG)
+    return path
+
+
+def test_the_old_log_counts_every_request_once(legacy_log):
+    stats, latencies = summary(legacy_log)
+    assert stats['received'] == 4 and stats['requests'] == 3
+    assert stats['statuses'] == {'200': 1, '401': 1, 'failed': 1}
+    assert latencies == [1.0, 2.0, 5.0]
+
+
+@pytest.mark.parametrize('chunk_bytes', [64, 200, 700])
+def test_the_chunks_do_not_change_the_result(legacy_log, chunk_bytes):
+    assert summary(legacy_log, chunk_bytes=chunk_bytes, workers=2) == summary(legacy_log)
+
+
+def test_the_structured_log_ends_a_request_once(tmp_path):
+    path = tmp_path / 'structured.log'
+    path.write_text(STRUCTURED_LOG)
+    stats, latencies = summary(path)
+    assert stats['statuses'] == {'200': 1}
+    assert latencies == [pytest.approx(1.5)]
+
+
+def test_the_log_of_the_repository():
+    stats, _ = summary(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'error.log'))
+    assert stats['requests'] == 17
+    assert stats['statuses'] == {'200': 7, '401': 7, '429': 3}
@@ -0,0 +1,34 @@
+# "MYSHLENEK", the checks of the retries of the OpenAI requests
+# Usage: python -m pytest -q test_resilience.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks that the statuses 429 and 5xx of the OpenAI API are retried (see 'resilience.py'),
+# and that the User gets the failure message once the retries are used up,
+# with the bot and the stand-ins of 'conftest.py' (the stand-in answers 'Retry-After: 0').
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+from conftest import FAILURE, message, sent_to
+
+####################################
+
+# THE CHECKS
+
+
+def test_429_and_5xx_are_retried(bot, server):
+    server.openai_statuses.extend([429, 503])
+    before = server.counters['completions']
+    bot.dispatch_update(message(30, 109, "a question")).result(timeout=30)
+    assert server.counters['completions'] - before == 3
+    assert sent_to(server, 109) and sent_to(server, 109)[0] != FAILURE
+
+
+def test_the_last_failure_is_answered_with_the_failure_message(bot, server):
+    server.openai_statuses.extend([503] * (bot.get_config().openai_max_retries + 1))
+    bot.dispatch_update(message(31, 110, "a question")).result(timeout=30)
+    assert sent_to(server, 110) == [FAILURE]
@@ -0,0 +1,59 @@
+# "MYSHLENEK", the checks of the scheduling
+# Usage: python -m pytest -q test_scheduling.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Runs the bot against the local stand-ins of the Telegram API and the OpenAI API (see 'conftest.py')
+# and checks what the scheduling and the cancellation promise (see 'scheduler.py' and 'cancellation.py'):
+# - a message superseded by a newer one of the same chat, or stopped by '/stop', sends nothing;
+# - '/stop' returns at once, even while the stream of the generation is stalled;
+# - the updates without a message text are not dispatched at all.
+
+# Every check holds the generations at the OpenAI stand-in ('held') and lets them go
+# after the event it checks, and uses its own chats. The messages are shorter than
+# the minimal length of the semantic cache, so no answer comes from the cache.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import time
+
+from conftest import message, sent_to
+
+####################################
+
+# THE CHECKS
+
+
+def test_a_superseded_generation_sends_nothing(bot, server, held):
+    first = bot.dispatch_update(message(1, 101, "first"))
+    held.wait_started()
+    second = bot.dispatch_update(message(2, 101, "second"))
+    held.release()
+    first.result(timeout=10)
+    second.result(timeout=10)
+    assert len(sent_to(server, 101)) == 1
+
+
+def test_stop_cancels_the_generation(bot, server, held):
+    work = bot.dispatch_update(message(3, 102, "a question"))
+    held.wait_started()
+    started = time.perf_counter()
+    assert bot.dispatch_update(message(4, 102, "/stop")) is None
+    assert time.perf_counter() - started < 1.0  # the stalled stream is not waited for
+    work.result(timeout=10)
+    held.release()
+    assert sent_to(server, 102) == []
+
+
+def test_updates_without_text_are_not_dispatched(bot, server, held):
+    work = bot.dispatch_update(message(5, 103, "a question"))
+    held.wait_started()
+    assert bot.dispatch_update({'update_id': 6, 'edited_message': {'text': "edited", 'chat': {'id': 103}}}) is None
+    assert bot.dispatch_update({'update_id': 7, 'message': {'sticker': {}, 'chat': {'id': 103}}}) is None
+    held.release()
+    work.result(timeout=10)
+    assert len(sent_to(server, 103)) == 1
@@ -0,0 +1,81 @@
+# "MYSHLENEK", the checks of the semantic answer cache
+# Usage: python -m pytest -q test_semantic_cache.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks what the semantic cache (see 'semantic_cache.py') promises:
+# - a reworded question gets the stored answer, a question with other numbers or another context does not;
+# - two caches on one directory (two processes) never overwrite the entries of each other,
+#   and a vector without its entry is never answered with the answer of the old entry of the slot.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+from semantic_cache import SemanticCache, conversation_context
+
+IFR = "What is the ideal final result in TRIZ?"
+MATRIX = "Explain the contradiction matrix of TRIZ"
+
+####################################
+
+# THE CHECKS
+
+
+def test_a_reworded_question_is_answered_from_the_cache(tmp_path):
+    cache = SemanticCache(str(tmp_path), capacity=8)
+    cache.store(IFR, "ANSWER ABOUT IFR")
+    assert cache.lookup("What is the ideal final result in TRIZ") == "ANSWER ABOUT IFR"
+
+
+def test_other_numbers_are_another_question(tmp_path):
+    cache = SemanticCache(str(tmp_path), capacity=8)
+    cache.store("What is the 15th inventive principle of TRIZ?", "ANSWER ABOUT 15")
+    assert cache.lookup("What is the 16th inventive principle of TRIZ?") is None
+    assert cache.lookup("what is the 15th inventive principle of TRIZ") == "ANSWER ABOUT 15"
+
+
+def test_a_follow_up_is_answered_only_in_its_conversation(tmp_path):
+    cache = SemanticCache(str(tmp_path), capacity=8)
+    question = "Can you give me an example of that, please?"
+    first = conversation_context('bot:1', "What is segmentation?\nSegmentation is ...")
+    second = conversation_context('bot:2', "What is asymmetry?\nAsymmetry is ...")
+    cache.store(question, "AN EXAMPLE OF SEGMENTATION", context=first)
+    assert cache.lookup(question, context=second) is None
+    assert cache.lookup(question) is None
+    assert cache.lookup(question, context=first) == "AN EXAMPLE OF SEGMENTATION"
+
+
+def test_two_processes_do_not_overwrite_each_other(tmp_path):
+    first = SemanticCache(str(tmp_path), capacity=8)
+    second = SemanticCache(str(tmp_path), capacity=8)
+    first.store(IFR, "ANSWER ABOUT IFR")
+    second.store(MATRIX, "ANSWER ABOUT MATRIX")
+    assert first.lookup(MATRIX) == "ANSWER ABOUT MATRIX"
+    assert first.lookup(IFR) == "ANSWER ABOUT IFR"
+    assert second.lookup(IFR) == "ANSWER ABOUT IFR"
+    assert SemanticCache(str(tmp_path), capacity=8).entries == first.entries
+
+
+def test_a_vector_without_its_entry_is_not_answered(tmp_path):
+    cache = SemanticCache(str(tmp_path), capacity=1)
+    cache.store(IFR, "ANSWER ABOUT IFR")
+    # Another process wrote the vector of the next entry into the only slot, and not yet its line
+    cache.vectors[0] = cache.embedder.embed(MATRIX)
+    assert cache.lookup(MATRIX) is None
+    assert cache.lookup(IFR) is None
+
+
+def test_a_compaction_by_another_process_is_read_again(tmp_path):
+    first = SemanticCache(str(tmp_path), capacity=2)
+    for number in range(5):
+        first.store("A question about the principle number {} of TRIZ".format(number), str(number))
+    # A new process compacts the file (more than twice the capacity of lines), then both go on storing
+    second = SemanticCache(str(tmp_path), capacity=2)
+    second.store(MATRIX, "ANSWER ABOUT MATRIX")
+    first.store(IFR, "ANSWER ABOUT IFR")
+    assert second.lookup(IFR) == "ANSWER ABOUT IFR"
+    assert first.lookup(MATRIX) == "ANSWER ABOUT MATRIX"
+    assert first.entries == second.entries
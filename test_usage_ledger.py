@@ -0,0 +1,46 @@
+# "MYSHLENEK", the checks of the token usage
+# Usage: python -m pytest -q test_usage_ledger.py
+
+####################################
+
+# THE PURPOSE OF THE SCRIPT
+
+# Checks what the usage ledger promises (see 'usage_ledger.py'), with the bot and the stand-ins of 'conftest.py':
+# - the chats that used fewer tokens lately are served first by the scheduler;
+# - the tokens of a cancelled generation are counted too.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+from conftest import message
+
+####################################
+
+# THE CHECKS
+
+
+def test_the_lighter_chat_is_served_first(bot, server, held):
+    from scheduler import Scheduler
+
+    bot.set_component('scheduler', Scheduler(1))
+    bot.get_component('usage_ledger').record('106', 'model', 5000, 5000, 1.0)
+    # The only slot is held, so both messages wait in the queue; the heavy chat comes first
+    busy = bot.dispatch_update(message(20, 107, "a question"))
+    held.wait_started()
+    heavy = bot.dispatch_update(message(21, 106, "a question"))
+    light = bot.dispatch_update(message(22, 108, "a question"))
+    held.release()
+    for work in (busy, heavy, light):
+        work.result(timeout=10)
+    chats = [chat_id for chat_id, _ in server.sent]
+    assert chats.index('108') < chats.index('106')
+
+
+def test_a_cancelled_generation_is_counted(bot, server, held):
+    ledger = bot.get_component('usage_ledger')
+    work = bot.dispatch_update(message(23, 111, "a question"))
+    held.wait_started()
+    assert bot.dispatch_update(message(24, 111, "/stop")) is None
+    work.result(timeout=10)
+    assert ledger.chat_tokens('111') > 0
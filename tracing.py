@@ -0,0 +1,265 @@
+# "MYSHLENEK", the per-update tracing
+# Used by 'main.py' and 'scheduler.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The log lines do not say which update or chat they belong to, so the journey of one message
+# cannot be pieced together when several updates are handled at the same time.
+
+# This module gives every update a trace: an ID and a list of timed spans, such as
+# 'queue' (waiting for a worker), 'prompt_build', 'openai' (with the token counts) and 'send_message'.
+
+# The current trace and span are kept in context variables. The scheduler copies the context
+# into the worker that handles the update (see 'scheduler.py'), so the trace follows the update
+# from 'get_updates' (or 'wsgi.application') to 'send_message'.
+# The 'TRACE_LOG_FILTER' adds the trace ID and the chat ID to every log line written in a trace.
+
+####################################
+
+# THE EXPORT AND THE TAIL-BASED SAMPLING
+
+# When a trace is finished, it is decided whether to keep it (tail-based sampling, because the decision
+# is made at the end, when the duration and the outcome are known). Kept are:
+# - the failed traces (an exception, or an error reported with 'mark_failed');
+# - the slow traces (longer than TRACE_SLOW_SECONDS);
+# - a random TRACE_SAMPLE_RATE share of all the other traces.
+# The kept traces are appended to the TRACE_FILE file as JSON lines (see 'settings.py').
+# If TRACE_FILE is empty, the traces are still used for the log lines, but nothing is exported.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import contextvars
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_current_trace = contextvars.ContextVar('trace', default=None)
+_current_span = contextvars.ContextVar('span', default=None)
+
+####################################
+
+# THE "SPAN" AND "TRACE" CLASSES
+
+
+class Span:
+    __slots__ = ('name', 'start', 'end', 'attributes')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attributes = attributes
+
+
+class Trace:
+    def __init__(self, name, attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.spans = []
+        self.open_spans = {}  # name -> Span started with 'start_span' and not ended yet
+        self.status = 'ok'
+        self.error = None
+        self._lock = threading.Lock()
+
+    def add_span(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self, end):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'start': self.started_at,
+            'duration': end - self.start,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+            'spans': [{
+                'name': span.name,
+                'offset': span.start - self.start,
+                'duration': (span.end if span.end is not None else end) - span.start,
+                'attributes': span.attributes,
+            } for span in self.spans],
+        }
+
+####################################
+
+# STARTING, ACTIVATING AND FINISHING A TRACE
+
+# 'start_trace' creates a trace, 'activate' makes it the current trace inside a 'with' block,
+# and 'finish_trace' ends it and passes it to the sampling and the export.
+
+
+def start_trace(name, **attributes):
+    return Trace(name, attributes)
+
+
+@contextmanager
+def activate(trace):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def finish_trace(trace=None, error=None):
+    trace = trace or _current_trace.get()
+    if trace is None:
+        return
+    end = time.perf_counter()
+    if error is not None:
+        mark_failed(str(error), trace)
+    with trace._lock:
+        for span in trace.open_spans.values():
+            span.end = end
+        trace.open_spans.clear()
+    _exporter.offer(trace, end)
+
+
+def mark_failed(reason, trace=None):
+    trace = trace or _current_trace.get()
+    if trace is not None:
+        trace.status = 'error'
+        trace.error = reason
+
+
+def set_trace_attributes(**attributes):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+####################################
+
+# THE SPANS
+
+# 'span' times a 'with' block of the current trace and makes it the current span,
+# so 'set_attributes' can add attributes to it from the called functions.
+# 'start_span' and 'end_span' are for spans that begin in one thread and end in another ('queue').
+# Without a current trace, all of them do nothing.
+
+
+@contextmanager
+def span(name, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+    current = Span(name, attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+        trace.add_span(current)
+
+
+def set_attributes(**attributes):
+    current = _current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def start_span(name, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    current = Span(name, attributes)
+    with trace._lock:
+        trace.open_spans[name] = current
+    return current
+
+
+def end_span(name, **attributes):
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    with trace._lock:
+        current = trace.open_spans.pop(name, None)
+    if current is not None:
+        current.end = time.perf_counter()
+        current.attributes.update(attributes)
+        trace.add_span(current)
+    return current
+
+####################################
+
+# THE "TRACE_EXPORTER" CLASS
+
+
+class TraceExporter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+
+    def offer(self, trace, end):
+        from settings import get_config
+
+        config = get_config()
+        duration = end - trace.start
+        metrics.observe('trace_seconds', duration)
+        if not config.trace_file:
+            return
+        keep = (trace.status != 'ok' or duration >= config.trace_slow_seconds
+                or random.random() < config.trace_sample_rate)
+        if not keep:
+            metrics.increment('traces.dropped')
+            return
+        line = json.dumps(trace.to_dict(end), ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(config.trace_file, 'a', encoding='utf-8')
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                logger.exception("Failed to export a trace: {}".format(e))
+                return
+        metrics.increment('traces.exported')
+
+
+_exporter = TraceExporter()
+
+####################################
+
+# THE "TRACE_LOG_FILTER" CLASS
+
+# Adds the 'trace' field to the log records: '[<trace ID> chat <chat ID>] ' inside a trace,
+# and an empty string outside of it. The log format of 'main.py' puts it before the message.
+# The structured log format uses the 'trace_id' and 'chat_id' fields instead (None outside a trace).
+
+
+class TraceLogFilter(logging.Filter):
+    def filter(self, record):
+        trace = _current_trace.get()
+        if trace is None:
+            record.trace = ''
+            record.trace_id = record.chat_id = None
+        else:
+            record.trace_id = trace.trace_id
+            record.chat_id = trace.attributes.get('chat_id', '-')
+            record.trace = '[{} chat {}] '.format(record.trace_id, record.chat_id)
+        return True
@@ -0,0 +1,115 @@
+# "MYSHLENEK", the traffic recorder
+# Used by 'main.py' and 'wsgi.py' to record, and by 'replay.py' to read the recorded traffic
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# To reproduce production incidents and to benchmark the bot with realistic arrival patterns,
+# the raw updates received from the Telegram API (by 'get_updates' or by the webhook)
+# are saved with their arrival time to an append-only file. 'replay.py' feeds them back later.
+
+# The recording is turned on by setting the TRAFFIC_RECORD_FILE environment variable (see 'settings.py').
+# When it is not set, 'record' does nothing.
+
+####################################
+
+# THE FILE FORMAT
+
+# The file is a sequence of records, each of them is:
+# - a header of 13 bytes: the arrival time (a little-endian double, seconds since the epoch),
+#   the source (one byte: 0 for 'getUpdates', 1 for the webhook) and the length of the payload (4 bytes);
+# - the payload: the update as compact UTF-8 JSON (see 'codec.py'); the webhook records the body as it came.
+
+# A record is written with a single 'write' call on a file opened in append mode,
+# so the records of several threads or processes are not mixed.
+# A truncated last record (for example after a crash) is ignored by 'read_traffic'.
+
+####################################
+
+# THE EXTERNAL LIBRARIES in use:
+
+import logging
+import struct
+import threading
+import time
+
+import codec
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<dBI')
+SOURCE_POLL = 0
+SOURCE_WEBHOOK = 1
+
+####################################
+
+# THE "TRAFFIC_RECORDER" CLASS
+
+
+class TrafficRecorder:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def record(self, update, source=SOURCE_POLL, arrived=None):
+        payload = update if isinstance(update, bytes) else codec.dumps(update)
+        data = HEADER.pack(time.time() if arrived is None else arrived, source, len(payload)) + payload
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, 'ab', buffering=0)
+                self._file.write(data)
+            except OSError as e:
+                logger.exception("Failed to record an update: {}".format(e))
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+####################################
+
+# THE "RECORD" FUNCTION
+
+# The module-level recorder used by the bot. It is created on the first call,
+# from the 'traffic_record_file' setting (read only then, so 'replay.py' can import this module
+# before it sets up the environment of the bot).
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+
+def record(update, source=SOURCE_POLL):
+    global _recorder
+    if _recorder is None:
+        from settings import get_config
+
+        path = get_config().traffic_record_file
+        if not path:
+            return
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = TrafficRecorder(path)
+    _recorder.record(update, source)
+
+####################################
+
+# THE "READ_TRAFFIC" FUNCTION
+
+# Yields the recorded updates as tuples (arrival time, source, update dictionary).
+
+
+def read_traffic(path):
+    with open(path, 'rb') as traffic_file:
+        while True:
+            header = traffic_file.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            arrived, source, length = HEADER.unpack(header)
+            payload = traffic_file.read(length)
+            if len(payload) < length:
+                return
+            yield arrived, source, codec.loads(payload)
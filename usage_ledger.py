@@ -0,0 +1,243 @@
+# "MYSHLENEK", the token usage ledger
+# Used by 'main.py'
+
+####################################
+
+# THE PURPOSE OF THE MODULE
+
+# The 'usage' block of the OpenAI answers used to be thrown away, so nobody could tell which chats
+# used up the capacity of the bot. The 'USAGE_LEDGER' now records, for every generation (the cancelled
+# and the failed ones too, with the tokens estimated from what was received),
+# the prompt tokens, the completion tokens and the time it took, per chat and per model.
+
+# The numbers are kept for a rolling window ('usage_window_seconds' in 'settings.py', an hour by default),
+# in BUCKETS time buckets per chat and per model, so the sums always describe the last window
+# and the memory of a chat does not grow with time.
+
+# The ledger drives the scheduling (see 'dispatch_update' and 'process_update' in 'main.py'):
+# - 'priority' orders the queue of the scheduler: the chats that used fewer tokens in the window
+#   go first (the fair share), and the chats over 'chat_token_budget' go after all the others;
+# - a chat over its budget also gets a shorter answer ('over_budget_max_tokens')
+#   and a cheaper model ('over_budget_model'), if they are set.
+
+# 'report' returns the totals of the window per model and for the heaviest chats
+# (GET /usage of the admin endpoint, see 'admin.py').
+
+####################################
+
+# THE FILE FORMAT
+
+# Every record is also appended to the 'usage_file', so the window survives a restart.
+# A record is a header of 22 bytes: the time (a little-endian double, seconds since the epoch),
+# the prompt tokens and the completion tokens (4 bytes each), the seconds of the request (a float),
+# the lengths of the chat key and of the model name (1 byte each), then the chat key and the model name
+# in UTF-8. On start, the records of the last window are read back; if most of the file is older
+# than that, it is rewritten with the recent records only, so the file stays small.
+
+####################################
+
+# THE EXTERNAL LIBRARIES AND FILES in use:
+
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('<dIIfBB')
+BUCKETS = 60  # the number of time buckets of the window
+PROMPT, COMPLETION, REQUESTS, SECONDS = range(4)
+
+####################################
+
+# THE "USAGE_WINDOW" CLASS
+
+# The usage of one chat or one model: a dictionary from the number of the time bucket
+# to the list [prompt tokens, completion tokens, requests, seconds].
+
+
+class UsageWindow:
+    __slots__ = ('buckets',)
+
+    def __init__(self):
+        self.buckets = {}
+
+    def add(self, bucket, prompt_tokens, completion_tokens, seconds):
+        totals = self.buckets.get(bucket)
+        if totals is None:
+            totals = self.buckets[bucket] = [0, 0, 0, 0.0]
+        totals[PROMPT] += prompt_tokens
+        totals[COMPLETION] += completion_tokens
+        totals[REQUESTS] += 1
+        totals[SECONDS] += seconds
+
+    # Drop the buckets older than 'oldest'; returns True if nothing is left
+    def expire(self, oldest):
+        for bucket in [bucket for bucket in self.buckets if bucket < oldest]:
+            del self.buckets[bucket]
+        return not self.buckets
+
+    def totals(self, oldest):
+        totals = [0, 0, 0, 0.0]
+        for bucket, values in self.buckets.items():
+            if bucket >= oldest:
+                for i in range(4):
+                    totals[i] += values[i]
+        return totals
+
+####################################
+
+# THE "USAGE_LEDGER" CLASS
+
+# 'path' is the usage file (None keeps the ledger in memory only), 'window_seconds' the rolling window.
+
+
+class UsageLedger:
+    def __init__(self, path, window_seconds=3600.0):
+        self.path = path
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._chats = {}  # chat key -> UsageWindow
+        self._models = {}  # model -> UsageWindow
+        self._file = None
+        if path:
+            self._load()
+
+    def _bucket(self, moment):
+        return int(moment // (self.window_seconds / BUCKETS))
+
+    def _oldest(self):
+        return self._bucket(time.time()) - BUCKETS + 1
+
+    def _add(self, moment, chat_id, model, prompt_tokens, completion_tokens, seconds):
+        bucket = self._bucket(moment)
+        for windows, key in ((self._chats, chat_id), (self._models, model)):
+            window = windows.get(key)
+            if window is None:
+                window = windows[key] = UsageWindow()
+            window.add(bucket, prompt_tokens, completion_tokens, seconds)
+
+    def record(self, chat_id, model, prompt_tokens, completion_tokens, seconds):
+        now = time.time()
+        chat_bytes = str(chat_id).encode('utf-8')[:255]
+        model_bytes = str(model).encode('utf-8')[:255]
+        data = HEADER.pack(now, prompt_tokens, completion_tokens, seconds, len(chat_bytes), len(model_bytes)) + chat_bytes + model_bytes
+        with self._lock:
+            self._add(now, chat_id, model, prompt_tokens, completion_tokens, seconds)
+            if self.path:
+                try:
+                    if self._file is None:
+                        self._file = open(self.path, 'ab', buffering=0)
+                    self._file.write(data)
+                except OSError as e:
+                    logger.exception("Failed to record the token usage: {}".format(e))
+        metrics.increment('usage.prompt_tokens', prompt_tokens)
+        metrics.increment('usage.completion_tokens', completion_tokens)
+
+    # The tokens used by the chat in the window
+    def chat_tokens(self, chat_id):
+        with self._lock:
+            window = self._chats.get(chat_id)
+            if window is None:
+                return 0
+            totals = window.totals(self._oldest())
+        return totals[PROMPT] + totals[COMPLETION]
+
+    def over_budget(self, chat_id, budget):
+        return bool(budget) and self.chat_tokens(chat_id) >= budget
+
+    # The place of the chat in the queue of the scheduler: the chats over the budget last,
+    # the others by the tokens they used in the window, the fewest first
+    def priority(self, chat_id, budget=None):
+        tokens = self.chat_tokens(chat_id)
+        return (1 if budget and tokens >= budget else 0, tokens)
+
+    def report(self, top=10):
+        oldest = self._oldest()
+        with self._lock:
+            chats = [(window.totals(oldest), chat_id) for chat_id, window in self._chats.items()]
+            models = {model: window.totals(oldest) for model, window in self._models.items()}
+        chats.sort(key=lambda item: item[0][PROMPT] + item[0][COMPLETION], reverse=True)
+        return {
+            'window_seconds': self.window_seconds,
+            'models': {model: _describe(totals) for model, totals in sorted(models.items()) if totals[REQUESTS]},
+            'chats': len(chats),
+            'heaviest_chats': {str(chat_id): _describe(totals) for totals, chat_id in chats[:top] if totals[REQUESTS]},
+        }
+
+    # Forget the chats and the models with no usage in the window (called by the memory accounting)
+    def forget_idle_chats(self):
+        oldest = self._oldest()
+        forgotten = 0
+        with self._lock:
+            for windows in (self._chats, self._models):
+                for key in [key for key, window in windows.items() if window.expire(oldest)]:
+                    del windows[key]
+                    forgotten += 1
+        return forgotten
+
+    # A close estimate: the dictionaries, and a list of four numbers per bucket
+    def memory_usage(self):
+        with self._lock:
+            windows = list(self._chats.values()) + list(self._models.values())
+            chats = len(self._chats)
+            size = sys.getsizeof(self._chats) + sys.getsizeof(self._models)
+        bucket_bytes = sys.getsizeof([0, 0, 0, 0.0]) + 4 * sys.getsizeof(0.0)
+        for window in windows:
+            size += sys.getsizeof(window) + sys.getsizeof(window.buckets) + len(window.buckets) * bucket_bytes
+        return {'bytes': size, 'chats': chats}
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # Read back the records of the window; rewrite the file if most of it is older than the window
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as usage_file:
+                data = usage_file.read()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.exception("Failed to read the token usage: {}".format(e))
+            return
+        since = time.time() - self.window_seconds
+        recent = []
+        total = 0
+        position = 0
+        while position + HEADER.size <= len(data):
+            moment, prompt_tokens, completion_tokens, seconds, chat_length, model_length = HEADER.unpack_from(data, position)
+            end = position + HEADER.size + chat_length + model_length
+            if end > len(data):
+                break  # a truncated last record
+            total += 1
+            if moment >= since:
+                chat_id = data[position + HEADER.size:end - model_length].decode('utf-8', 'replace')
+                model = data[end - model_length:end].decode('utf-8', 'replace')
+                self._add(moment, chat_id, model, prompt_tokens, completion_tokens, seconds)
+                recent.append(data[position:end])
+            position = end
+        if total > 2 * len(recent) + 1000:
+            temporary_path = self.path + '.tmp'
+            try:
+                with open(temporary_path, 'wb') as usage_file:
+                    usage_file.write(b''.join(recent))
+                os.replace(temporary_path, self.path)
+            except OSError as e:
+                logger.exception("Failed to compact the token usage file: {}".format(e))
+
+
+def _describe(totals):
+    return {
+        'prompt_tokens': totals[PROMPT],
+        'completion_tokens': totals[COMPLETION],
+        'requests': totals[REQUESTS],
+        'mean_seconds': totals[SECONDS] / totals[REQUESTS] if totals[REQUESTS] else 0.0,
+    }
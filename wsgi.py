@@ -1,19 +1,60 @@
+import atexit
 import json
-import logging
-import os
-import requests
-import time
+import threading
 
 from json.decoder import JSONDecodeError
 
-# Import the handle_message function from your main code file
-from main import handle_message
+# Import the dispatch_update function from your main code file
+from main import dispatch_update, configure_logging, drain, start_admin_endpoint, start_memory_monitor, start_spill_timer
+from settings import get_config
+import traffic
+import codec
 
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Importing this file does no work, so the web server can import it before forking its workers.
+# The worker is set up on its first request, once ('start_worker'): the logging (see 'configure_logging'
+# in 'main.py'), the admin endpoint (if ADMIN_PORT is set, see 'admin.py'), the memory accounting, the timer moving the idle conversations to disk ('start_spill_timer'),
+# and the drain at the exit of the worker. The threads are started in the worker itself, after the fork. The webhook request only queues the update
+# and is answered at once, so the answers are generated after it; when the worker stops, the drain
+# lets them finish for up to 'drain_seconds' (give gunicorn a '--graceful-timeout' at least as long).
+
+_worker_lock = threading.Lock()
+_worker_started = False
+
+
+# 'drain_at_exit' is False for a server that drains by itself (see 'run_webhook' in 'cli.py')
+
+
+def start_worker(drain_at_exit=True):
+    global _worker_started
+    with _worker_lock:
+        if _worker_started:
+            return
+        _worker_started = True
+        configure_logging()
+        start_admin_endpoint()
+        start_memory_monitor()
+        start_spill_timer()
+        if drain_at_exit:
+            atexit.register(drain, {})
+
+# Every bot hosted by the process (see 'THE BOTS' in 'settings.py') has its own webhook path:
+# '/' for the default bot and '/<name of the bot>' for the others, so the webhook of each bot
+# is set to its own URL, and the path tells which bot an update came to.
+
+
+def find_bot(path):
+    name = path.strip('/')
+    try:
+        return get_config().bot(name or None)
+    except ValueError:
+        return None
+
 
 def application(environ, start_response):
+    # Set up logging and the drain of the worker
+    start_worker()
+
     # Set the response content type
     headers = [("Content-type", "application/json")]
 
@@ -21,25 +62,34 @@ def application(environ, start_response):
     method = environ.get("REQUEST_METHOD")
     path = environ.get("PATH_INFO")
 
-    if method == "POST" and path == "/":
+    bot = find_bot(path or "/") if method == "POST" else None
+    if bot is not None:
         try:
             # Get the request body
             length = int(environ.get("CONTENT_LENGTH", "0"))
-            body = environ["wsgi.input"].read(length).decode()
+            body = environ["wsgi.input"].read(length)
+
+            # Parse the request body as JSON (see 'codec.py')
+            request = codec.loads(body)
 
-            # Parse the request body as JSON
-            request = json.loads(body)
+            # Save the raw update as it came, if the traffic recording is turned on (see 'traffic.py')
+            traffic.record(body, traffic.SOURCE_WEBHOOK)
 
-            # Call the handle_message function with the request and an empty conversation history
-            response = handle_message(request, "")
+            # Handle the update the same way as the polling loop does (see 'dispatch_update' in 'main.py'):
+            # it is queued on the scheduler, with the conversation of the chat, the planned answer length
+            # and the token budget, and the trace and the profiling of a slow update come with it.
+            # The request does not wait for the answer, so Telegram does not send the update again
+            # because of a slow answer, and the next update of the chat ('/stop' or a newer message)
+            # can come in and cancel the generation.
+            future = dispatch_update(request, bot, source='webhook')
 
-            # Construct the response data as a JSON string
-            data = json.dumps({"response": response})
+            # Construct the response data as JSON bytes
+            data = codec.dumps({"queued": future is not None})
 
             # Set the response status code and send the response data
             status = "200 OK"
             start_response(status, headers)
-            return [data.encode()]
+            return [data]
 
         except JSONDecodeError:
             # If the request body cannot be parsed as JSON, return a 400 Bad Request response